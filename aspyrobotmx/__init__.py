@@ -1,7 +1,36 @@
-from .robot import RobotMX
-from .server import RobotServerMX
-from .client import RobotClientMX
+import importlib
+import sys
 
 __version__ = '0.24.0'
 
 __all__ = ['RobotMX', 'RobotServerMX', 'RobotClientMX']
+
+# Classes and modules are imported on first access so client-only processes
+# don't import the server and with it pyepics and requests
+_lazy_attrs = {
+    'RobotMX': 'robot',
+    'RobotServerMX': 'server',
+    'RobotClientMX': 'client',
+}
+
+
+def __getattr__(name):
+    if name in _lazy_attrs:
+        module = importlib.import_module('.' + _lazy_attrs[name], __name__)
+        return getattr(module, name)
+    try:
+        return importlib.import_module('.' + name, __name__)
+    except ImportError as exc:
+        if exc.name != f'{__name__}.{name}':
+            raise
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
+
+
+if sys.version_info < (3, 7):  # module __getattr__ needs PEP 562
+    from .robot import RobotMX  # noqa: F401
+    from .server import RobotServerMX  # noqa: F401
+    from .client import RobotClientMX  # noqa: F401
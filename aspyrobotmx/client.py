@@ -1,4 +1,22 @@
+import logging
+import random
+from threading import Event, Lock, Thread
+import time
+
 from aspyrobot import RobotClient
+import zmq
+
+from .codes import RobotStatus
+
+
+QUERY_TIMEOUT = 5.
+HEARTBEAT_TIMEOUT = 5.
+WATCHDOG_INTERVAL = 0.5
+# Longest random delay before resyncing with a restarted server so clients
+# don't all ask for the full state at once
+RESYNC_JITTER = 1.
+
+logger = logging.getLogger(__name__)
 
 
 class RobotClientMX(RobotClient):
@@ -7,6 +25,18 @@ class RobotClientMX(RobotClient):
     methods specific to the MX application. These include operation methods to
     calibrate, probe and mount samples.
 
+    If ``query_addr`` is given, query operations, including the ``refresh`` made
+    by ``setup``, are sent to the server's query lane at that address instead of
+    the request socket, so they don't wait behind other requests.
+
+    After ``setup`` a watchdog thread follows the server heartbeats. If none
+    arrive for ``heartbeat_timeout`` seconds the client is marked disconnected
+    and the callbacks of operations in progress are called with an error. When
+    heartbeats resume, or show that updates were missed, the client catches up
+    with a ``changes_since`` query, which only returns the full state if the
+    server has restarted. The watchdog sends it on a socket of its own, so it
+    doesn't share the request socket with the thread using the client.
+
     Attributes:
         current_task (str): Current task being executed on the robot
         task_message (str): Messages about current foreground task
@@ -58,18 +88,287 @@ class RobotClientMX(RobotClient):
         port_distance (dict):
             * keys (str): `'left'`, `'middle'`, `'right'`
             * values (list): 96 element list of `float` values
+        port_anomalies (dict):
+            * keys (str): `'left'`, `'middle'`, `'right'`
+            * values (list): 96 element list of `bool` values, True for full
+              ports whose probed distance is unusual for their puck
         sample_locations (dict):
             * keys (str): `'cavity'`, `'picker`', `'placer'`, `'goniometer'`
             * values (list): `[position, port_index]` of sample at location
         mount_message (str): Mount progress message
+        ready (bool): Whether the server has received all data from the robot
+        startup_timings (dict): Seconds from server start to each startup phase
+        operation_eta (dict): `handle`, `operation`, expected duration in seconds
+            (`eta`, None if unknown) and `started` time of the running operation
+            on the server clock, or None when no timed operation is running
+        maintenance (dict): `task`, `operation` and `handle` of the idle-time
+            maintenance step that is running, or None
+        status_flags (tuple): Names of the codes.RobotStatus flags that are set
+        status_changes (list): `{'flag': name, 'set': bool}` for the flags that
+            changed in the last status update
+        server_id (str): Identifier of the server process the state is from
+        state_version (int): Version of the server state the client is up to
+        heartbeat (dict): `server_id`, `state_version` and `time` of the last
+            server heartbeat. The time is on the server clock, so the time an
+            operation has been running is `time` minus its `started` time
+        connected (bool): Whether server heartbeats are being received
+        updates_dropped (dict): `since`, the state version to resync from, when
+            the server's publish queue dropped updates. The client resyncs.
 
     """
+    def __init__(self, *args, query_addr=None, query_timeout=QUERY_TIMEOUT,
+                 heartbeat_timeout=HEARTBEAT_TIMEOUT, **kwargs):
+        self._status_changes = []
+        self._status_flag_callbacks = {}
+        self.query_addr = query_addr
+        self.query_timeout = query_timeout
+        # REQ sockets by lane: 'query' for query() and 'resync' for the watchdog
+        self._sockets = {}
+        self._socket_locks = {'query': Lock(), 'resync': Lock()}
+        self.heartbeat_timeout = heartbeat_timeout
+        self.connected = False
+        self.server_id = None
+        self.state_version = None
+        self._heartbeat = None
+        self._last_heartbeat = None
+        self._updates_dropped = None
+        self._resync_from = None
+        self._pending_operations = {}
+        self._pending_lock = Lock()
+        self._watchdog = None
+        self._watchdog_stop = Event()
+        self._request_addr = kwargs.get('request_addr',
+                                        args[1] if len(args) > 1 else None)
+        super().__init__(*args, **kwargs)
+
+    def setup(self):
+        super().setup()
+        if self.heartbeat_timeout and self._watchdog is None:
+            self._watchdog = Thread(target=self._watch_connection, daemon=True)
+            self._watchdog.start()
+
+    def close(self):
+        """Stop watching the connection and close the request sockets.
+
+        The update socket of ``aspyrobot.RobotClient`` stays open, as it belongs
+        to the thread receiving the updates and zmq sockets can't be closed
+        from another thread. Don't use the client after closing it.
+
+        """
+        self._watchdog_stop.set()
+        for lane in self._socket_locks:
+            self._reset_socket(lane)
+        request_socket = getattr(self, 'request_socket', None)
+        if request_socket is not None:
+            request_socket.close(linger=0)
+
+    def refresh(self):
+        """Update the attributes with the whole state of the server.
+
+        Uses the query lane if there is one.
+
+        """
+        if self.query_addr is None:
+            return super().refresh()
+        response = self.query('refresh')
+        if response.get('error'):
+            raise RuntimeError(f'refresh failed: {response["error"]}')
+        for attr, value in response['data'].items():
+            setattr(self, attr, value)
+        return response
+
+    def run_operation(self, operation, callback=None, **parameters):
+        """Run an operation on the server.
+
+        If the connection to the server is lost before the operation ends, the
+        callback is called with stage `'end'` and an error.
+
+        """
+        if callback is None:
+            return super().run_operation(operation, **parameters)
+        key = object()
+
+        def tracked_callback(*args, **kwargs):
+            stage = kwargs['stage'] if 'stage' in kwargs else args[1]
+            with self._pending_lock:
+                if key not in self._pending_operations:
+                    # Already ended, or reported lost with the connection
+                    return
+                if stage == 'end':
+                    del self._pending_operations[key]
+            callback(*args, **kwargs)
+
+        with self._pending_lock:
+            self._pending_operations[key] = [None, callback]
+        try:
+            response = super().run_operation(operation, callback=tracked_callback,
+                                             **parameters)
+        except Exception:
+            with self._pending_lock:
+                self._pending_operations.pop(key, None)
+            raise
+        with self._pending_lock:
+            if not isinstance(response, dict) or response.get('error'):
+                self._pending_operations.pop(key, None)
+            elif key in self._pending_operations:
+                self._pending_operations[key][0] = response.get('handle')
+        return response
+
+    @property
+    def heartbeat(self):
+        return self._heartbeat
+
+    @heartbeat.setter
+    def heartbeat(self, heartbeat):
+        self._heartbeat = heartbeat
+        self._last_heartbeat = time.monotonic()
+
+    @property
+    def updates_dropped(self):
+        return self._updates_dropped
+
+    @updates_dropped.setter
+    def updates_dropped(self, updates_dropped):
+        self._updates_dropped = updates_dropped
+        # The watchdog resyncs from before the dropped updates
+        since = updates_dropped['since']
+        if self._resync_from is None or since < self._resync_from:
+            self._resync_from = since
+
+    def resync(self, version=None):
+        """Catch up with the server state with the smallest request possible.
+
+        Args:
+            version (int): State version to catch up from. Defaults to the
+                version the client is up to.
+
+        """
+        if version is None:
+            version = self.state_version or 0
+        # Not sent with query() as the watchdog mustn't share the user's request socket
+        addr = self.query_addr or self._request_addr
+        response = self._request('resync', addr, 'changes_since', version=version,
+                                 server_id=self.server_id)
+        if response.get('error'):
+            raise RuntimeError(f'resync failed: {response["error"]}')
+        self.server_id = response['data']['server_id']
+        for attr, value in response['data']['values'].items():
+            setattr(self, attr, value)
+        logger.info('resynced to version %s of server %s (full state: %s)',
+                    self.state_version, self.server_id, response['data']['full'])
+
+    def _watch_connection(self):
+        while not self._watchdog_stop.wait(WATCHDOG_INTERVAL):
+            try:
+                self._check_connection()
+            except Exception:
+                logger.exception('connection check failed')
+
+    def _check_connection(self):
+        heartbeat, last_heartbeat = self._heartbeat, self._last_heartbeat
+        if last_heartbeat is None \
+                or time.monotonic() - last_heartbeat > self.heartbeat_timeout:
+            if self.connected:
+                logger.warning('no heartbeat from server for %ss', self.heartbeat_timeout)
+                self.connected = False
+                self._fail_pending_operations('lost connection to server')
+                # Requests sent before the loss may never be answered
+                for lane in self._socket_locks:
+                    self._reset_socket(lane)
+            return
+        resync = not self.connected
+        self.connected = True
+        if heartbeat['server_id'] != self.server_id:
+            logger.warning('server restarted')
+            self._fail_pending_operations('server restarted')
+            time.sleep(random.uniform(0, RESYNC_JITTER))
+            resync = True
+        elif heartbeat['state_version'] > (self.state_version or 0):
+            resync = True
+        resync_from, self._resync_from = self._resync_from, None
+        if resync_from is not None:
+            self.resync(min(resync_from, self.state_version or 0))
+        elif resync:
+            self.resync()
+
+    def _fail_pending_operations(self, error):
+        with self._pending_lock:
+            pending = list(self._pending_operations.values())
+            self._pending_operations.clear()
+        for handle, callback in pending:
+            callback(handle=handle, stage='end', message=None, error=error)
+
+    def query(self, operation, **parameters):
+        """Run a query operation, using the query lane if there is one.
+
+        Raises:
+            TimeoutError: If the query lane doesn't reply within ``query_timeout``
+
+        """
+        if self.query_addr is None:
+            return self.run_operation(operation, **parameters)
+        return self._request('query', self.query_addr, operation, **parameters)
+
+    def _request(self, lane, addr, operation, **parameters):
+        with self._socket_locks[lane]:
+            socket = self._sockets.get(lane)
+            if socket is None:
+                socket = self._sockets[lane] = zmq.Context.instance().socket(zmq.REQ)
+                socket.connect(addr)
+            socket.send_json({'operation': operation, 'parameters': parameters})
+            if not socket.poll(self.query_timeout * 1000):
+                # A REQ socket can't send again until it gets a reply so replace it
+                del self._sockets[lane]
+                socket.close(linger=0)
+                raise TimeoutError(f'no reply to {operation} from {addr}')
+            return socket.recv_json()
+
+    def _reset_socket(self, lane):
+        with self._socket_locks[lane]:
+            socket = self._sockets.pop(lane, None)
+        if socket is not None:
+            socket.close(linger=0)
+
+    @property
+    def status_changes(self):
+        return self._status_changes
+
+    @status_changes.setter
+    def status_changes(self, changes):
+        self._status_changes = changes
+        for change in changes:
+            for callback in self._status_flag_callbacks.get(change['flag'], []):
+                callback(change['flag'], change['set'])
+
+    def add_status_flag_callback(self, flag, callback):
+        """Register a callback for changes of a single robot status flag.
+
+        Args:
+            flag: codes.RobotStatus flag or its name, eg 'reason_port_jam'
+            callback: Function called with the flag name and whether it is set
+
+        """
+        name = RobotStatus[flag].name if isinstance(flag, str) else RobotStatus(flag).name
+        self._status_flag_callbacks.setdefault(name, []).append(callback)
+
     def probe(self, ports, callback=None):
         """Probe the sample holder ports.
 
+        Ports can be given as a dictionary with keys: 'left', 'middle', 'right'
+        and values that are any of:
+
+        * 96 element lists of 1s and 0s by port index (see `layout.PortLayout`
+          for the port at each index)
+        * lists of pucks and ports, eg `['C', 'A 5']`
+        * bitmasks with bit `i` for port index `i`, as `'hex:<digits>'` or
+          `'base64:<big-endian bytes>'`
+
+        or as a list of pucks and ports across positions, eg `['L C', 'R A 5']`.
+        Pucks and ports of superpucks are refused until their port index map is
+        confirmed, so select those by index.
+
         Args:
-            ports: Dictionary with keys: 'left', 'middle', 'right' and values
-                that are 98 element lists of 1s and 0s
+            ports: Ports to probe
             callback: Callback function to receive operation state updates
 
         """
@@ -169,25 +468,25 @@ class RobotClientMX(RobotClient):
         """Clear the probe data for specific ports.
 
         Args:
-            ports: dictionary with keys: 'left', 'middle', 'right' and values
-                the ports to reset in each position
+            ports: Ports to reset in any of the forms accepted by `probe`
             callback: Callback function to receive operation state updates
 
         """
         return self.run_operation('reset_ports', ports=ports, callback=callback)
 
-    def mount(self, position, column, port_num, callback=None):
+    def mount(self, position, column, port_num, force=False, callback=None):
         """Mount a sample.
 
         Args:
             position: 'left', 'middle', 'right'
             column: 'A', 'B', ..., 'L'
             port_num: 1-16
+            force: Mount even if the port fails the preflight checks (staff only)
             callback: Callback function to receive operation state updates
 
         """
         return self.run_operation('mount', position=position, column=column,
-                                  port_num=port_num, callback=callback)
+                                  port_num=port_num, force=force, callback=callback)
 
     def dismount(self, callback=None):
         """Dismount a sample.
@@ -208,18 +507,19 @@ class RobotClientMX(RobotClient):
         """
         return self.run_operation("park_robot", dismount=dismount, callback=callback)
 
-    def prefetch(self, position, column, port_num, callback=None):
+    def prefetch(self, position, column, port_num, force=False, callback=None):
         """Prefetch a sample.
 
         Args:
             position: 'left', 'middle', 'right'
             column: 'A', 'B', ..., 'L'
             port_num: 1-16
+            force: Prefetch even if the port fails the preflight checks (staff only)
             callback: Callback function to receive operation state updates
 
         """
         return self.run_operation('prefetch', position=position, column=column,
-                                  port_num=port_num, callback=callback)
+                                  port_num=port_num, force=force, callback=callback)
 
     def return_prefetch(self, callback=None):
         """Return a prefetched sample to it's port.
@@ -232,7 +532,7 @@ class RobotClientMX(RobotClient):
 
     def mount_and_prefetch(self, position, column, port_num,
                            prefetch_position, prefetch_column, prefetch_port_num,
-                           callback=None):
+                           force=False, callback=None):
         """Mount a sample and prefetch another sample.
 
         Args:
@@ -242,6 +542,7 @@ class RobotClientMX(RobotClient):
             prefetch_position: 'left', 'middle', 'right'
             prefetch_column: 'A', 'B', ..., 'L'
             prefetch_port_num: 1-16
+            force: Mount even if the ports fail the preflight checks (staff only)
             callback: Callback function to receive operation state updates
 
         """
@@ -250,7 +551,28 @@ class RobotClientMX(RobotClient):
                                   prefetch_position=prefetch_position,
                                   prefetch_column=prefetch_column,
                                   prefetch_port_num=prefetch_port_num,
-                                  callback=callback)
+                                  force=force, callback=callback)
+
+    def dismount_and_prefetch(self, prefetch_position, prefetch_column,
+                              prefetch_port_num, force=False, callback=None):
+        """Dismount a sample and prefetch another sample.
+
+        The prefetch is done as the robot returns the placer after the dismount
+        so it doesn't need a separate `prefetch` call.
+
+        Args:
+            prefetch_position: 'left', 'middle', 'right'
+            prefetch_column: 'A', 'B', ..., 'L'
+            prefetch_port_num: 1-16
+            force: Prefetch even if the port fails the preflight checks (staff only)
+            callback: Callback function to receive operation state updates
+
+        """
+        return self.run_operation('dismount_and_prefetch',
+                                  prefetch_position=prefetch_position,
+                                  prefetch_column=prefetch_column,
+                                  prefetch_port_num=prefetch_port_num,
+                                  force=force, callback=callback)
 
     def set_port_state(self, position, column, port_num, state, callback=None):
         """Set the state of port to be unknown, error etc.
@@ -275,3 +597,90 @@ class RobotClientMX(RobotClient):
 
         """
         return self.run_operation('inspected', callback=callback)
+
+    def ports_in_state(self, state, position=None):
+        """Query the ports that are in a given state.
+
+        Args:
+            state: `codes.PortState` name (eg 'full') or value
+            position: 'left', 'middle', 'right' or None for all positions
+
+        Returns:
+            Response with `data` as a list of port codes (eg `'L A 1'`)
+
+        """
+        return self.query('ports_in_state', state=state, position=position)
+
+    def puck_summary(self, position, puck):
+        """Query the state of a puck and the number of its ports in each state.
+
+        Args:
+            position: 'left', 'middle', 'right'
+            puck: 'A', 'B', ... (columns of cassettes). Superpucks are refused
+                until their port index map is confirmed.
+
+        Returns:
+            Response with `data` as a dict with keys `'state'` (codes.PuckState)
+            and `'counts'` (dict of `codes.PortState` names to counts)
+
+        """
+        return self.query('puck_summary', position=position, puck=puck)
+
+    def next_port(self, after, state='full'):
+        """Query the next port in a state after a given port.
+
+        Args:
+            after: port code, eg 'L A 5'
+            state: `codes.PortState` name (eg 'full') or value
+
+        Returns:
+            Response with `data` as the port code or None if there are no more
+
+        """
+        return self.query('next_port', after=after, state=state)
+
+    def start_profiling(self, duration, path=None, callback=None):
+        """Profile all the server threads by sampling their stacks.
+
+        The profile is written as folded stacks for flame graph tools.
+
+        Args:
+            duration: Seconds to profile for or None to profile until stopped
+            path: Name of the file to write to in the profile directory of the
+                server. Defaults to a new file.
+            callback: Callback function to receive operation state updates
+
+        """
+        return self.run_operation('start_profiling', duration=duration, path=path,
+                                  callback=callback)
+
+    def stop_profiling(self, callback=None):
+        """Stop profiling the server and write the profile.
+
+        Args:
+            callback: Callback function to receive operation state updates
+
+        """
+        return self.run_operation('stop_profiling', callback=callback)
+
+    def memory_snapshot(self, limit=10, callback=None):
+        """Summarise the largest memory allocations of the server.
+
+        The first call starts tracing allocations so later calls have data.
+
+        Args:
+            limit: Number of allocation sites to include
+            callback: Callback function to receive operation state updates
+
+        """
+        return self.run_operation('memory_snapshot', limit=limit, callback=callback)
+
+    def metrics(self):
+        """Query the server's publish queue, caching and request latency metrics.
+
+        Returns:
+            Response with `data` as a dict with keys `'publish_queue'`,
+            `'encoding'`, `'refresh'`, `'maintenance'` and `'lanes'`
+
+        """
+        return self.query('metrics')
@@ -1,31 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 import json
+import time
+import tracemalloc
+import logging
 import logging.config
 
 import click
-from epics import poll
 
-from . import RobotMX, RobotServerMX
-from .make_safe import MakeSafe, DummyMakeSafe
+from .loadtest import DEFAULT_MIX, parse_mix, run_load_test
+from .logs import limit_log_rate, start_queue_logging
+from .profiling import profiler
+from .relay import UpdateRelay
 
 
 @click.command()
 @click.option('--config', type=click.Path(exists=True))
 @click.option('--update-address', default='tcp://*:2000')
 @click.option('--request-address', default='tcp://*:2001')
+@click.option('--query-address', help='Address of a separate socket for queries')
 @click.option('--make-safe-url', default='http://127.0.0.1:6000')
 @click.option('--disable-makesafe', is_flag=True, default=False)
-@click.argument('robot-name')
-def run_server(config, update_address, request_address, robot_name, make_safe_url, disable_makesafe):
-    if config:
-        with open(config) as file:
-            config = json.load(file)
-        if 'logging' in config:
-            logging.config.dictConfig(config['logging'])
-    robot = RobotMX(robot_name + ':')
-    make_safe = DummyMakeSafe() if disable_makesafe else MakeSafe(make_safe_url)
-    server = RobotServerMX(robot, make_safe=make_safe,
-                           update_addr=update_address,
-                           request_addr=request_address)
-    server.setup()
+@click.option('--publish-queue-size', type=int, default=1000)
+@click.option('--publish-overflow', default='coalesce',
+              type=click.Choice(['coalesce', 'drop_oldest', 'drop_newest']))
+@click.option('--queue-logging', is_flag=True, default=False,
+              help='Write logs from a background thread')
+@click.option('--log-rate-limit', type=float,
+              help='Records per second allowed from each logging call site')
+@click.option('--log-burst', type=int, default=5)
+@click.option('--profile', type=float,
+              help='Profile the server for this many seconds from startup')
+@click.option('--profile-output', type=click.Path(),
+              help='File to write the folded stack profile to')
+@click.option('--profile-dir', type=click.Path(file_okay=False),
+              help='Directory that clients can write profiles to')
+@click.option('--tracemalloc', 'tracemalloc_frames', type=int,
+              help='Trace memory allocations, keeping this many frames')
+@click.option('--duration-store', type=click.Path(),
+              help='File of operation durations used to estimate ETAs')
+@click.option('--state-file', type=click.Path(),
+              help='Memory mapped file to share the state with local processes')
+@click.option('--refresh-ttl', type=float,
+              help='Seconds a refresh is reused for while the state is unchanged')
+@click.option('--http-address', help='host:port to serve the state over HTTP on')
+@click.argument('robot-name', required=False)
+def run_server(config, update_address, request_address, query_address, robot_name,
+               make_safe_url, disable_makesafe, publish_queue_size, publish_overflow,
+               queue_logging, log_rate_limit, log_burst, profile, profile_output,
+               profile_dir, tracemalloc_frames, duration_store, state_file, refresh_ttl,
+               http_address):
+    """Run a server for ROBOT_NAME or for every robot in the config "robots" list."""
+    # Server dependencies are imported in the server functions so the relay
+    # command works with a client-only install
+    from epics import poll
+    config = load_config(config)
+    if tracemalloc_frames:
+        tracemalloc.start(tracemalloc_frames)
+    if profile:
+        path = profiler.start(duration=profile, path=profile_output)
+        logging.getLogger(__name__).info('profiling for %ss to %s', profile, path)
+    if queue_logging:
+        for listener in start_queue_logging(rate=log_rate_limit, burst=log_burst):
+            atexit.register(listener.stop)
+    elif log_rate_limit:
+        limit_log_rate(log_rate_limit, burst=log_burst)
+    if robot_name:
+        robots = [{
+            'name': robot_name,
+            'update_address': update_address,
+            'request_address': request_address,
+            'query_address': query_address,
+            'make_safe_url': make_safe_url,
+            'disable_makesafe': disable_makesafe,
+            'publish_queue_size': publish_queue_size,
+            'publish_overflow': publish_overflow,
+            'duration_store': duration_store,
+            'state_file': state_file,
+            'refresh_ttl': refresh_ttl,
+            'http_address': http_address,
+            'profile_dir': profile_dir,
+        }]
+    else:
+        robots = config.get('robots')
+    if not robots:
+        raise click.UsageError('give a ROBOT_NAME or a config with a "robots" list')
+    executor = ThreadPoolExecutor(max_workers=2 * len(robots))
+    servers = [make_server(robot_config, executor, multiple=len(robots) > 1)
+               for robot_config in robots]
+    for server, robot_config in zip(servers, robots):
+        server.setup()
+        if robot_config.get('http_address'):
+            start_gateway(server, robot_config['http_address'])
     while True:
         poll(1e-2)
+
+
+def load_config(path):
+    """Load the JSON config file at ``path`` and configure logging from it."""
+    if not path:
+        return {}
+    with open(path) as file:
+        config = json.load(file)
+    if 'logging' in config:
+        logging.config.dictConfig(config['logging'])
+    return config
+
+
+def make_server(robot_config, executor, *, multiple=False):
+    """Create a RobotServerMX from a "robots" entry of the config file.
+
+    Entries need a ``name`` (the robot PV prefix without the colon) and may set
+    ``update_address``, ``request_address``, ``query_address``, ``make_safe_url``,
+    ``disable_makesafe``, ``publish_queue_size``, ``publish_overflow``,
+    ``duration_store``, ``state_file``, ``refresh_ttl``, ``http_address``,
+    ``profile_dir``, ``maintenance_idle`` and ``maintenance``, a list of tasks
+    with the fields of ``maintenance.MaintenanceTask``. When hosting multiple
+    robots each server logs to a logger named after its robot.
+
+    """
+    # Startup is timed from here so creating the robot PVs is included
+    started = time.monotonic()
+    from .robot import RobotMX
+    from .server import RobotServerMX
+    from .make_safe import MakeSafe, DummyMakeSafe
+    from .eta import DurationHistory
+    from .maintenance import MaintenanceTask
+    name = robot_config['name']
+    robot = RobotMX(name + ':')
+    if robot_config.get('disable_makesafe', False):
+        make_safe = DummyMakeSafe()
+    else:
+        make_safe = MakeSafe(robot_config.get('make_safe_url', 'http://127.0.0.1:6000'))
+    kwargs = {key: robot_config[key]
+              for key in ['publish_queue_size', 'publish_overflow', 'state_file',
+                          'refresh_ttl', 'maintenance_idle', 'profile_dir']
+              if robot_config.get(key) is not None}
+    if robot_config.get('duration_store'):
+        kwargs['duration_history'] = DurationHistory(robot_config['duration_store'])
+    if robot_config.get('maintenance'):
+        kwargs['maintenance_tasks'] = [MaintenanceTask.from_config(task)
+                                       for task in robot_config['maintenance']]
+    if multiple:
+        kwargs['logger'] = logging.getLogger(f'aspyrobotmx.{name}')
+    return RobotServerMX(robot, make_safe=make_safe, executor=executor, started=started,
+                         update_addr=robot_config.get('update_address', 'tcp://*:2000'),
+                         request_addr=robot_config.get('request_address',
+                                                       'tcp://*:2001'),
+                         query_addr=robot_config.get('query_address'),
+                         **kwargs)
+
+
+def start_gateway(server, address):
+    """Serve the state of ``server`` over HTTP on a ``host:port`` address."""
+    from .gateway import StateGateway
+    host, _, port = address.rpartition(':')
+    gateway = StateGateway(server, (host, int(port)),
+                           encode=server.encoded_values.encode, logger=server.logger)
+    gateway.start()
+    return gateway
+
+
+@click.command()
+@click.option('--config', type=click.Path(exists=True))
+@click.option('--update-address', default='tcp://*:2100')
+@click.option('--request-address', default='tcp://*:2101',
+              help='Address to serve the cached state on')
+@click.argument('server-update-address')
+@click.argument('server-request-address')
+def run_relay(config, update_address, request_address, server_update_address,
+              server_request_address):
+    """Re-publish the updates of the server at SERVER_UPDATE_ADDRESS."""
+    load_config(config)
+    relay = UpdateRelay(server_update_address, server_request_address, update_address,
+                        request_address)
+    relay.run()
+
+
+@click.command()
+@click.option('--clients', type=int, default=10)
+@click.option('--requests', type=int, default=100, help='Requests per client')
+@click.option('--mix', default=','.join(f'{op}={weight}' for op, weight
+                                        in DEFAULT_MIX.items()),
+              help='Weights of the operations, eg refresh=10,set_lid=1,mount=1')
+@click.option('--mount-port', default='L A 1', help='Port to mount from in mock mounts')
+@click.option('--query-address')
+@click.option('--seed', type=int)
+@click.argument('update-address')
+@click.argument('request-address')
+def run_loadtest(clients, requests, mix, mount_port, query_address, seed,
+                 update_address, request_address):
+    """Load test the server at UPDATE_ADDRESS and REQUEST_ADDRESS.
+
+    Only mount against a server connected to a simulated robot.
+    """
+    try:
+        mix = parse_mix(mix)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint='--mix')
+    report = run_load_test(update_address, request_address, clients=clients,
+                           requests=requests, mix=mix, mount_port=mount_port,
+                           query_addr=query_address, seed=seed)
+    click.echo(json.dumps(report, indent=2))
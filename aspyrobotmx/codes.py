@@ -91,3 +91,81 @@ class RobotStatus(IntEnum):
     in_calibration = 0x20000000
     in_tool = 0x40000000
     in_manual = 0x80000000
+
+
+# Lookup tables for decoding RobotStatus words a byte at a time. Each table maps
+# a byte value to the names of the single bit flags set in it, grouped by the
+# need, reason and in prefixes.
+STATUS_GROUPS = ('need', 'reason', 'in')
+
+
+def _status_tables():
+    # Built from plain ints and strings as enum lookups in the loops make
+    # importing the module slow
+    bits = {}
+    for flag in RobotStatus:
+        value, name = flag.value, flag.name
+        if bin(value).count('1') != 1:
+            continue
+        for group_number, group in enumerate(STATUS_GROUPS):
+            if name.startswith(group + '_'):
+                bits[value] = (group_number, name)
+    tables = []
+    for shift in (0, 8, 16, 24):
+        table = []
+        for byte in range(256):
+            groups = ([], [], [])
+            for bit in range(8):
+                flag = bits.get((byte >> bit & 1) << bit << shift)
+                if flag is not None:
+                    groups[flag[0]].append(flag[1])
+            table.append(tuple(tuple(names) for names in groups))
+        tables.append(table)
+    return tables
+
+
+_STATUS_TABLES = _status_tables()
+
+
+def decode_status(status):
+    """Decode a robot status word into the names of the flags that are set.
+
+    Args:
+        status (int): Bitwise or of ``RobotStatus`` flags
+
+    Returns:
+        dict: ``'need'``, ``'reason'`` and ``'in'`` to tuples of flag names
+
+    """
+    status = int(status)
+    groups = ([], [], [])
+    for shift, table in zip((0, 8, 16, 24), _STATUS_TABLES):
+        for names, group_names in zip(groups, table[(status >> shift) & 0xff]):
+            names.extend(group_names)
+    return {group: tuple(names) for group, names in zip(STATUS_GROUPS, groups)}
+
+
+def status_flags(status):
+    """Return the names of the ``RobotStatus`` flags set in a status word."""
+    status = int(status)
+    return tuple(name
+                 for shift, table in zip((0, 8, 16, 24), _STATUS_TABLES)
+                 for group_names in table[(status >> shift) & 0xff]
+                 for name in group_names)
+
+
+# Keys of values updates that report events rather than state, so they are
+# left out when updates are replayed or merged into a cached state
+EVENT_KEYS = ('status_changes', 'heartbeat', 'updates_dropped')
+
+
+def status_changes(old, new):
+    """Return the flags that differ between two status words.
+
+    Returns:
+        list: ``{'flag': name, 'set': bool}`` for each changed flag
+
+    """
+    new = int(new)
+    return [{'flag': name, 'set': bool(new & RobotStatus[name])}
+            for name in status_flags(int(old) ^ new)]
@@ -0,0 +1,125 @@
+import json
+import logging
+from threading import Event, Lock, Thread
+
+
+class EncodedValueCache:
+    """
+    Cache of the JSON encoding of state values so large tables such as the
+    port states are encoded once per change rather than once per reply.
+
+    Values are invalidated with the updates that change them. If ``start`` has
+    been called a worker thread encodes the new values straight away, off the
+    thread that made the update, otherwise they are encoded when next used. A
+    cached encoding is only used for the same object that was in the update,
+    so values must not be changed in place without an update.
+
+    """
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        self._generations = {}
+        self._encoded = {}
+        self._pending = {}
+        self._lock = Lock()
+        self._work = Event()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        """Start encoding updated values in a worker thread if it isn't already."""
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='EncodedValueCache',
+                                  daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._work.set()
+
+    def invalidate(self, update):
+        """Record new values from a values update."""
+        with self._lock:
+            for key, value in update.items():
+                generation = self._generations.get(key, 0) + 1
+                self._generations[key] = generation
+                self._pending[key] = (generation, value)
+        self._work.set()
+
+    def encode(self, values):
+        """Return ``values`` encoded as JSON bytes, using cached encodings.
+
+        Dicts are encoded key by key so the values of nested dicts, such as the
+        ``data`` of a query reply, can come from the cache too.
+
+        """
+        if not isinstance(values, dict):
+            return json.dumps(values).encode()
+        parts = []
+        for key, value in values.items():
+            parts.append(json.dumps(str(key)).encode() + b': ' + self._value(key, value))
+        return b'{' + b', '.join(parts) + b'}'
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'cached': len(self._encoded)}
+
+    def _value(self, key, value):
+        with self._lock:
+            generation = self._generations.get(key)
+            entry = self._encoded.get(key)
+            if generation is not None:
+                if entry is not None and entry[0] == generation and entry[1] is value:
+                    self.hits += 1
+                    return entry[2]
+                self.misses += 1
+        if isinstance(value, dict):
+            encoded = self.encode(value)
+        else:
+            encoded = json.dumps(value).encode()
+        if generation is not None:
+            self._store(key, generation, value, encoded)
+        return encoded
+
+    def _store(self, key, generation, value, encoded):
+        with self._lock:
+            if self._generations.get(key) == generation:
+                self._encoded[key] = (generation, value, encoded)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._work.wait()
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._work.clear()
+            for key, (generation, value) in pending.items():
+                try:
+                    encoded = json.dumps(value).encode()
+                except (TypeError, ValueError):
+                    self.logger.exception('could not encode %s', key)
+                    continue
+                self._store(key, generation, value, encoded)
+
+
+class EncodingSocket:
+    """
+    Wraps a zmq socket so ``send_json`` sends the bytes made by ``encode``,
+    for sockets whose messages are sent by code outside this package.
+    Everything else is passed to the socket.
+
+    Args:
+        socket: zmq socket to wrap.
+        encode: Function returning the JSON bytes of a message.
+
+    """
+    def __init__(self, socket, encode):
+        self.socket = socket
+        self.encode = encode
+
+    def send_json(self, obj, flags=0, **kwargs):
+        return self.socket.send(self.encode(obj), flags)
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
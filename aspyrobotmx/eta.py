@@ -0,0 +1,100 @@
+from collections import defaultdict, deque
+import json
+import os
+from statistics import median
+from threading import Lock
+import time
+
+
+class DurationHistory:
+    """
+    History of how long operations took, used to estimate how long the next one
+    will take.
+
+    Durations are grouped by the operation and its features (eg position or
+    holder type). Estimates are the median duration of the most specific group
+    with at least ``min_samples`` durations, dropping features from the most
+    specific until one is found.
+
+    Args:
+        path (str): JSON lines file to load the history from and append new
+            durations to. The history is only kept in memory if None. The file
+            is compacted when loaded so it only keeps the durations in use.
+        max_samples (int): Number of recent durations to keep in each group.
+        min_samples (int): Durations needed before a group is used.
+
+    """
+    def __init__(self, path=None, max_samples=50, min_samples=3):
+        self.path = path
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self._durations = defaultdict(lambda: deque(maxlen=max_samples))
+        self._lock = Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    def record(self, operation, duration, **features):
+        """Record the duration of an operation.
+
+        Features should be given from the least to the most specific.
+
+        """
+        record = {'operation': operation, 'duration': duration, 'time': time.time(),
+                  'features': features}
+        with self._lock:
+            self._add(operation, duration, features)
+            if self.path:
+                with open(self.path, 'a') as file:
+                    file.write(json.dumps(record) + '\n')
+
+    def estimate(self, operation, **features):
+        """Return the expected duration in seconds or None if there's no history.
+
+        Features should be given in the same order as when recorded.
+
+        """
+        with self._lock:
+            keys = _keys(operation, features)
+            for key in keys:
+                durations = self._durations.get(key)
+                if durations and len(durations) >= self.min_samples:
+                    return median(durations)
+            durations = self._durations.get(keys[-1])
+            return median(durations) if durations else None
+
+    def _add(self, operation, duration, features):
+        for key in _keys(operation, features):
+            self._durations[key].append(duration)
+
+    def _load(self):
+        records, lines = [], 0
+        with open(self.path) as file:
+            for line in file:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                    self._add(record['operation'], record['duration'],
+                              record['features'])
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    continue
+                records.append(record)
+        # Durations pushed out of their most specific group are out of every
+        # group, so only the recent ones of each most specific group are kept
+        recent = defaultdict(lambda: deque(maxlen=self.max_samples))
+        for record in records:
+            recent[_keys(record['operation'], record['features'])[0]].append(record)
+        kept = {id(record) for group in recent.values() for record in group}
+        if len(kept) < lines:
+            self._compact([record for record in records if id(record) in kept])
+
+    def _compact(self, records):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+        os.replace(temp_path, self.path)
+
+
+def _keys(operation, features):
+    items = tuple(features.items())
+    return [(operation,) + items[:count] for count in range(len(items), -1, -1)]
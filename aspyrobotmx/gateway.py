@@ -0,0 +1,178 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import re
+from socketserver import ThreadingMixIn
+from threading import Event, Thread
+
+
+# State keys served by each resource. The state resource serves everything.
+RESOURCES = {
+    'ports': ['holder_types', 'port_states', 'port_distances', 'port_anomalies'],
+    'pucks': ['holder_types', 'puck_states'],
+    'status': [
+        'status', 'status_flags', 'ready', 'current_task', 'task_message',
+        'task_progress', 'foreground_done', 'at_home', 'motors_on', 'motors_locked',
+        'safety_gate', 'lid_open', 'lid_closed', 'gripper_open', 'gripper_closed',
+        'heater_hot', 'ln2_level', 'dumbbell_state', 'mount_message', 'operation_eta',
+    ],
+    'samples': [
+        'sample_locations', 'picker_sample', 'placer_sample', 'cavity_sample',
+        'goniometer_sample', 'pins_mounted', 'pins_lost',
+    ],
+}
+# Seconds between comments sent to keep idle event streams open
+KEEPALIVE_INTERVAL = 15.
+# Entity tags of an If-None-Match header (RFC 7232), or its ``*``
+ENTITY_TAG = re.compile(r'[\s,]*(?:(\*)|(?:W/)?("[^"]*"))\s*(?:,|$)')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StateGateway:
+    """
+    Serves the state of a ``RobotServerMX`` over HTTP for dashboards, without
+    going through the ZMQ request socket.
+
+    ``GET /<resource>`` returns the JSON values of a resource in `RESOURCES`
+    or ``/state`` for everything. Responses have an ETag made of the server id
+    and the state version at which the resource last changed, and requests
+    with a matching ``If-None-Match`` get a 304 without the state being read.
+    ``GET /events`` is a server-sent event stream of the values that change.
+
+    Args:
+        source: The ``RobotServerMX`` to serve, or any object with its
+            ``server_id``, ``state_version``, ``state_snapshot``,
+            ``state_changes``, ``key_version`` and ``wait_for_change``.
+        address (tuple): ``(host, port)`` to listen on.
+        encode: Function encoding a dict of values as JSON bytes.
+
+    """
+    def __init__(self, source, address, *, encode=None, logger=None):
+        self.source = source
+        self.address = address
+        self.encode = encode or (lambda values: json.dumps(values).encode())
+        self.logger = logger or logging.getLogger(__name__)
+        self.shutdown_requested = Event()
+        self._httpd = None
+
+    def start(self):
+        """Start serving in a background thread and return the bound address."""
+        class Handler(_StateRequestHandler):
+            gateway = self
+
+        self._httpd = _ThreadingHTTPServer(self.address, Handler)
+        Thread(target=self._httpd.serve_forever, name='StateGateway',
+               daemon=True).start()
+        self.logger.info('serving state over HTTP on %s:%s',
+                         *self._httpd.server_address[:2])
+        return self._httpd.server_address
+
+    def shutdown(self):
+        self.shutdown_requested.set()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+    def etag(self, resource):
+        keys = RESOURCES.get(resource)
+        if keys is None:
+            version = self.source.state_version
+        else:
+            version = self.source.key_version(keys)
+        return f'"{self.source.server_id}-{version}"'
+
+    def body(self, resource):
+        state = self.source.state_snapshot()
+        keys = RESOURCES.get(resource)
+        if keys is not None:
+            state = {key: state[key] for key in keys if key in state}
+        return self.encode(state)
+
+
+class _StateRequestHandler(BaseHTTPRequestHandler):
+
+    gateway = None
+
+    def do_GET(self):
+        resource = self.path.split('?')[0].strip('/')
+        if resource == 'events':
+            self._stream_events()
+        elif resource == 'state' or resource in RESOURCES:
+            self._send_resource(resource)
+        else:
+            self.send_error(404, f'no resource {resource!r}')
+
+    def _send_resource(self, resource):
+        etag = self.gateway.etag(resource)
+        if _none_match(self.headers.get_all('If-None-Match', []), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = self.gateway.body(resource)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_events(self):
+        source = self.gateway.source
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        # Reconnecting clients continue from their last event, others start
+        # with the full state
+        server_id, _, version = self.headers.get('Last-Event-ID', '').rpartition('-')
+        try:
+            version = int(version)
+        except ValueError:
+            server_id, version = None, -1
+        try:
+            while not self.gateway.shutdown_requested.is_set():
+                if not source.wait_for_change(version, KEEPALIVE_INTERVAL):
+                    self.wfile.write(b': keepalive\n\n')
+                    self.wfile.flush()
+                    continue
+                changes = source.state_changes(version, server_id)
+                server_id = changes['server_id']
+                version = self._send_event(changes, server_id)
+        except ConnectionError:
+            pass
+
+    def _send_event(self, changes, server_id):
+        values = changes['values']
+        version = values['state_version']
+        event = 'state' if changes['full'] else 'values'
+        self.wfile.write(b'event: ' + event.encode() + b'\n'
+                         + f'id: {server_id}-{version}\n'.encode()
+                         + b'data: ' + self.gateway.encode(values) + b'\n\n')
+        self.wfile.flush()
+        return version
+
+    def log_message(self, format, *args):
+        self.gateway.logger.debug('%s %s', self.address_string(), format % args)
+
+
+def _none_match(headers, etag):
+    """Return whether If-None-Match header values match an ETag.
+
+    Uses the weak comparison of RFC 7232, so ``W/`` prefixes are ignored, and
+    ``*`` matches as the resources always exist. Tags after a malformed one
+    are ignored.
+
+    """
+    for header in headers:
+        match = ENTITY_TAG.match(header)
+        while match:
+            star, tag = match.groups()
+            if star or tag == etag:
+                return True
+            match = ENTITY_TAG.match(header, match.end())
+    return False
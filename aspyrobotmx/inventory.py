@@ -0,0 +1,127 @@
+from bisect import bisect_right, insort
+from collections import Counter
+from threading import Lock
+
+from .codes import HolderType, PortState
+from .layout import layout
+
+
+class PortInventory:
+    """
+    Index of the port states that is updated incrementally as the robot reports
+    changes. Keeps a sorted list of port indexes for each state and per-puck
+    counts of each state so queries don't need to scan the port tables.
+
+    Pucks are the 16 port pucks for superpuck adaptors and the 8 port columns
+    for all other holders.
+
+    Args:
+        positions (list[str]): Dewar positions in port ordering.
+        ports_per_position (int): Number of ports in each position.
+
+    """
+    def __init__(self, positions, ports_per_position):
+        self.positions = list(positions)
+        self.ports_per_position = ports_per_position
+        self._lock = Lock()
+        unknown = int(PortState.unknown)
+        self._states = {position: [unknown] * ports_per_position
+                        for position in self.positions}
+        self._holder_types = dict.fromkeys(self.positions, HolderType.unknown)
+        self._puck_states = {position: {} for position in self.positions}
+        self._by_state = {position: {unknown: list(range(ports_per_position))}
+                          for position in self.positions}
+        self._puck_counts = {}
+        for position in self.positions:
+            self._count_pucks(position)
+
+    def update_ports(self, position, start, values):
+        """Record new states for the ports of ``position`` from index ``start``."""
+        with self._lock:
+            states = self._states[position]
+            by_state = self._by_state[position]
+            counts = self._puck_counts[position]
+            holder_type = self._holder_types[position]
+            for index, new in enumerate(values, start):
+                new = int(new)
+                old = states[index]
+                if new == old:
+                    continue
+                states[index] = new
+                old_indexes = by_state[old]
+                del old_indexes[bisect_right(old_indexes, index) - 1]
+                insort(by_state.setdefault(new, []), index)
+                puck = layout(holder_type).puck(index)
+                if puck is not None:
+                    counts[puck][old] -= 1
+                    counts[puck][new] += 1
+
+    def set_holder_type(self, position, holder_type):
+        """Record the holder type of ``position`` and regroup its pucks."""
+        with self._lock:
+            self._holder_types[position] = HolderType(holder_type)
+            self._count_pucks(position)
+
+    def set_puck_states(self, position, puck_states):
+        """Record the puck states (dict of puck to ``PuckState``) of ``position``."""
+        with self._lock:
+            self._puck_states[position] = dict(puck_states)
+
+    def ports_in_state(self, state, position=None):
+        """Return ``(position, index)`` of every port in ``state`` in port order."""
+        positions = self.positions if position is None else [position]
+        with self._lock:
+            return [(pos, index)
+                    for pos in positions
+                    for index in self._by_state[pos].get(int(state), [])]
+
+    def puck_summary(self, position, puck):
+        """Return the puck state and the count of its ports in each state.
+
+        Raises ``ValueError`` if the index map of the holder isn't confirmed.
+
+        """
+        with self._lock:
+            layout(self._holder_types[position]).check_confirmed()
+            counts = self._puck_counts[position].get(puck)
+            if counts is None:
+                raise KeyError(f'no puck {puck} in {position}')
+            return {
+                'state': self._puck_states[position].get(puck),
+                'counts': {PortState(state).name: count
+                           for state, count in counts.items() if count},
+            }
+
+    def next_port(self, state, position, index):
+        """Return the first port in ``state`` after ``(position, index)``.
+
+        Ports are ordered by position and then index. Returns ``None`` if there
+        are no later ports in ``state``.
+
+        """
+        state = int(state)
+        with self._lock:
+            start = self.positions.index(position)
+            for pos in self.positions[start:]:
+                indexes = self._by_state[pos].get(state, [])
+                after = bisect_right(indexes, index) if pos == position else 0
+                if after < len(indexes):
+                    return pos, indexes[after]
+        return None
+
+    def port_code(self, position, index):
+        """Return the port code (eg ``'L A 1'``) of a port index or None."""
+        port = layout(self._holder_types[position]).port(position, index)
+        return None if port is None else port.code
+
+    def port_index(self, position, column, port_num):
+        """Return the index of a port in ``position``."""
+        return layout(self._holder_types[position]).index(column, port_num)
+
+    def _count_pucks(self, position):
+        states = self._states[position]
+        puck_indexes = layout(self._holder_types[position]).puck_indexes
+        self._puck_counts[position] = {
+            puck: Counter(states[index] for index in indexes)
+            for puck, indexes in puck_indexes.items()
+        }
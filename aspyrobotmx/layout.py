@@ -0,0 +1,199 @@
+import base64
+from enum import Enum
+from typing import NamedTuple
+
+from .codes import HolderType
+
+
+PORTS_PER_POSITION = 96
+COLUMNS = 'ABCDEFGHIJKL'
+PUCKS = 'ABCD'
+PORTS_PER_COLUMN = 8
+PORTS_PER_PUCK = 16
+POSITION_CODES = {'l': 'left', 'm': 'middle', 'r': 'right'}
+
+
+class Port(NamedTuple):
+
+    position: str
+    column: str
+    port_num: int
+
+    @property
+    def code(self):
+        return f'{self.position[0]} {self.column} {self.port_num}'.upper()
+
+    @classmethod
+    def from_code(cls, code):
+        pos_char, column, port_num = code.split(' ')
+        position = POSITION_CODES[pos_char.lower()]
+        return cls(position, column, int(port_num))
+
+
+class Position(Enum):
+
+    LEFT = 'left'
+    MIDDLE = 'middle'
+    RIGHT = 'right'
+
+    @property
+    def code(self):
+        return self.value[0]
+
+
+class PortLayout:
+    """
+    Tables mapping the port indexes of a holder to their puck (or cassette
+    column) and port number and back again, built once so lookups don't repeat
+    the index arithmetic.
+
+    Indexes past the last port of the holder (eg 64 to 95 of a superpuck
+    adaptor) have no location.
+
+    Until the index map of a holder is confirmed against the robot its ports
+    can only be selected by index: puck and port codes are refused, as is
+    naming the port at an index, so nothing is mounted or probed from a port
+    the map may have wrong. The pucks of the indexes are still used to group
+    the ports.
+
+    Args:
+        pucks (str): Puck names in index order.
+        ports_per_puck (int): Number of ports in each puck.
+        size (int): Number of port indexes in a position.
+        confirmed (bool): Whether the index map is confirmed.
+
+    """
+    def __init__(self, pucks, ports_per_puck, size=PORTS_PER_POSITION, confirmed=True):
+        self.pucks = pucks
+        self.ports_per_puck = ports_per_puck
+        self.size = size
+        self.confirmed = confirmed
+        locations = [(puck, port_num)
+                     for puck in pucks
+                     for port_num in range(1, ports_per_puck + 1)]
+        self._locations = tuple(locations + [None] * (size - len(locations)))
+        self._indexes = {location: index for index, location in enumerate(locations)}
+        self.puck_indexes = {
+            puck: range(number * ports_per_puck, (number + 1) * ports_per_puck)
+            for number, puck in enumerate(pucks)
+        }
+        self._puck_masks = {puck: sum(1 << index for index in indexes)
+                            for puck, indexes in self.puck_indexes.items()}
+        self._all_mask = (1 << size) - 1
+
+    def location(self, index):
+        """Return the ``(puck, port_num)`` of a port index or None if there's no port."""
+        return self._locations[index]
+
+    def puck(self, index):
+        """Return the puck of a port index or None if there's no port."""
+        location = self._locations[index]
+        return None if location is None else location[0]
+
+    def port(self, position, index):
+        """Return the `Port` at an index of ``position`` or None if there's no port.
+
+        Also None if the index map isn't confirmed.
+
+        """
+        location = self._locations[index] if self.confirmed else None
+        return None if location is None else Port(position, *location)
+
+    def index(self, puck, port_num):
+        """Return the index of a port, raising ``ValueError`` if there's no such port.
+
+        Also raises ``ValueError`` if the index map isn't confirmed.
+
+        """
+        self.check_confirmed()
+        try:
+            return self._indexes[puck.upper(), int(port_num)]
+        except KeyError:
+            raise ValueError(f'no port {puck} {port_num}') from None
+
+    def mask(self, ports):
+        """Return the bitmask of a selection of ports, with bit ``i`` for index ``i``.
+
+        ``ports`` may be any of:
+
+        * a list of 1s and 0s by port index
+        * a list of puck letters (eg ``'C'``) and ports (eg ``'C 5'``) in
+          either case
+        * ``'hex:<digits>'`` or ``'base64:<bytes>'`` encoding the bitmask as a
+          hexadecimal number or as big-endian bytes
+
+        Selections by index are passed on as given, as the index map of some
+        holders isn't confirmed, while puck letters and ports only select the
+        indexes of the layout and raise ``ValueError`` if its index map isn't
+        confirmed.
+
+        """
+        if isinstance(ports, int):
+            return ports & self._all_mask
+        if isinstance(ports, str):
+            encoding, _, text = ports.partition(':')
+            if encoding == 'hex':
+                return int(text, 16) & self._all_mask
+            if encoding == 'base64':
+                value = int.from_bytes(base64.b64decode(text), 'big')
+                return value & self._all_mask
+            raise ValueError(f'unknown port encoding {encoding!r}')
+        ports = list(ports)
+        if any(isinstance(item, str) and item not in ('0', '1') for item in ports):
+            self.check_confirmed()
+            mask = 0
+            for item in ports:
+                puck, _, port_num = item.strip().upper().partition(' ')
+                if not port_num:
+                    if puck not in self._puck_masks:
+                        raise ValueError(f'no puck {puck}')
+                    mask |= self._puck_masks[puck]
+                else:
+                    mask |= 1 << self.index(puck, port_num)
+            return mask
+        bits = ''.join('1' if int(flag) else '0' for flag in reversed(ports))
+        return int(bits or '0', 2) & self._all_mask
+
+    def check_confirmed(self):
+        """Raise ``ValueError`` if the index map isn't confirmed."""
+        if not self.confirmed:
+            raise ValueError('the port index map of this holder is not confirmed, '
+                             'select its ports by index')
+
+    def probe_request(self, mask):
+        """Return the probe request string (a 1 or 0 per index) of a bitmask."""
+        return format(mask, f'0{self.size}b')[::-1]
+
+
+LAYOUTS = {
+    HolderType.unknown: PortLayout(COLUMNS, PORTS_PER_COLUMN),
+    HolderType.calibration: PortLayout(COLUMNS, PORTS_PER_COLUMN),
+    HolderType.normal: PortLayout(COLUMNS, PORTS_PER_COLUMN),
+    # Not yet checked against the robot's superpuck port numbering
+    HolderType.superpuck: PortLayout(PUCKS, PORTS_PER_PUCK, confirmed=False),
+}
+
+
+def layout(holder_type):
+    """Return the `PortLayout` of a ``codes.HolderType``."""
+    return LAYOUTS[HolderType(holder_type)]
+
+
+def port_masks(ports, holder_types):
+    """Return the bitmask of each position for a selection of ports.
+
+    Args:
+        ports: Dict of positions to any selection accepted by `PortLayout.mask`
+            or a list of codes of pucks (eg ``'L C'``) and ports (eg ``'L C 5'``)
+            across all positions.
+        holder_types (dict): ``codes.HolderType`` of each position.
+
+    """
+    if not isinstance(ports, dict):
+        by_position = {}
+        for code in ports:
+            pos_char, _, rest = code.strip().partition(' ')
+            by_position.setdefault(POSITION_CODES[pos_char.lower()], []).append(rest)
+        ports = by_position
+    return {position: layout(holder_type).mask(ports.get(position, []))
+            for position, holder_type in holder_types.items()}
@@ -0,0 +1,134 @@
+from collections import defaultdict
+from functools import partial
+import random
+from threading import Lock, Thread
+import time
+
+from .client import RobotClientMX
+from .metrics import latency_summary
+
+
+DEFAULT_MIX = {'refresh': 10, 'set_lid': 1, 'set_heater': 1, 'mount': 0}
+
+
+def parse_mix(text):
+    """Parse an operation mix such as ``'refresh=10,set_lid=1'`` into weights."""
+    mix = {}
+    for item in text.split(','):
+        operation, _, weight = item.partition('=')
+        operation = operation.strip()
+        if operation not in DEFAULT_MIX:
+            raise ValueError(f'unknown operation {operation!r}')
+        mix[operation] = float(weight or 1)
+    return mix
+
+
+class LoadResults:
+    """Latencies and errors collected from the load test clients."""
+
+    def __init__(self):
+        self.request_latencies = defaultdict(list)
+        self.update_latencies = []
+        self.errors = defaultdict(int)
+        self._lock = Lock()
+
+    def add_request(self, operation, latency, error=None):
+        with self._lock:
+            self.request_latencies[operation].append(latency)
+            if error:
+                self.errors[operation] += 1
+
+    def add_update(self, latency):
+        with self._lock:
+            self.update_latencies.append(latency)
+
+    def report(self, duration):
+        with self._lock:
+            all_latencies = [latency for latencies in self.request_latencies.values()
+                             for latency in latencies]
+            requests = {operation: latency_summary(latencies)
+                        for operation, latencies in self.request_latencies.items()}
+            requests['all'] = latency_summary(all_latencies)
+            return {
+                'duration': duration,
+                'requests': len(all_latencies),
+                'throughput': len(all_latencies) / duration if duration else None,
+                'errors': dict(self.errors),
+                'request_latency': requests,
+                'update_latency': latency_summary(self.update_latencies),
+            }
+
+
+def run_load_test(update_addr, request_addr, *, clients=10, requests=100, mix=None,
+                  mount_port='L A 1', query_addr=None, seed=None,
+                  client_factory=RobotClientMX):
+    """Run ``clients`` concurrent clients that each send ``requests`` requests.
+
+    Each request is picked at random from ``mix``, a dict of operation names
+    (``refresh``, ``set_lid``, ``set_heater`` and ``mount``) to weights. Mounts
+    are forced to ``mount_port`` so they should only be run against a server
+    connected to a simulated robot.
+
+    Request latency is the time for the client call to return. Update latency
+    is the time from sending an operation to receiving its first update.
+
+    Returns:
+        dict: Throughput, error counts and p50, p95, p99 and max latencies
+
+    """
+    mix = mix or DEFAULT_MIX
+    operations = [operation for operation, weight in mix.items() if weight > 0]
+    weights = [mix[operation] for operation in operations]
+    rng = random.Random(seed)
+    results = LoadResults()
+    workers = []
+    load_clients = []
+    try:
+        for _ in range(clients):
+            client = client_factory(update_addr=update_addr, request_addr=request_addr,
+                                    query_addr=query_addr)
+            load_clients.append(client)
+            client.setup()
+            choices = rng.choices(operations, weights, k=requests)
+            workers.append(Thread(target=_run_client,
+                                  args=(client, choices, mount_port, results),
+                                  daemon=True))
+        start = time.monotonic()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results.report(time.monotonic() - start)
+    finally:
+        for client in load_clients:
+            client.close()
+
+
+def _run_client(client, operations, mount_port, results):
+    position, column, port_num = mount_port.split(' ')
+    position = {'L': 'left', 'M': 'middle', 'R': 'right'}[position.upper()]
+    for count, operation in enumerate(operations):
+        sent = time.monotonic()
+        # Bound now as a late update can arrive after the next request is sent
+        callback = partial(_record_first_update, results, sent, [])
+        try:
+            if operation == 'refresh':
+                response = client.query('refresh')
+            elif operation == 'set_lid':
+                response = client.set_lid(count % 2, callback=callback)
+            elif operation == 'set_heater':
+                response = client.set_heater(count % 2, callback=callback)
+            else:
+                response = client.mount(position, column, int(port_num), force=True,
+                                        callback=callback)
+        except Exception as exc:
+            results.add_request(operation, time.monotonic() - sent, error=str(exc))
+            continue
+        error = response.get('error') if isinstance(response, dict) else None
+        results.add_request(operation, time.monotonic() - sent, error=error)
+
+
+def _record_first_update(results, sent, first_update, *args, **kwargs):
+    if not first_update:
+        first_update.append(True)
+        results.add_update(time.monotonic() - sent)
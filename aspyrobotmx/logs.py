@@ -0,0 +1,171 @@
+import logging
+import logging.handlers
+from queue import Queue
+from threading import Lock, Thread
+import time
+
+
+# Seconds between checks for call sites that went quiet with suppressed records
+FLUSH_INTERVAL = 1.
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits the records logged from each call site with a token bucket. Each call
+    site may log ``burst`` records at once and then ``rate`` records per second.
+    The number of records suppressed is added to the next record let through,
+    or reported by `flush` once the call site has gone quiet.
+
+    One filter can be shared by several handlers: a record is only counted
+    and annotated the first time it is filtered, and later handlers get the
+    same decision.
+
+    Args:
+        rate (float): Records per second allowed from each call site.
+        burst (int): Records that may be logged at once.
+        max_level (int): Records above this level are never limited.
+
+    """
+    def __init__(self, rate, burst=5, max_level=logging.INFO, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_level = max_level
+        self._clock = clock
+        self._buckets = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno > self.max_level or getattr(record, 'suppressed', None):
+            return True
+        # Decisions are kept by filter as a record may pass through several
+        decisions = record.__dict__.setdefault('_rate_limits', {})
+        if id(self) not in decisions:
+            decisions[id(self)] = self._filter(record)
+        return decisions[id(self)]
+
+    def _filter(self, record):
+        key = (record.name, record.pathname, record.lineno)
+        now = self._clock()
+        with self._lock:
+            tokens, last, suppressed, _ = self._buckets.get(key,
+                                                            (self.burst, now, 0, None))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now, suppressed + 1, record)
+                return False
+            self._buckets[key] = (tokens - 1, now, 0, None)
+        if suppressed:
+            record.msg = f'{record.msg} [{suppressed} similar messages suppressed]'
+        return True
+
+    def flush(self):
+        """Return summary records for call sites that went quiet after records
+        were suppressed, so the count isn't lost if nothing else is logged.
+
+        """
+        now = self._clock()
+        summaries = []
+        with self._lock:
+            for key, (tokens, last, suppressed, record) in self._buckets.items():
+                if not suppressed or tokens + (now - last) * self.rate < 1:
+                    continue
+                self._buckets[key] = (tokens, last, 0, None)
+                summary = logging.makeLogRecord(record.__dict__)
+                summary.msg = (f'{record.getMessage()} '
+                               f'[{suppressed} similar messages suppressed]')
+                summary.args = None
+                summary.exc_info = summary.exc_text = None
+                summary.suppressed = suppressed
+                summaries.append(summary)
+        return summaries
+
+
+def start_queue_logging(rate=None, burst=5, loggers=None):
+    """Move the handlers of the configured loggers onto background threads.
+
+    Each logger with handlers gets a ``QueueHandler`` in their place and a
+    ``QueueListener`` thread that passes its records to the original handlers,
+    so slow handlers don't block the threads that log.
+
+    Args:
+        rate (float): If given, limit each call site to this many records per
+            second with a ``RateLimitFilter``.
+        burst (int): Records each call site may log at once when rate limited.
+        loggers (list): Loggers to move. Defaults to the root logger and all
+            named loggers.
+
+    Returns:
+        list: The started queue listeners. Stop them to flush queued records.
+
+    """
+    if loggers is None:
+        loggers = [logging.getLogger()]
+        loggers.extend(logger for logger in logging.Logger.manager.loggerDict.values()
+                       if isinstance(logger, logging.Logger))
+    listeners = []
+    for logger in loggers:
+        handlers = logger.handlers[:]
+        if not handlers:
+            continue
+        log_queue = Queue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        if rate:
+            _add_rate_limit(queue_handler, rate, burst)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                                  respect_handler_level=True)
+        listener.start()
+        listeners.append(listener)
+    return listeners
+
+
+def limit_log_rate(rate, burst=5, loggers=None):
+    """Limit each call site to ``rate`` records per second on the handlers of
+    the configured loggers, for when the handlers aren't moved to a queue.
+
+    One `RateLimitFilter` is shared by all the handlers so a record passed to
+    several of them is only counted and annotated once. Summaries of quiet
+    call sites are logged through the logger of their records.
+
+    Args:
+        rate (float): Records per second allowed from each call site.
+        burst (int): Records each call site may log at once.
+        loggers (list): Loggers whose handlers are limited. Defaults to the root
+            logger and all named loggers.
+
+    Returns:
+        RateLimitFilter: The filter added to the handlers.
+
+    """
+    if loggers is None:
+        loggers = [logging.getLogger()]
+        loggers.extend(logger for logger in logging.Logger.manager.loggerDict.values()
+                       if isinstance(logger, logging.Logger))
+    rate_limit = RateLimitFilter(rate, burst)
+    for logger in loggers:
+        for handler in logger.handlers:
+            handler.addFilter(rate_limit)
+    Thread(target=_flush_suppressed, args=(rate_limit, _log_summary),
+           daemon=True).start()
+    return rate_limit
+
+
+def _add_rate_limit(handler, rate, burst):
+    rate_limit = RateLimitFilter(rate, burst)
+    handler.addFilter(rate_limit)
+    Thread(target=_flush_suppressed, args=(rate_limit, handler.handle),
+           daemon=True).start()
+
+
+def _log_summary(record):
+    logging.getLogger(record.name).handle(record)
+
+
+def _flush_suppressed(rate_limit, handle):
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        for record in rate_limit.flush():
+            handle(record)
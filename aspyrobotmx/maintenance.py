@@ -0,0 +1,222 @@
+from contextlib import contextmanager
+from itertools import count
+import logging
+from threading import Condition, Event, Thread
+import time
+from typing import NamedTuple
+
+from .codes import HolderType, PortState
+from .layout import layout
+
+
+# Seconds without user operations before the robot counts as idle
+MIN_IDLE = 300.
+# Seconds between checks for maintenance that is due
+CHECK_INTERVAL = 5.
+# Longest a user operation waits for a running maintenance step to finish
+PREEMPT_TIMEOUT = 120.
+# Maintenance that probes the pucks whose ports are all in an unknown state
+PROBE_UNKNOWN_PUCKS = 'probe_unknown_pucks'
+# Start of the operation handles of maintenance steps
+HANDLE_PREFIX = 'maintenance-'
+
+
+class MaintenanceTask(NamedTuple):
+    """
+    Maintenance to run when the robot is idle.
+
+    Args:
+        operation (str): Foreground operation of ``RobotServerMX`` to run, eg
+            ``'dry_and_cool'``, or ``'probe_unknown_pucks'``.
+        interval (float): Seconds to wait after the task runs before running it
+            again.
+        parameters (dict): Keyword parameters of the operation.
+
+    """
+    operation: str
+    interval: float
+    parameters: dict = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a task from a dict with the fields of the task."""
+        return cls(config['operation'], float(config['interval']),
+                   dict(config.get('parameters', {})))
+
+    def steps(self, server):
+        """Return the ``(operation, parameters)`` to run, in order."""
+        if self.operation == PROBE_UNKNOWN_PUCKS:
+            # One probe of all the pucks rather than a ProbeCassettes run each
+            pucks = unknown_pucks(server)
+            return [('probe', {'ports': pucks})] if pucks else []
+        return [(self.operation, self.parameters or {})]
+
+
+def unknown_pucks(server):
+    """Return the codes (eg ``'L A'``) of pucks whose ports are all unknown.
+
+    Holders whose index map isn't confirmed are left out as their pucks can't
+    be probed by code.
+
+    """
+    pucks = []
+    for position, holder_type in server.holder_types.items():
+        if holder_type == HolderType.unknown or not layout(holder_type).confirmed:
+            continue
+        states = server.port_states[position]
+        for puck, indexes in layout(holder_type).puck_indexes.items():
+            if all(states[index] == PortState.unknown for index in indexes):
+                pucks.append(f'{position[0].upper()} {puck}')
+    return pucks
+
+
+class MaintenanceScheduler:
+    """
+    Runs maintenance tasks, such as ``dry_and_cool`` or a quick toolset
+    calibration, in the idle windows between user operations.
+
+    The robot is idle when the server is ready, no foreground task is running
+    and no user operation has been requested or has reported progress (see
+    `record_activity`) for ``min_idle`` seconds. Tasks
+    run one step at a time and user operations wrapped in `preempt` stop any
+    further steps from starting and wait for the running step to finish, so a
+    mount waits for at most one step rather than being refused as busy.
+
+    Args:
+        server (RobotServerMX): Server to run the operations on.
+        tasks (list): `MaintenanceTask`\\ s in order of priority.
+        min_idle (float): Seconds without user operations before maintenance runs.
+        clock: Function returning monotonic seconds.
+
+    """
+    def __init__(self, server, tasks, *, min_idle=MIN_IDLE, clock=time.monotonic,
+                 logger=None):
+        self.server = server
+        self.tasks = list(tasks)
+        self.min_idle = min_idle
+        self.clock = clock
+        self.logger = logger or logging.getLogger(__name__)
+        self.runs = 0
+        self.preempted = 0
+        self.running = None
+        self._last_runs = [-float('inf')] * len(self.tasks)
+        self._last_request = clock()
+        self._requests = 0
+        self._handles = count(1)
+        self._changed = Condition()
+        self._stop = Event()
+        for task in self.tasks:
+            if task.operation == PROBE_UNKNOWN_PUCKS:
+                continue
+            operation = getattr(server, task.operation, None)
+            if operation is None:
+                raise ValueError(f'no operation {task.operation!r}')
+            if getattr(operation, '_preempts_maintenance', False):
+                raise ValueError(f'{task.operation!r} is a user operation')
+
+    def start(self):
+        """Check for due maintenance in a background thread."""
+        if self.tasks:
+            Thread(target=self._run, name='MaintenanceScheduler', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def idle(self):
+        """Return whether the robot is free for maintenance."""
+        with self._changed:
+            if self._requests or self.clock() - self._last_request < self.min_idle:
+                return False
+        return (bool(self.server.ready)
+                and bool(self.server.robot.foreground_done.value)
+                and not self.server._foreground_lock.locked())
+
+    def due(self):
+        """Return the indexes of the tasks that are due, in order of priority."""
+        now = self.clock()
+        return [number for number, task in enumerate(self.tasks)
+                if now - self._last_runs[number] >= task.interval]
+
+    def run_pending(self):
+        """Run the first due task if the robot is idle and return it, else None."""
+        if not self.idle():
+            return None
+        for number in self.due():
+            task = self.tasks[number]
+            steps = task.steps(self.server)
+            if steps:
+                self._run_task(number, steps)
+                return task
+            self._last_runs[number] = self.clock()
+        return None
+
+    def record_activity(self, handle):
+        """Restart the idle time for an operation unless it is maintenance."""
+        if str(handle).startswith(HANDLE_PREFIX):
+            return
+        with self._changed:
+            self._last_request = self.clock()
+
+    @contextmanager
+    def preempt(self):
+        """Hold off maintenance while a user operation runs.
+
+        Waits up to `PREEMPT_TIMEOUT` for a running maintenance step and gives
+        whether it finished in time, in which case the robot is free of
+        maintenance until the context exits.
+
+        """
+        with self._changed:
+            self._requests += 1
+            self._last_request = self.clock()
+            yielded = True
+            if self.running is not None:
+                self.logger.info('waiting for maintenance step %s', self.running)
+                yielded = self._changed.wait_for(lambda: self.running is None,
+                                                 PREEMPT_TIMEOUT)
+                if not yielded:
+                    self.logger.error('maintenance step %s did not yield',
+                                      self.running)
+        try:
+            yield yielded
+        finally:
+            with self._changed:
+                self._requests -= 1
+                self._last_request = self.clock()
+
+    def stats(self):
+        with self._changed:
+            return {'runs': self.runs, 'preempted': self.preempted,
+                    'running': self.running}
+
+    def _run_task(self, number, steps):
+        task = self.tasks[number]
+        self.logger.info('running maintenance %s in %d steps', task.operation,
+                         len(steps))
+        for operation, parameters in steps:
+            with self._changed:
+                if self._requests:
+                    self.preempted += 1
+                    self.logger.info('maintenance %s preempted', task.operation)
+                    return
+                self.running = operation
+            handle = f'{HANDLE_PREFIX}{next(self._handles)}'
+            self.server.maintenance = {'task': task.operation, 'operation': operation,
+                                       'handle': handle}
+            try:
+                getattr(self.server, operation)(handle, **parameters)
+            finally:
+                self.server.maintenance = None
+                with self._changed:
+                    self.running = None
+                    self._changed.notify_all()
+        with self._changed:
+            self.runs += 1
+            self._last_runs[number] = self.clock()
+
+    def _run(self):
+        while not self._stop.wait(CHECK_INTERVAL):
+            try:
+                self.run_pending()
+            except Exception:
+                self.logger.exception('maintenance failed')
@@ -0,0 +1,58 @@
+from collections import deque
+import math
+from threading import Lock
+
+
+def percentile(sorted_values, fraction):
+    """Return the nearest-rank percentile of a sorted sequence."""
+    if not sorted_values:
+        return None
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def latency_summary(latencies):
+    """Summarise a sequence of latencies with their count, percentiles and max."""
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50': percentile(latencies, .5),
+        'p95': percentile(latencies, .95),
+        'p99': percentile(latencies, .99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+
+class LatencyTracker:
+    """
+    Records the latencies of recent requests and summarises them against a
+    service level objective.
+
+    Args:
+        slo (float): Target latency in seconds.
+        window (int): Number of recent latencies to keep.
+
+    """
+    def __init__(self, slo, window=1000):
+        self.slo = slo
+        self.count = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self.count += 1
+            self._latencies.append(latency)
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self._latencies)
+            count = self.count
+        within = sum(1 for latency in latencies if latency <= self.slo)
+        stats = latency_summary(latencies)
+        stats.update({
+            'count': count,
+            'slo': self.slo,
+            'within_slo': within / len(latencies) if latencies else None,
+        })
+        return stats
@@ -0,0 +1,121 @@
+from collections import Counter
+import os
+import sys
+import tempfile
+from threading import Event, Lock, Thread, enumerate as enumerate_threads, get_ident
+import time
+import tracemalloc
+
+
+DEFAULT_INTERVAL = 0.005
+
+
+class SamplingProfiler:
+    """
+    Profiles every thread of a running process by periodically sampling their
+    stacks. Writes the samples as folded stacks (one ``frame;frame;... count``
+    line per stack) which can be rendered with ``flamegraph.pl`` or speedscope.
+
+    Unlike ``cProfile`` it sees all threads and doesn't slow the profiled code.
+
+    """
+    def __init__(self):
+        self.samples = Counter()
+        self.path = None
+        self._stop = Event()
+        self._thread = None
+        self._lock = Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration=None, path=None, interval=DEFAULT_INTERVAL, directory=None):
+        """Start sampling every ``interval`` seconds.
+
+        Args:
+            duration (float): Seconds to profile for. Runs until ``stop`` if None.
+            path (str): File to write the folded stacks to when profiling ends.
+                Defaults to a new file in ``directory``.
+            directory (str): Directory of the default file. Defaults to the temp
+                directory.
+
+        Returns:
+            str: Path the profile will be written to
+
+        """
+        with self._lock:
+            if self.running:
+                raise RuntimeError('profiler is already running')
+            if path is None:
+                fd, path = tempfile.mkstemp(prefix='aspyrobotmx-', suffix='.folded',
+                                            dir=directory)
+                os.close(fd)
+            self.path = path
+            self.samples = Counter()
+            self._stop.clear()
+            self._thread = Thread(target=self._run, args=(duration, interval),
+                                  name='SamplingProfiler', daemon=True)
+            self._thread.start()
+        return path
+
+    def stop(self):
+        """Stop sampling, write the profile and return its path."""
+        thread = self._thread
+        if thread is None:
+            raise RuntimeError('profiler is not running')
+        self._stop.set()
+        thread.join()
+        return self.path
+
+    def _run(self, duration, interval):
+        deadline = None if duration is None else time.monotonic() + duration
+        own_ident = get_ident()
+        while not self._stop.wait(interval):
+            names = {thread.ident: thread.name for thread in enumerate_threads()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own_ident:
+                    self.samples[_fold(names.get(ident, ident), frame)] += 1
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        self.write(self.path)
+
+    def write(self, path):
+        with open(path, 'w') as file:
+            for stack, count in self.samples.most_common():
+                file.write(f'{stack} {count}\n')
+
+
+def _fold(thread_name, frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        frames.append(f'{code.co_name} ({filename}:{code.co_firstlineno})')
+        frame = frame.f_back
+    frames.append(f'thread {thread_name}')
+    return ';'.join(reversed(frames))
+
+
+def tracemalloc_summary(limit=10, group_by='lineno'):
+    """Return the largest allocations traced by ``tracemalloc`` as lines of text.
+
+    Starts tracing if it isn't already running, in which case only allocations
+    made from now on will appear in later summaries.
+
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        return ['tracemalloc started, take another snapshot to see allocations']
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f'traced memory: {current / 1024:.1f} KiB (peak {peak / 1024:.1f} KiB)']
+    lines.extend(str(stat) for stat in snapshot.statistics(group_by)[:limit])
+    return lines
+
+
+# Profiler shared by the servers and command line of a process
+profiler = SamplingProfiler()
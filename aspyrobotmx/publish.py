@@ -0,0 +1,138 @@
+from collections import deque
+from queue import Empty
+from threading import Condition
+import time
+
+
+OVERFLOW_POLICIES = ['coalesce', 'drop_oldest', 'drop_newest']
+# Values that are lists of events and are joined rather than replaced when
+# updates are coalesced
+ACCUMULATED_KEYS = {'status_changes'}
+
+
+class PublishQueue:
+    """
+    Bounded queue of the updates waiting to be published. Implements the parts
+    of the ``queue.Queue`` interface used by the server.
+
+    Operation updates are never dropped so clients see every operation stage.
+    When the queue is full, a blocking ``put`` of an operation update waits for
+    room, so a storm of operations is slowed down rather than growing the
+    queue. ``values`` updates are handled by the overflow policy:
+
+    * ``'coalesce'``: merge the update into the last queued update if that is a
+      values update, so the latest value of each key is published without
+      overtaking operation updates
+    * ``'drop_oldest'``: drop the oldest queued values update
+    * ``'drop_newest'``: drop the new update
+
+    When values are dropped, the next values update published has an
+    ``updates_dropped`` entry with the state version to resync from (``since``)
+    so clients can catch up with ``changes_since``.
+
+    Args:
+        maxsize (int): Number of updates to hold before applying the overflow
+            policy. Zero for no limit.
+        overflow (str): Overflow policy.
+
+    """
+    def __init__(self, maxsize=0, overflow='coalesce'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'overflow must be one of {OVERFLOW_POLICIES}')
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_water = 0
+        self._messages = deque()
+        self._not_empty = Condition()
+        self._not_full = Condition(self._not_empty)
+        self._dropped_since = None
+
+    def put(self, message, block=True, timeout=None):
+        with self._not_empty:
+            if self.full() and message.get('type') == 'values':
+                self._put_overflowing(message)
+            else:
+                if block:
+                    self._not_full.wait_for(lambda: not self.full(), timeout)
+                self._messages.append(message)
+            self.high_water = max(self.high_water, len(self._messages))
+            self._not_empty.notify()
+
+    def put_nowait(self, message):
+        self.put(message, block=False)
+
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            if not block:
+                timeout = 0
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._messages:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Empty
+                self._not_empty.wait(remaining)
+            message = self._messages.popleft()
+            self._not_full.notify()
+            if self._dropped_since is not None and message.get('type') == 'values':
+                message['data'] = dict(message['data'], updates_dropped={
+                    'since': self._dropped_since,
+                })
+                self._dropped_since = None
+            return message
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return len(self._messages)
+
+    def empty(self):
+        return not self._messages
+
+    def full(self):
+        return 0 < self.maxsize <= len(self._messages)
+
+    def stats(self):
+        return {
+            'size': len(self._messages),
+            'maxsize': self.maxsize,
+            'overflow': self.overflow,
+            'high_water': self.high_water,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
+
+    def _put_overflowing(self, message):
+        if self.overflow == 'drop_newest':
+            self._drop(message)
+        elif self.overflow == 'drop_oldest':
+            oldest = next((m for m in self._messages if m.get('type') == 'values'),
+                          None)
+            if oldest is not None:
+                self._messages.remove(oldest)
+                self._drop(oldest)
+            self._messages.append(message)
+        else:
+            newest = self._messages[-1] if self._messages else None
+            if newest is None or newest.get('type') != 'values':
+                # Nothing to merge with so this update goes over the limit. Later
+                # updates are merged into it.
+                self._messages.append(message)
+                return
+            data = dict(newest['data'])
+            for key, value in message['data'].items():
+                if key in ACCUMULATED_KEYS and key in data:
+                    value = data[key] + value
+                data[key] = value
+            newest['data'] = data
+            self.coalesced += 1
+
+    def _drop(self, message):
+        self.dropped += 1
+        version = message['data'].get('state_version')
+        if version is None:
+            return
+        if self._dropped_since is None or version - 1 < self._dropped_since:
+            self._dropped_since = version - 1
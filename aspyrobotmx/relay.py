@@ -0,0 +1,114 @@
+import json
+import logging
+from threading import Event
+
+import zmq
+
+from .client import RobotClientMX
+from .codes import EVENT_KEYS
+
+
+SUBSCRIBE = b'\x01'
+
+
+class UpdateRelay:
+    """
+    Re-publishes the update stream of a ``RobotServerMX`` so read-only clients
+    can connect to relays on other hosts instead of the robot server.
+
+    The relay subscribes to the server with an XSUB socket and forwards every
+    update through an XPUB socket. It keeps the latest values from a single
+    ``refresh`` of the server and the ``values`` updates that follow. Clients
+    using the relay as their request address get that state from ``refresh``
+    and ``changes_since`` without calling the server, and each joining client
+    only receives its own copy. Other operations are refused as the relay is
+    read-only.
+
+    Args:
+        server_update_addr (str): Update address of the server to relay.
+        server_request_addr (str): Request address of the server, used once to
+            fetch the initial state.
+        update_addr (str): Address to publish the relayed updates on.
+        request_addr (str): Address to serve the cached state on.
+
+    """
+    def __init__(self, server_update_addr, server_request_addr, update_addr,
+                 request_addr=None, *, context=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.server_update_addr = server_update_addr
+        self.server_request_addr = server_request_addr
+        self.update_addr = update_addr
+        self.request_addr = request_addr
+        self.context = context or zmq.Context.instance()
+        self.state = {}
+        self.shutdown_requested = Event()
+
+    def fetch_state(self):
+        client = RobotClientMX(update_addr=self.server_update_addr,
+                               request_addr=self.server_request_addr)
+        response = client.run_operation('refresh')
+        self.state = dict(response['data'])
+
+    def run(self):
+        upstream = self.context.socket(zmq.XSUB)
+        upstream.connect(self.server_update_addr)
+        upstream.send(SUBSCRIBE)
+        downstream = self.context.socket(zmq.XPUB)
+        downstream.bind(self.update_addr)
+        requests = None
+        self.fetch_state()
+        poller = zmq.Poller()
+        poller.register(upstream, zmq.POLLIN)
+        poller.register(downstream, zmq.POLLIN)
+        if self.request_addr:
+            requests = self.context.socket(zmq.REP)
+            requests.bind(self.request_addr)
+            poller.register(requests, zmq.POLLIN)
+        try:
+            while not self.shutdown_requested.is_set():
+                events = dict(poller.poll(100))
+                if upstream in events:
+                    frames = upstream.recv_multipart()
+                    downstream.send_multipart(frames)
+                    self._cache(frames[-1])
+                if downstream in events:
+                    # The relay is already subscribed to everything upstream so
+                    # subscriptions aren't forwarded
+                    if downstream.recv()[:1] == SUBSCRIBE:
+                        self.logger.debug('subscriber joined')
+                if requests is not None and requests in events:
+                    requests.send_json(self._reply(requests.recv()))
+        finally:
+            upstream.close(linger=0)
+            downstream.close(linger=0)
+            if requests is not None:
+                requests.close(linger=0)
+
+    def shutdown(self):
+        self.shutdown_requested.set()
+
+    def _reply(self, frame):
+        try:
+            request = json.loads(frame)
+            operation = request.get('operation')
+        except (ValueError, AttributeError):
+            return {'error': 'requests must be JSON objects', 'data': None}
+        if operation == 'refresh':
+            return {'error': None, 'data': self.state}
+        if operation == 'changes_since':
+            return {'error': None, 'data': {'server_id': self.state.get('server_id'),
+                                            'full': True, 'values': self.state}}
+        return {'error': f'{operation!r} is not served by the read-only relay',
+                'data': None}
+
+    def _cache(self, frame):
+        try:
+            message = json.loads(frame)
+        except ValueError:
+            self.logger.warning('could not decode update: %r', frame[:100])
+            return
+        if message.get('type') == 'values':
+            # Replaying events such as status flag changes to new subscribers
+            # would fire their callbacks for changes that happened earlier
+            self.state.update((key, value) for key, value in message['data'].items()
+                              if key not in EVENT_KEYS)
@@ -1,4 +1,10 @@
+import time
+
 from aspyrobot import Robot
+from epics import poll
+
+
+CONNECTION_TIMEOUT = 5.
 
 
 class RobotMX(Robot):
@@ -36,6 +42,24 @@ class RobotMX(Robot):
     })
     attrs_r = {v: k for k, v in attrs.items()}
 
+    def wait_for_connections(self, timeout=CONNECTION_TIMEOUT):
+        """Wait up to ``timeout`` seconds for the PVs to connect.
+
+        Channel searches for all the PVs are started when they are created so
+        the PVs connect concurrently and startup is bounded by the slowest PV.
+
+        Returns:
+            list: Names of the attributes whose PVs failed to connect
+
+        """
+        deadline = time.monotonic() + timeout
+        pending = list(self.attrs)
+        while True:
+            pending = [attr for attr in pending if not getattr(self, attr).connected]
+            if not pending or time.monotonic() >= deadline:
+                return pending
+            poll(evt=1e-3, iot=1e-3)
+
     def prepare_for_mount(self):
         return self.run_task('PrepareForMountDismount')
 
@@ -0,0 +1,53 @@
+import warnings
+
+import numpy as np
+
+from .codes import PortState
+from .layout import layout
+
+
+# Ports further than this many robust standard deviations from the median of
+# their puck are flagged
+THRESHOLD = 3.5
+# Smallest spread used so identical pins don't make tiny differences anomalous
+MIN_SPREAD = 0.1
+# Full ports needed in a puck before it is screened
+MIN_PORTS = 4
+# Scales the median absolute deviation to the standard deviation of normal data
+MAD_SCALE = 1.4826
+
+
+def distance_anomalies(distances, states, holder_type, *, threshold=THRESHOLD,
+                       min_spread=MIN_SPREAD, min_ports=MIN_PORTS):
+    """Flag the full ports whose probed distance is unusual for their puck.
+
+    Each puck (or cassette column) is screened separately with the modified
+    z-score ``|distance - median| / (1.4826 * MAD)`` so a few bad pins don't
+    hide each other the way they would with the mean and standard deviation.
+    Empty ports and ports without a distance are ignored.
+
+    Args:
+        distances (list): Distance of each port of a position, None if unknown.
+        states (list): ``codes.PortState`` of each port of the position.
+        holder_type (codes.HolderType): Holder in the position.
+
+    Returns:
+        list[bool]: Whether each port is anomalous
+
+    """
+    group_size = layout(holder_type).ports_per_puck
+    values = np.array([np.nan if distance is None else distance
+                       for distance in distances], dtype=float)
+    values[np.asarray(states) != PortState.full] = np.nan
+    values = values.reshape(-1, group_size)
+    measured = ~np.isnan(values)
+    with warnings.catch_warnings():
+        # Pucks with no measured ports give all NaN slices
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(values, axis=1, keepdims=True)
+        deviation = np.abs(values - median)
+        spread = MAD_SCALE * np.nanmedian(deviation, axis=1, keepdims=True)
+    score = deviation / np.maximum(spread, min_spread)
+    screened = measured.sum(axis=1, keepdims=True) >= min_ports
+    anomalous = measured & screened & (score > threshold)
+    return anomalous.ravel().tolist()
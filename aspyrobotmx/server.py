@@ -1,8 +1,15 @@
-from itertools import repeat
+from collections import deque
+from itertools import islice, repeat
+import time
 from copy import deepcopy
-from concurrent.futures import ThreadPoolExecutor
-from typing import NamedTuple
-from enum import Enum
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+import tempfile
+from threading import Condition, Event, Lock, Thread, current_thread
+import uuid
 
 
 from aspyrobot import RobotServer
@@ -10,15 +17,81 @@ from aspyrobot.server import (foreground_operation, background_operation,
                               query_operation)
 from aspyrobot.exceptions import RobotError
 from epics import poll
-
-from .codes import HolderType, PuckState, PortState
+import zmq
+
+from .codes import (EVENT_KEYS, HolderType, PuckState, PortState, status_changes,
+                    status_flags)
+from .encoding import EncodedValueCache, EncodingSocket
+from .eta import DurationHistory
+from .inventory import PortInventory
+from .layout import PORTS_PER_POSITION, PUCKS, Port, Position, layout, port_masks
+from .maintenance import MIN_IDLE, MaintenanceScheduler
 from .make_safe import MakeSafeFailed
+from .metrics import LatencyTracker
+from .profiling import profiler, tracemalloc_summary
+from .publish import PublishQueue
+from .screening import distance_anomalies
+from .shm import SharedStateWriter
+from .singleflight import SingleFlight
 
 
 POSITIONS = ['left', 'middle', 'right']
-SLOTS = ['A', 'B', 'C', 'D']
-PORTS_PER_POSITION = 96
+SLOTS = list(PUCKS)
 DELAY_TO_PROCESS = 0.5
+PUT_TIMEOUT = 5.
+# Updates sent by SPEL in response to the DataRequest in fetch_all_data
+DATA_DUMP_UPDATES = ['cassette_type', 'puck_states', 'port_states', 'sample_distances']
+# Seconds to wait for the data dump before requesting the missing updates again
+DATA_TIMEOUT = 30.
+# Times the data dump is requested again before the server gives up waiting
+DATA_RETRIES = 2
+QUERY_LANE_SLO = 0.01
+REQUEST_LANE_SLO = 0.1
+HEARTBEAT_INTERVAL = 1.
+# Number of recent values updates kept so clients can catch up with changes_since
+JOURNAL_SIZE = 1000
+# Seconds a refresh is reused for while the state version is unchanged
+REFRESH_TTL = 0.2
+
+
+def fast_query(func):
+    """Mark a query operation to be served by the query lane as well.
+
+    Times each call made through the request socket for the request lane
+    latency metrics.
+
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if current_thread() is self._query_lane_thread:
+            return func(self, *args, **kwargs)
+        start = self.clock()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.lane_latency['request'].record(self.clock() - start)
+    wrapper._fast_query = True
+    return wrapper
+
+
+def preempts_maintenance(func):
+    """Mark a user operation that idle-time maintenance must give way to.
+
+    Maintenance steps stop starting while the operation is requested or
+    running, and the operation waits for a running step to finish. If the
+    step doesn't finish in time the operation ends with an error.
+
+    """
+    @wraps(func)
+    def wrapper(self, handle, *args, **kwargs):
+        with self.maintenance_scheduler.preempt() as yielded:
+            if not yielded:
+                self.operation_update(handle, stage='end',
+                                      error='maintenance did not yield')
+                return None
+            return func(self, handle, *args, **kwargs)
+    wrapper._preempts_maintenance = True
+    return wrapper
 
 
 class ServerAttr(object):
@@ -45,8 +118,45 @@ class RobotServerMX(RobotServer):
     Args:
         robot (RobotMX): An instance of RobotMX to enable communication with the
             robot EPICS IOC.
+        make_safe: Object that moves beamline equipment to and from safe positions.
+        executor (concurrent.futures.Executor): Worker pool for running the robot
+            and make safe steps of operations in parallel. Can be shared between
+            servers. Defaults to a private pool.
+        publish_queue_size (int): Number of updates that can wait to be published
+            before the overflow policy applies. Zero for no limit.
+        publish_overflow (str): Overflow policy of the publish queue. See
+            ``publish.PublishQueue``.
+        query_addr (str): If given, address of a separate request socket that only
+            serves query operations so they aren't held up by other requests.
+        duration_history (eta.DurationHistory): History of operation durations
+            used to publish ETAs. Defaults to an in-memory history.
+        state_file (str): If given, path of a memory mapped file to keep the
+            state in for processes on the same host. See ``shm``.
+        refresh_ttl (float): Seconds a ``refresh`` result is reused for while
+            the state version is unchanged. Concurrent refreshes always share
+            one snapshot.
+        maintenance_tasks (list): ``maintenance.MaintenanceTask``\\ s to run
+            when the robot is idle, in order of priority.
+        maintenance_idle (float): Seconds without user operations before the
+            robot counts as idle.
+        profile_dir (str): Directory that ``start_profiling`` writes profiles
+            to. Clients can only choose the file name. Defaults to the temp
+            directory.
+        started (float): ``clock`` time at which startup began, eg before the
+            robot PVs were created, so ``startup_timings`` include it. Defaults
+            to the start of ``setup``.
+        clock: Function returning monotonic seconds used to time operations.
+        sleep: Function called with seconds to wait for the robot to process
+            requests. Defaults to ``epics.poll`` so PV callbacks keep running.
+            See ``testing`` for virtual time versions for tests.
         **kwargs: Extra keyword parameters to be passed to RobotServer.
 
+    The ``holder_types``, ``puck_states``, ``port_states``, ``port_distances``
+    and ``port_anomalies`` tables are copied on write: updates build a new
+    table and replace the attribute, so a reference taken by a reader (or
+    waiting in the publish queue) never changes and needs no lock. Tables must
+    not be changed in place.
+
     """
     pins_mounted = ServerAttr('pins_mounted', 0)
     pins_lost = ServerAttr('pins_lost', 0)
@@ -55,11 +165,45 @@ class RobotServerMX(RobotServer):
     })
     dumbbell_state = ServerAttr('dumbbell_state')
     mount_message = ServerAttr('mount_message', default='')
-
-    def __init__(self, robot, *, make_safe, **kwargs):
+    ready = ServerAttr('ready', default=False)
+    startup_timings = ServerAttr('startup_timings', default={})
+    operation_eta = ServerAttr('operation_eta')
+    maintenance = ServerAttr('maintenance')
+
+    def __init__(self, robot, *, make_safe, executor=None, publish_queue_size=1000,
+                 publish_overflow='coalesce', query_addr=None, duration_history=None,
+                 state_file=None, refresh_ttl=REFRESH_TTL, maintenance_tasks=(),
+                 maintenance_idle=MIN_IDLE, profile_dir=None, started=None,
+                 clock=time.monotonic, sleep=poll, **kwargs):
         super().__init__(robot, **kwargs)
+        self.clock = clock
+        self.sleep = sleep
         self.logger.debug('__init__')
+        self.publish_queue = PublishQueue(publish_queue_size, publish_overflow)
+        self.query_addr = query_addr
+        self.duration_history = duration_history or DurationHistory()
+        self.lane_latency = {'query': LatencyTracker(QUERY_LANE_SLO),
+                             'request': LatencyTracker(REQUEST_LANE_SLO)}
+        self._query_lane_thread = None
+        self._shutdown_requested = Event()
+        self.server_id = uuid.uuid4().hex
+        self.state_version = 0
+        self._journal = deque(maxlen=JOURNAL_SIZE)
+        self._version_lock = Lock()
+        self._key_versions = {}
+        self._state_changed = Condition(self._version_lock)
+        self.encoded_values = EncodedValueCache(logger=self.logger)
+        self._refresh_flight = SingleFlight(self.state_snapshot, refresh_ttl, clock)
+        self._encoded_reply = None
+        self.maintenance_scheduler = MaintenanceScheduler(
+            self, maintenance_tasks, min_idle=maintenance_idle, clock=clock,
+            logger=self.logger,
+        )
+        self.state_file = state_file
+        self.profile_dir = profile_dir or tempfile.gettempdir()
+        self.shared_state = None
         self.make_safe = make_safe
+        self.executor = executor or ThreadPoolExecutor(max_workers=2)
         self.height_errors = {'left': None, 'middle': None, 'right': None}
         self.holder_types = dict.fromkeys(POSITIONS, HolderType.unknown)
         pucks_unknown = dict.fromkeys(SLOTS, int(PuckState.unknown))
@@ -76,17 +220,203 @@ class RobotServerMX(RobotServer):
             'middle': deepcopy(port_distances_unknown),
             'right': deepcopy(port_distances_unknown),
         }
+        self.port_anomalies = {position: [False] * PORTS_PER_POSITION
+                               for position in POSITIONS}
+        self.port_inventory = PortInventory(POSITIONS, PORTS_PER_POSITION)
         self.motors_locked = False
+        self._startup_times = {}
+        if started is not None:
+            self._startup_times = {'start': started, 'create': clock()}
+        self._awaiting_data = set()
+        self._data_ready = Event()
+        self._status = 0
 
     def setup(self):
+        if not self._startup_times:
+            self._startup_times = {'start': self.clock()}
+        else:
+            self._record_startup_phase('create', self._startup_times['create'])
+        failed = self.robot.wait_for_connections()
+        if failed:
+            self.logger.warning('PVs failed to connect: %s', ', '.join(failed))
+        self._record_startup_phase('connect')
         super(RobotServerMX, self).setup()
+        self._encode_sends()
+        if self.state_file:
+            self.shared_state = SharedStateWriter(self.state_file, logger=self.logger)
+            self.shared_state.update(self.state_snapshot())
+        self.encoded_values.start()
+        if self.query_addr:
+            self._query_lane_thread = Thread(target=self._serve_query_lane, daemon=True)
+            self._query_lane_thread.start()
+        Thread(target=self._publish_heartbeats, daemon=True).start()
+        self.maintenance_scheduler.start()
+        self._record_startup_phase('setup')
         self.fetch_all_data()
+        self._record_startup_phase('data_request')
+        Thread(target=self._await_data, daemon=True).start()
+
+    def shutdown(self):
+        self._shutdown_requested.set()
+        self.encoded_values.stop()
+        self.maintenance_scheduler.stop()
+        super().shutdown()
+
+    def _serve_query_lane(self):
+        socket = zmq.Context.instance().socket(zmq.REP)
+        socket.bind(self.query_addr)
+        try:
+            while not self._shutdown_requested.is_set():
+                if not socket.poll(100):
+                    continue
+                # Timed from receipt to send so decoding and encoding count too
+                frame = socket.recv()
+                start = self.clock()
+                try:
+                    request = json.loads(frame)
+                except ValueError as exc:
+                    response = {'error': f'malformed request: {exc}', 'data': None}
+                else:
+                    response = self._handle_query(request)
+                try:
+                    reply = self._encode_reply(response)
+                except Exception as exc:
+                    self.logger.exception('query lane request failed')
+                    reply = self.encoded_values.encode({'error': str(exc), 'data': None})
+                socket.send(reply)
+                self.lane_latency['query'].record(self.clock() - start)
+        finally:
+            socket.close(linger=0)
+
+    def _handle_query(self, request):
+        if not isinstance(request, dict):
+            return {'error': 'request is not an object', 'data': None}
+        operation = request.get('operation')
+        method = getattr(self, operation, None) if isinstance(operation, str) else None
+        if not getattr(method, '_fast_query', False):
+            return {'error': f'{operation!r} is not a query operation', 'data': None}
+        parameters = request.get('parameters') or {}
+        if not isinstance(parameters, dict):
+            return {'error': 'parameters are not an object', 'data': None}
+        try:
+            return method(**parameters)
+        except Exception as exc:
+            return {'error': str(exc), 'data': None}
+
+    def _encode_sends(self):
+        # Published updates and the replies on the request socket are encoded
+        # with the cached encodings like the query lane replies
+        for name, encode in [('update_socket', self.encoded_values.encode),
+                             ('request_socket', self._encode_reply)]:
+            socket = getattr(self, name, None)
+            if socket is not None and not isinstance(socket, EncodingSocket):
+                setattr(self, name, EncodingSocket(socket, encode))
+
+    def _encode_reply(self, reply):
+        # Replies sharing a snapshot, such as concurrent refreshes, share the
+        # encoding. Snapshots are never changed so the identity check is enough.
+        data = reply.get('data')
+        cached = self._encoded_reply
+        if (cached is not None and cached[0] is data
+                and cached[1] == reply.get('error')):
+            return cached[2]
+        encoded = self.encoded_values.encode(reply)
+        if isinstance(data, dict):
+            self._encoded_reply = (data, reply.get('error'), encoded)
+        return encoded
 
     def fetch_all_data(self):
-        self.robot.task_args.put('PSDC LMR')
-        poll(DELAY_TO_PROCESS)
+        self._awaiting_data = {(update, position) for update in DATA_DUMP_UPDATES
+                               for position in POSITIONS}
+        self._data_ready.clear()
+        self._request_data()
+
+    def _request_data(self):
+        self.robot.task_args.put('PSDC LMR', wait=True, timeout=PUT_TIMEOUT)
         self.robot.generic_command.put('DataRequest')
 
+    def _await_data(self):
+        """Request the data dump again if it doesn't arrive, then stop waiting."""
+        for retry in range(DATA_RETRIES + 1):
+            if self._data_ready.wait(DATA_TIMEOUT) or self._shutdown_requested.is_set():
+                return
+            missing = ', '.join(f'{update} {position}'
+                                for update, position in sorted(self._awaiting_data))
+            if retry < DATA_RETRIES:
+                self.logger.warning('data dump incomplete, requesting again: %s',
+                                    missing)
+                self._request_data()
+            else:
+                self.logger.error('data dump incomplete, ready without: %s', missing)
+        self._awaiting_data = set()
+        self._record_startup_phase('data_timeout')
+        self._data_ready.set()
+        self.ready = True
+
+    def _record_startup_phase(self, phase, when=None):
+        if not self._startup_times:
+            return
+        self._startup_times[phase] = self.clock() if when is None else when
+        start = self._startup_times['start']
+        timings = dict(self.startup_timings)
+        timings[phase] = self._startup_times[phase] - start
+        self.startup_timings = timings
+
+    def _data_received(self, update, position):
+        if not self._awaiting_data:
+            return
+        self._awaiting_data.discard((update, position))
+        if not self._awaiting_data and not self.ready:
+            self._record_startup_phase('data_received')
+            self.logger.info('ready: %r', self.startup_timings)
+            self._data_ready.set()
+            self.ready = True
+
+    def values_update(self, update):
+        if 'status' in update:
+            changes = self._status_changes(update['status'])
+            if changes:
+                update = dict(update, status_changes=changes,
+                              status_flags=status_flags(self._status))
+        # Updates are published in version order, so the lock is held until
+        # it is queued. The state file orders writes itself by version.
+        with self._version_lock:
+            self.state_version += 1
+            update = dict(update, state_version=self.state_version)
+            self._journal.append(update)
+            self._key_versions.update(dict.fromkeys(update, self.state_version))
+            self._state_changed.notify_all()
+            self.encoded_values.invalidate(update)
+            super().values_update(update)
+        if self.shared_state is not None:
+            self.shared_state.update(update)
+
+    def _publish_heartbeats(self):
+        # Heartbeats aren't versioned so idle servers don't fill the journal
+        while not self._shutdown_requested.wait(HEARTBEAT_INTERVAL):
+            # Read under the lock so the update of the version is already queued
+            with self._version_lock:
+                state_version = self.state_version
+            super().values_update({'heartbeat': {
+                'server_id': self.server_id,
+                'state_version': state_version,
+                'time': self.clock(),
+            }})
+
+    def _status_changes(self, status):
+        try:
+            status = int(status)
+        except (TypeError, ValueError):
+            return []
+        previous, self._status = self._status, status
+        return status_changes(previous, status)
+
+    def operation_update(self, handle, *args, **kwargs):
+        # Any user operation restarts the idle time, so maintenance doesn't
+        # start between eg a probe and the mount that follows it
+        self.maintenance_scheduler.record_activity(handle)
+        super().operation_update(handle, *args, **kwargs)
+
     def lock_motors(self):
         self.robot.goniometer_locked.put(True)
         if not self.motors_locked:
@@ -104,30 +434,56 @@ class RobotServerMX(RobotServer):
     # ******************************************************************
 
     def update_cassette_type(self, value, position, **_):
-        self.holder_types[position] = HolderType[value]
+        self._data_received('cassette_type', position)
+        self.holder_types = {**self.holder_types, position: HolderType[value]}
+        self.port_inventory.set_holder_type(position, self.holder_types[position])
         self.values_update({'holder_types': self.holder_types})
+        # The pucks the distances are compared within depend on the holder
+        self.screen_port_distances(position)
 
     def update_puck_states(self, value, position, start, **_):
+        self._data_received('puck_states', position)
         if not value:
             return
         end = start + len(value)
-        for slot, state in zip(SLOTS[start:end], value):
-            self.puck_states[position][slot] = state
+        pucks = {**self.puck_states[position], **dict(zip(SLOTS[start:end], value))}
+        self.puck_states = {**self.puck_states, position: pucks}
+        self.port_inventory.set_puck_states(position, self.puck_states[position])
         self.values_update({'puck_states': self.puck_states})
 
     def update_adaptor_puck_status(self, value, position, puck, **_):
-        self.puck_states[position][puck] = int(value)
+        pucks = {**self.puck_states[position], puck: int(value)}
+        self.puck_states = {**self.puck_states, position: pucks}
+        self.port_inventory.set_puck_states(position, self.puck_states[position])
         self.values_update({'puck_states': self.puck_states})
 
     def update_port_states(self, value, position, start, **_):
-        end = start + len(value)
-        self.port_states[position][start:end] = value
+        self._data_received('port_states', position)
+        self.port_states = _replace_ports(self.port_states, position, start, value)
+        self.port_inventory.update_ports(position, start, value)
         self.values_update({'port_states': self.port_states})
+        # Only full ports are screened
+        self.screen_port_distances(position)
 
     def update_sample_distances(self, value, position, start, **_):
+        self._data_received('sample_distances', position)
         end = start + len(value)
-        self.port_distances[position][start:end] = value
+        self.port_distances = _replace_ports(self.port_distances, position, start,
+                                             value)
         self.values_update({'port_distances': self.port_distances})
+        if end == PORTS_PER_POSITION:
+            self.screen_port_distances(position)
+
+    def screen_port_distances(self, position):
+        """Flag the ports of a position with distances unusual for their puck."""
+        anomalies = distance_anomalies(self.port_distances[position],
+                                       self.port_states[position],
+                                       self.holder_types[position])
+        if anomalies != self.port_anomalies[position]:
+            self.port_anomalies = {**self.port_anomalies, position: anomalies}
+            self.logger.info('%s ports with unusual distances: %d', position,
+                             sum(anomalies))
+            self.values_update({'port_anomalies': self.port_anomalies})
 
     def update_sample_locations(self, value, **_):
         self.sample_locations = value
@@ -142,55 +498,91 @@ class RobotServerMX(RobotServer):
     # ****************** High Level Operations *************************
     # ******************************************************************
 
+    @preempts_maintenance
     @foreground_operation
-    def mount(self, handle, position, column, port_num):
+    def mount(self, handle, position, column, port_num, force=False):
         self.logger.info(f'mount: {position} {column} {port_num}')
         port = Port(position, column, port_num)
-        try:
-            self.robot.set_auto_heat_cool_allowed(False)
-            self.lock_motors()
-            self._prepare_for_mount_and_make_safe(handle, port=port)
-            self.robot.mount(port)
-            self.free_motors()
-            self._undo_make_safe_and_finalise_robot(handle)
-        finally:
-            self.robot.set_auto_heat_cool_allowed(True)
-            self.free_motors()
-
+        self._check_ports(handle, port, force=force)
+        with self._timed_operation(handle, 'mount', **self._port_features(port)):
+            try:
+                self.robot.set_auto_heat_cool_allowed(False)
+                self.lock_motors()
+                self._prepare_for_mount_and_make_safe(handle, port=port)
+                self.robot.mount(port)
+                self.free_motors()
+                self._undo_make_safe_and_finalise_robot(handle)
+            finally:
+                self.robot.set_auto_heat_cool_allowed(True)
+                self.free_motors()
+
+    @preempts_maintenance
     @foreground_operation
     def mount_and_prefetch(self, handle, position, column, port_num,
-                           prefetch_position, prefetch_column, prefetch_port_num):
+                           prefetch_position, prefetch_column, prefetch_port_num,
+                           force=False):
         mount_port = Port(position, column, port_num)
         prefetch_port = Port(prefetch_position, prefetch_column, prefetch_port_num)
-        try:
-            self.robot.set_auto_heat_cool_allowed(False)
-            self.lock_motors()
-            self._prepare_for_mount_and_make_safe(handle, port=mount_port)
-            self.robot.mount(mount_port)
-            self.free_motors()
-            self._undo_make_safe_and_finalise_robot(handle, prefetch_port)
-        finally:
-            self.robot.set_auto_heat_cool_allowed(True)
-            self.free_motors()
-
+        self._check_ports(handle, mount_port, prefetch_port, force=force)
+        features = self._port_features(mount_port, prefetch=True)
+        with self._timed_operation(handle, 'mount_and_prefetch', **features):
+            try:
+                self.robot.set_auto_heat_cool_allowed(False)
+                self.lock_motors()
+                self._prepare_for_mount_and_make_safe(handle, port=mount_port)
+                self.robot.mount(mount_port)
+                self.free_motors()
+                self._undo_make_safe_and_finalise_robot(handle, prefetch_port)
+            finally:
+                self.robot.set_auto_heat_cool_allowed(True)
+                self.free_motors()
+
+    @preempts_maintenance
     @foreground_operation
     def dismount(self, handle):
+        return self._dismount(handle)
+
+    @preempts_maintenance
+    @foreground_operation
+    def dismount_and_prefetch(self, handle, prefetch_position, prefetch_column,
+                              prefetch_port_num, force=False):
+        prefetch_port = Port(prefetch_position, prefetch_column, prefetch_port_num)
+        self._check_ports(handle, prefetch_port, force=force)
+        return self._dismount(handle, prefetch_port)
+
+    def _dismount(self, handle, prefetch_port=None):
         port_code = self.robot.goniometer_sample.get().strip()
+        if not port_code and prefetch_port is not None:
+            # Nothing to dismount but the prefetch that was asked for still is
+            try:
+                self.robot.set_auto_heat_cool_allowed(False)
+                self.operation_update(handle, message='returning placer and prefetching')
+                self._prepare_and_prefetch(prefetch_port)
+                self.robot.go_to_standby()
+            finally:
+                self.robot.set_auto_heat_cool_allowed(True)
         if not port_code:
             return 'no sample mounted'
-        try:
-            self.robot.set_auto_heat_cool_allowed(False)
-            self.lock_motors()
-            port = Port.from_code(port_code)
-            self._prepare_for_mount_and_make_safe(handle)
-            self.operation_update(handle, message=f'dismounting {port}')
-            self.robot.dismount(port)
-            self.free_motors()
-            self._undo_make_safe_and_finalise_robot(handle)
-        finally:
-            self.robot.set_auto_heat_cool_allowed(True)
-            self.free_motors()
-
+        port = Port.from_code(port_code)
+        if prefetch_port is None:
+            operation, features = 'dismount', self._port_features(port)
+        else:
+            operation = 'dismount_and_prefetch'
+            features = self._port_features(port, prefetch=True)
+        with self._timed_operation(handle, operation, **features):
+            try:
+                self.robot.set_auto_heat_cool_allowed(False)
+                self.lock_motors()
+                self._prepare_for_mount_and_make_safe(handle)
+                self.operation_update(handle, message=f'dismounting {port}')
+                self.robot.dismount(port)
+                self.free_motors()
+                self._undo_make_safe_and_finalise_robot(handle, prefetch_port)
+            finally:
+                self.robot.set_auto_heat_cool_allowed(True)
+                self.free_motors()
+
+    @preempts_maintenance
     @foreground_operation
     def park_robot(self, handle, dismount):
         if not dismount:
@@ -206,16 +598,21 @@ class RobotServerMX(RobotServer):
             self.robot.set_auto_heat_cool_allowed(True)
             self.free_motors()
 
+    @preempts_maintenance
     @foreground_operation
-    def prefetch(self, handle, position, column, port_num):
-        try:
-            self.robot.set_auto_heat_cool_allowed(False)
-            self.robot.prepare_for_mount()
-            self.robot.prefetch(Port(position, column, port_num))
-            self.robot.go_to_standby()
-        finally:
-            self.robot.set_auto_heat_cool_allowed(True)
+    def prefetch(self, handle, position, column, port_num, force=False):
+        port = Port(position, column, port_num)
+        self._check_ports(handle, port, force=force)
+        with self._timed_operation(handle, 'prefetch', **self._port_features(port)):
+            try:
+                self.robot.set_auto_heat_cool_allowed(False)
+                self.robot.prepare_for_mount()
+                self.robot.prefetch(port)
+                self.robot.go_to_standby()
+            finally:
+                self.robot.set_auto_heat_cool_allowed(True)
 
+    @preempts_maintenance
     @foreground_operation
     def return_prefetch(self, handle):
         try:
@@ -226,16 +623,88 @@ class RobotServerMX(RobotServer):
         finally:
             self.robot.set_auto_heat_cool_allowed(True)
 
+    @contextmanager
+    def _timed_operation(self, handle, operation, **features):
+        """Publish an estimate of how long an operation will take while it runs.
+
+        The duration is recorded in the history if the operation succeeds.
+
+        """
+        eta = self.duration_history.estimate(operation, **features)
+        start = self.clock()
+        self.operation_eta = {'handle': handle, 'operation': operation, 'eta': eta,
+                              'started': start}
+        if eta is not None:
+            self.operation_update(handle, message=f'expected to take {eta:.0f} s')
+        try:
+            yield
+            self.duration_history.record(operation, self.clock() - start,
+                                         **features)
+        finally:
+            self.operation_eta = None
+
+    def _port_features(self, port, prefetch=False):
+        holder_type = self.holder_types.get(port.position, HolderType.unknown)
+        return {'prefetch': prefetch, 'holder_type': HolderType(holder_type).name,
+                'position': port.position, 'column': port.column}
+
+    def _check_ports(self, handle, *ports, force):
+        """Check ports against the cached state before any robot motion.
+
+        Raises ``RobotError`` if a port can't be mounted unless ``force`` is set,
+        in which case the problems are reported as operation updates instead.
+
+        """
+        problems, warnings = [], []
+        for port in ports:
+            port_problems, port_warnings = self._port_problems(port)
+            problems.extend(f'{port.code} {problem}' for problem in port_problems)
+            warnings.extend(f'{port.code} {warning}' for warning in port_warnings)
+        if problems and not force:
+            raise RobotError('preflight failed: ' + ', '.join(problems))
+        if problems:
+            warnings = problems + warnings
+            self.logger.warning('preflight overridden: %s', ', '.join(problems))
+        if warnings:
+            self.operation_update(handle, message='preflight: ' + ', '.join(warnings))
+
+    def _port_problems(self, port):
+        holder_type = self.holder_types.get(port.position, HolderType.unknown)
+        if holder_type == HolderType.unknown:
+            return ['holder type is unknown'], []
+        if not layout(holder_type).confirmed:
+            return ['is in a holder whose port index map is not confirmed'], []
+        try:
+            index = self.port_inventory.port_index(port.position, port.column,
+                                                   port.port_num)
+            state = self.port_states[port.position][index]
+        except (ValueError, IndexError):
+            return ['is not a valid port'], []
+        if state == PortState.empty:
+            return ['is empty'], []
+        if state == PortState.error:
+            return ['is in error'], []
+        for location, sample in self.sample_locations.items():
+            if sample and list(sample[:2]) == [port.position, index]:
+                return [f'sample is on the {location}'], []
+        if state == PortState.unknown:
+            return [], ['state is unknown']
+        if self.port_anomalies[port.position][index]:
+            return [], ['probed distance is unusual for its puck']
+        return [], []
+
     def _prepare_for_mount_and_make_safe(self, handle, *, port=None):
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            prepare_future = executor.submit(self._prepare_and_prefetch, port)
-            make_safe_future = executor.submit(self.make_safe.move_to_safe_position)
+        prepare_future = self.executor.submit(self._prepare_and_prefetch, port)
+        make_safe_future = self.executor.submit(self.make_safe.move_to_safe_position)
+        try:
             prepare_future.result()
-            try:
-                make_safe_future.result()
-            except MakeSafeFailed as exc:
-                self.robot.go_to_standby()
-                raise RobotError(f'make safe failed: {exc}') from exc
+        finally:
+            wait([make_safe_future])
+        try:
+            make_safe_future.result()
+        except MakeSafeFailed as exc:
+            self.robot.go_to_standby()
+            raise RobotError(f'make safe failed: {exc}') from exc
 
     def _prepare_and_prefetch(self, prefetch_port=None):
         self.robot.prepare_for_mount()
@@ -249,36 +718,43 @@ class RobotServerMX(RobotServer):
             self.operation_update(handle, message='going to standby position')
             self.robot.go_to_standby()
 
-        with ThreadPoolExecutor(max_workers=2) as executor:
-
-            undo_make_safe_future = executor.submit(self.make_safe.return_positions)
-            prefetch_and_go_standby_future = executor.submit(prefetch_and_go_standby)
+        undo_make_safe_future = self.executor.submit(self.make_safe.return_positions)
+        prefetch_and_go_standby_future = self.executor.submit(prefetch_and_go_standby)
 
-            try:
-                prefetch_and_go_standby_future.result()
-            except RobotError as exc:
-                robot_exc = exc
-            else:
-                robot_exc = None
+        try:
+            prefetch_and_go_standby_future.result()
+        except RobotError as exc:
+            robot_exc = exc
+        else:
+            robot_exc = None
+        finally:
+            wait([undo_make_safe_future])
 
-            try:
-                undo_make_safe_future.result()
-            except MakeSafeFailed as exc:
-                self.operation_update(handle, error=str(exc))
-                make_safe_exc = RobotError(f'undo make safe failed: {exc}')
-            else:
-                make_safe_exc = None
+        try:
+            undo_make_safe_future.result()
+        except MakeSafeFailed as exc:
+            self.operation_update(handle, error=str(exc))
+            make_safe_exc = RobotError(f'undo make safe failed: {exc}')
+        else:
+            make_safe_exc = None
 
-            final_exc = robot_exc or make_safe_exc
-            if final_exc:
-                raise final_exc
+        final_exc = robot_exc or make_safe_exc
+        if final_exc:
+            raise final_exc
 
     # ******************************************************************
     # ************************ Operations ******************************
     # ******************************************************************
 
+    @fast_query
     @query_operation
     def refresh(self):
+        return self._refresh_flight(self.state_version)
+
+    def state_snapshot(self):
+        """Return the current values of the whole state."""
+        # The version is read first so the state is at least as new as it
+        state_version = self.state_version
         state = self.robot.snapshot()
         for attr, obj in RobotServerMX.__dict__.items():
             if isinstance(obj, ServerAttr):
@@ -287,9 +763,84 @@ class RobotServerMX(RobotServer):
         state['holder_types'] = self.holder_types
         state['port_states'] = self.port_states
         state['port_distances'] = self.port_distances
+        state['port_anomalies'] = self.port_anomalies
         state['motors_locked'] = self.motors_locked
+        state['status_flags'] = status_flags(self._status)
+        state['server_id'] = self.server_id
+        state['state_version'] = state_version
         return state
 
+    @fast_query
+    @query_operation
+    def changes_since(self, version, server_id=None):
+        return self.state_changes(version, server_id)
+
+    def state_changes(self, version, server_id=None):
+        """Return the values that changed after ``version`` of the server state.
+
+        Falls back to the full state if ``server_id`` is from another server
+        process or the journal no longer goes back to ``version``.
+
+        """
+        with self._version_lock:
+            oldest = self._journal[0]['state_version'] if self._journal else 1
+            if server_id == self.server_id and oldest <= version + 1:
+                values = {}
+                # Versions in the journal are consecutive
+                for update in islice(self._journal, version + 1 - oldest, None):
+                    values.update(update)
+                # Replayed flag changes would fire client callbacks a second time
+                for key in EVENT_KEYS:
+                    values.pop(key, None)
+                values['state_version'] = self.state_version
+                return {'server_id': self.server_id, 'full': False, 'values': values}
+        return {'server_id': self.server_id, 'full': True,
+                'values': self.state_snapshot()}
+
+    def key_version(self, keys):
+        """Return the state version at which any of ``keys`` last changed."""
+        return max((self._key_versions.get(key, 0) for key in keys), default=0)
+
+    def wait_for_change(self, version, timeout=None):
+        """Wait until the state is newer than ``version`` and return if it is."""
+        with self._state_changed:
+            return self._state_changed.wait_for(lambda: self.state_version > version,
+                                                timeout)
+
+    @fast_query
+    @query_operation
+    def metrics(self):
+        return {
+            'publish_queue': self.publish_queue.stats(),
+            'encoding': self.encoded_values.stats(),
+            'refresh': self._refresh_flight.stats(),
+            'maintenance': self.maintenance_scheduler.stats(),
+            'lanes': {lane: tracker.stats()
+                      for lane, tracker in self.lane_latency.items()},
+        }
+
+    @fast_query
+    @query_operation
+    def ports_in_state(self, state, position=None):
+        inventory = self.port_inventory
+        codes = (inventory.port_code(pos, index)
+                 for pos, index in inventory.ports_in_state(_port_state(state), position))
+        return [code for code in codes if code is not None]
+
+    @fast_query
+    @query_operation
+    def puck_summary(self, position, puck):
+        return self.port_inventory.puck_summary(position, puck)
+
+    @fast_query
+    @query_operation
+    def next_port(self, after, state='full'):
+        inventory = self.port_inventory
+        port = Port.from_code(after)
+        index = inventory.port_index(port.position, port.column, port.port_num)
+        found = inventory.next_port(_port_state(state), port.position, index)
+        return inventory.port_code(*found) if found else None
+
     @background_operation
     def set_gripper(self, handle, value):
         self.robot.gripper_command.put(value)
@@ -309,8 +860,11 @@ class RobotServerMX(RobotServer):
     @foreground_operation
     def calibrate_toolset(self, handle, *, include_find_magnet, quick_mode):
         self.logger.debug('calibrate toolset: %r %r', include_find_magnet, quick_mode)
-        message = self.robot.calibrate_toolset(include_find_magnet=include_find_magnet,
-                                               quick_mode=quick_mode)
+        with self._timed_operation(handle, 'calibrate_toolset', quick_mode=quick_mode,
+                                   include_find_magnet=include_find_magnet):
+            message = self.robot.calibrate_toolset(
+                include_find_magnet=include_find_magnet, quick_mode=quick_mode,
+            )
         self.logger.info('calibrate message: %r', message)
         return message
 
@@ -318,7 +872,10 @@ class RobotServerMX(RobotServer):
     def calibrate_cassettes(self, handle, *, positions, initial):
         self.logger.debug('calibrate cassettes: %r %r', positions, initial)
         positions = [Position(p) for p in positions]
-        message = self.robot.calibrate_cassettes(positions=positions, initial=initial)
+        with self._timed_operation(handle, 'calibrate_cassettes', initial=initial,
+                                   positions=''.join(p.code for p in positions)):
+            message = self.robot.calibrate_cassettes(positions=positions,
+                                                     initial=initial)
         self.logger.info('calibrate message: %r', message)
         return message
 
@@ -336,16 +893,19 @@ class RobotServerMX(RobotServer):
     @foreground_operation
     def probe(self, handle, ports):
         self.logger.debug('probe ports: %r', ports)
-        self.set_probe_requests(ports)
-        poll(DELAY_TO_PROCESS)
-        message = self.robot.run_task('ProbeCassettes')
+        masks = self.set_probe_requests(ports)
+        self.sleep(DELAY_TO_PROCESS)
+        port_count = sum(bin(mask).count('1') for mask in masks.values())
+        with self._timed_operation(handle, 'probe', ports=port_count):
+            message = self.robot.run_task('ProbeCassettes')
         self.logger.info('probe message: %r', message)
         return message
 
     @foreground_operation
     def dry_and_cool(self, handle):
         self.logger.debug('dry_and_cool')
-        message = self.robot.dry_and_cool()
+        with self._timed_operation(handle, 'dry_and_cool'):
+            message = self.robot.dry_and_cool()
         self.logger.info('dry_and_cool message: %r', message)
         return message
 
@@ -370,7 +930,7 @@ class RobotServerMX(RobotServer):
     @background_operation
     def reset_ports(self, handle, ports):
         self.set_probe_requests(ports)
-        poll(DELAY_TO_PROCESS)
+        self.sleep(DELAY_TO_PROCESS)
         message = self.robot.run_task('ResetCassettePorts')
         self.logger.info('message: %r', message)
         return message
@@ -388,41 +948,54 @@ class RobotServerMX(RobotServer):
         task_args = '{} {}'.format(location, port_code)
         self.robot.run_background_task('SetSampleStatus', task_args)
 
+    @background_operation
+    def start_profiling(self, handle, duration, path=None, interval=0.005):
+        if path is not None:
+            # Paths come from clients so they can only name a file in profile_dir
+            name = os.path.basename(path)
+            if name != path or name in ('', '.', '..'):
+                raise RobotError(f'profile path must be a file name: {path!r}')
+            path = os.path.join(self.profile_dir, name)
+        try:
+            path = profiler.start(duration=duration, path=path, interval=interval,
+                                  directory=self.profile_dir)
+        except RuntimeError as exc:
+            raise RobotError(str(exc)) from exc
+        self.logger.info('profiling for %ss to %s', duration, path)
+        return f'profiling to {path}'
+
+    @background_operation
+    def stop_profiling(self, handle):
+        try:
+            path = profiler.stop()
+        except RuntimeError as exc:
+            raise RobotError(str(exc)) from exc
+        self.logger.info('profile written to %s', path)
+        return f'profile written to {path}'
+
+    @background_operation
+    def memory_snapshot(self, handle, limit=10):
+        return '\n'.join(tracemalloc_summary(limit))
+
     # ******************************************************************
     # ********************* Helper methods *****************************
     # ******************************************************************
 
     def set_probe_requests(self, ports):
+        masks = port_masks(ports, self.holder_types)
         for position in ['left', 'middle', 'right']:
-            position_ports = ports.get(position, [])
-            position_ports_str = ''.join(str(p) for p in position_ports)
+            request = layout(self.holder_types[position]).probe_request(masks[position])
             pv = getattr(self.robot, '{pos}_probe_request'.format(pos=position))
-            pv.put(position_ports_str)
-
-
-class Port(NamedTuple):
-
-    position: str
-    column: str
-    port_num: int
-
-    @property
-    def code(self):
-        return f'{self.position[0]} {self.column} {self.port_num}'.upper()
-
-    @classmethod
-    def from_code(cls, code):
-        pos_char, column, port_num = code.split(' ')
-        position = {'l': 'left', 'r': 'right', 'm': 'middle'}[pos_char.lower()]
-        return cls(position, column, int(port_num))
+            pv.put(request)
+        return masks
 
 
-class Position(Enum):
+def _port_state(state):
+    return PortState[state] if isinstance(state, str) else PortState(state)
 
-    LEFT = 'left'
-    MIDDLE = 'middle'
-    RIGHT = 'right'
 
-    @property
-    def code(self):
-        return self.value[0]
+def _replace_ports(table, position, start, values):
+    """Return a copy of a table of ports by position with ports replaced."""
+    ports = list(table[position])
+    ports[start:start + len(values)] = values
+    return {**table, position: ports}
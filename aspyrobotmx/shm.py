@@ -0,0 +1,238 @@
+import logging
+import math
+import mmap
+import os
+import struct
+from threading import Lock
+import time
+
+from .layout import PORTS_PER_POSITION, PUCKS as SLOTS
+
+
+MAGIC = b'AMXS'
+FORMAT_VERSION = 1
+POSITIONS = ['left', 'middle', 'right']
+# Magic, format version and sequence number
+HEADER = struct.Struct('<4sIQ')
+SEQUENCE_OFFSET = 8
+NUMERIC_KEYS = [
+    'status', 'at_home', 'motors_on', 'motors_on_command', 'toolset',
+    'foreground_done', 'safety_gate', 'closest_point', 'lid_open', 'lid_closed',
+    'lid_command', 'gripper_open', 'gripper_closed', 'gripper_command', 'heater_hot',
+    'heater_command', 'heater_air_command', 'ln2_level', 'pins_mounted', 'pins_lost',
+    'dumbbell_state', 'motors_locked', 'ready', 'state_version',
+]
+# Text values and the bytes reserved for each, longer values are truncated
+TEXT_KEYS = {
+    'model': 64, 'time': 64, 'current_task': 64, 'task_message': 256,
+    'task_progress': 64, 'mount_message': 256, 'picker_sample': 32,
+    'placer_sample': 32, 'cavity_sample': 32, 'goniometer_sample': 32,
+    'last_toolset_calibration': 64, 'last_left_calibration': 64,
+    'last_middle_calibration': 64, 'last_right_calibration': 64,
+    'last_goniometer_calibration': 64,
+}
+# Stored in place of numeric values that are None
+MISSING = -2 ** 63
+SLOT_INDEXES = {slot: index for index, slot in enumerate(SLOTS)}
+
+
+def _regions():
+    regions = {}
+    offset = HEADER.size
+    sizes = [
+        ('holder_types', 'b', len(POSITIONS)),
+        ('puck_states', 'b', len(POSITIONS) * len(SLOTS)),
+        ('port_states', 'b', len(POSITIONS) * PORTS_PER_POSITION),
+        ('port_distances', 'd', len(POSITIONS) * PORTS_PER_POSITION),
+        ('numeric', 'q', len(NUMERIC_KEYS)),
+    ]
+    sizes.extend((key, 's', size) for key, size in TEXT_KEYS.items())
+    for name, code, count in sizes:
+        item_size = struct.calcsize(code)
+        offset += -offset % item_size
+        regions[name] = (offset, struct.Struct(f'<{count}{code}'))
+        offset += regions[name][1].size
+    return regions, offset
+
+
+REGIONS, SIZE = _regions()
+
+
+class SharedStateWriter:
+    """
+    Writes the robot state to a memory mapped file that processes on the same
+    host can read with `SharedStateReader` instead of subscribing to updates.
+
+    Writes are protected by a sequence lock: the sequence number in the header
+    is odd while a write is in progress and readers retry if it changed while
+    they read. An existing file is reused so readers keep their mapping when
+    the server restarts.
+
+    Updates with a ``state_version`` may be written in any order: a value is
+    skipped if the file already has a newer one for its key.
+
+    """
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger(__name__)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SIZE)
+            self._map = mmap.mmap(fd, SIZE)
+        finally:
+            os.close(fd)
+        self._lock = Lock()
+        self._versions = {}
+        magic, version, sequence = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT_VERSION or sequence % 2:
+            HEADER.pack_into(self._map, 0, MAGIC, FORMAT_VERSION, 0)
+        self._sequence = HEADER.unpack_from(self._map)[2]
+        self._numeric = list(self._read('numeric'))
+        self._tables = {name: list(self._read(name))
+                        for name in ['holder_types', 'puck_states', 'port_states',
+                                     'port_distances']}
+
+    def update(self, values):
+        """Write the values of a values update or refresh that are in the file."""
+        version = values.get('state_version')
+        with self._lock:
+            if version is not None:
+                values = {key: value for key, value in values.items()
+                          if self._versions.get(key, -1) < version}
+                self._versions.update(dict.fromkeys(values, version))
+            tables = [name for name in self._tables if name in values]
+            numeric = [key for key in NUMERIC_KEYS if key in values]
+            text = [key for key in TEXT_KEYS if key in values]
+            if not (tables or numeric or text):
+                return
+            self._set_sequence(self._sequence + 1)
+            for name in tables:
+                self._write(name, self._table(name, values[name]))
+            if numeric:
+                for key in numeric:
+                    self._numeric[NUMERIC_KEYS.index(key)] = _number(values[key])
+                self._write('numeric', self._numeric)
+            for key in text:
+                value = values[key]
+                encoded = b'' if value is None else str(value).encode()
+                self._write(key, [encoded[:TEXT_KEYS[key]]])
+            self._set_sequence(self._sequence + 1)
+
+    def close(self):
+        self._map.close()
+
+    def _table(self, name, value):
+        table = self._tables[name]
+        for number, position in enumerate(POSITIONS):
+            if position not in value:
+                continue
+            if name == 'holder_types':
+                table[number] = int(value[position])
+            elif name == 'puck_states':
+                for slot, state in value[position].items():
+                    # Pucks the file has no room for, eg from a newer holder
+                    if slot not in SLOT_INDEXES:
+                        self.logger.warning('no %s puck %r in the state file',
+                                            position, slot)
+                        continue
+                    table[number * len(SLOTS) + SLOT_INDEXES[slot]] = int(state)
+            else:
+                start = number * PORTS_PER_POSITION
+                convert = _distance if name == 'port_distances' else int
+                table[start:start + PORTS_PER_POSITION] = [
+                    convert(port) for port in value[position]
+                ]
+        return table
+
+    def _read(self, name):
+        offset, layout = REGIONS[name]
+        return layout.unpack_from(self._map, offset)
+
+    def _write(self, name, values):
+        offset, layout = REGIONS[name]
+        layout.pack_into(self._map, offset, *values)
+
+    def _set_sequence(self, sequence):
+        self._sequence = sequence
+        struct.pack_into('<Q', self._map, SEQUENCE_OFFSET, sequence)
+
+
+class SharedStateReader:
+    """
+    Reads the robot state written by a `RobotServerMX` started with a
+    ``state_file``.
+
+    Example:
+        reader = SharedStateReader('/dev/shm/aspyrobotmx-SR03ID01')
+        state = reader.read()
+        state['port_states']['left'][0]
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), SIZE, access=mmap.ACCESS_READ)
+        magic, version, _ = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a version {FORMAT_VERSION} state file')
+
+    @property
+    def sequence(self):
+        """Sequence number of the state, which changes with every write."""
+        return struct.unpack_from('<Q', self._map, SEQUENCE_OFFSET)[0]
+
+    def read(self, retries=1000):
+        """Return a consistent copy of the state.
+
+        Raises:
+            TimeoutError: If the state kept changing for ``retries`` attempts
+
+        """
+        for _ in range(retries):
+            before = self.sequence
+            if not before % 2:
+                raw = {name: layout.unpack_from(self._map, offset)
+                       for name, (offset, layout) in REGIONS.items()}
+                if self.sequence == before:
+                    return _decode(raw)
+            # Let a writer in this process finish rather than spinning on the GIL
+            time.sleep(0)
+        raise TimeoutError(f'state in {self.path} kept changing')
+
+    def close(self):
+        self._map.close()
+
+
+def _decode(raw):
+    state = {
+        'holder_types': dict(zip(POSITIONS, raw['holder_types'])),
+        'puck_states': {
+            position: dict(zip(SLOTS, raw['puck_states'][number * len(SLOTS):
+                                                         (number + 1) * len(SLOTS)]))
+            for number, position in enumerate(POSITIONS)
+        },
+    }
+    for name in ['port_states', 'port_distances']:
+        state[name] = {
+            position: list(raw[name][number * PORTS_PER_POSITION:
+                                     (number + 1) * PORTS_PER_POSITION])
+            for number, position in enumerate(POSITIONS)
+        }
+    for ports in state['port_distances'].values():
+        ports[:] = [None if math.isnan(port) else port for port in ports]
+    for key, value in zip(NUMERIC_KEYS, raw['numeric']):
+        state[key] = None if value == MISSING else value
+    for key in TEXT_KEYS:
+        state[key] = raw[key][0].rstrip(b'\0').decode(errors='replace')
+    return state
+
+
+def _number(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MISSING
+
+
+def _distance(value):
+    return math.nan if value is None else float(value)
@@ -0,0 +1,80 @@
+from threading import Event, Lock
+import time
+
+
+class SingleFlight:
+    """
+    Memoizes a function so concurrent callers share one call, for expensive
+    reads that many clients make at once, such as ``refresh`` when every client
+    reconnects after the server restarts.
+
+    A caller that arrives while a call for the same key is running waits for
+    its result. A result is reused by later callers for ``ttl`` seconds as long
+    as the key they pass is the one it was computed for. Callers with a
+    different key, such as a newer state version, make their own call.
+
+    Args:
+        func: Function of no arguments to memoize.
+        ttl (float): Seconds a result is reused for. Zero to only share calls
+            that are running.
+        clock: Function returning monotonic seconds.
+
+    """
+    def __init__(self, func, ttl, clock=time.monotonic):
+        self.func = func
+        self.ttl = ttl
+        self.clock = clock
+        self.calls = 0
+        self.computed = 0
+        self.shared = 0
+        self.cached = 0
+        self._result = None
+        self._flights = {}
+        self._lock = Lock()
+
+    def __call__(self, key=None):
+        with self._lock:
+            self.calls += 1
+            result = self._result
+            if (result is not None and result['key'] == key
+                    and self.clock() - result['time'] <= self.ttl):
+                self.cached += 1
+                return result['value']
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = {'done': Event()}
+                self.computed += 1
+            else:
+                self.shared += 1
+        if not leader:
+            flight['done'].wait()
+            if 'error' in flight:
+                raise flight['error']
+            return flight['value']
+        try:
+            flight['value'] = self.func()
+        except Exception as exc:
+            flight['error'] = exc
+            raise
+        else:
+            with self._lock:
+                self._result = {'key': key, 'time': self.clock(),
+                                'value': flight['value']}
+            return flight['value']
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight['done'].set()
+
+    def clear(self):
+        """Stop reusing the last result."""
+        with self._lock:
+            self._result = None
+
+    def stats(self):
+        with self._lock:
+            calls = self.calls
+            hits = self.shared + self.cached
+            return {'calls': calls, 'computed': self.computed, 'shared': self.shared,
+                    'cached': self.cached, 'hit_rate': hits / calls if calls else None}
@@ -0,0 +1,52 @@
+from concurrent.futures import Executor, Future
+from threading import Lock
+
+
+class VirtualClock:
+    """
+    Clock for the ``clock`` and ``sleep`` arguments of ``RobotServerMX`` in
+    which time only passes when something sleeps, so tests of operations with
+    delays run instantly and always see the same times.
+
+    Example:
+        clock = VirtualClock()
+        server = RobotServerMX(robot, make_safe=make_safe, clock=clock,
+                               sleep=clock.sleep, executor=ImmediateExecutor())
+
+    """
+    def __init__(self, start=0.):
+        self.now = start
+        self.sleeps = []
+        self._lock = Lock()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        """Record a sleep and move time forward by ``seconds``."""
+        with self._lock:
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+    def advance(self, seconds):
+        """Move time forward by ``seconds`` without recording a sleep."""
+        with self._lock:
+            self.now += seconds
+
+
+class ImmediateExecutor(Executor):
+    """
+    Executor that runs each function in the submitting thread as soon as it is
+    submitted. The parallel phases of operations then run one after another in
+    the order they are submitted, without any threads.
+
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+        return future
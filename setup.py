@@ -14,13 +14,22 @@ setup(
     packages=['aspyrobotmx'],
     install_requires=[
         'aspyrobot',
-        'requests',
+        'pyzmq',
         'click',
-        'colorlog',
     ],
+    extras_require={
+        'server': [
+            'pyepics',
+            'requests',
+            'colorlog',
+            'numpy',
+        ],
+    },
     entry_points={
         'console_scripts': [
-            'pyrobotmxserver=aspyrobotmx.cmd:run_server'
+            'pyrobotmxserver=aspyrobotmx.cmd:run_server',
+            'pyrobotmxrelay=aspyrobotmx.cmd:run_relay',
+            'pyrobotmxloadtest=aspyrobotmx.cmd:run_loadtest',
         ],
     },
 )
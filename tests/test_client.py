@@ -2,6 +2,7 @@ from unittest.mock import MagicMock, call
 
 import pytest
 
+from aspyrobot import RobotClient
 from aspyrobotmx import RobotClientMX
 from aspyrobotmx.server import Position
 
@@ -73,3 +74,165 @@ def test_calibrate_goniometer(client):
     client.calibrate_goniometer(False)
     assert client.run_operation.call_args == call('calibrate_goniometer',
                                                   initial=False, callback=None)
+
+
+def test_dismount_and_prefetch(client):
+    client.dismount_and_prefetch('right', 'B', 2)
+    assert client.run_operation.call_args == call(
+        'dismount_and_prefetch', prefetch_position='right', prefetch_column='B',
+        prefetch_port_num=2, force=False, callback=None,
+    )
+
+
+def test_ports_in_state(client):
+    client.ports_in_state('full', 'left')
+    assert client.run_operation.call_args == call('ports_in_state',
+                                                  state='full', position='left')
+
+
+def test_next_port(client):
+    client.next_port('L A 5')
+    assert client.run_operation.call_args == call('next_port', after='L A 5',
+                                                  state='full')
+
+
+def test_status_flag_callbacks(client):
+    callback = MagicMock()
+    client.add_status_flag_callback('reason_port_jam', callback)
+    client.status_changes = [{'flag': 'reason_estop', 'set': True},
+                             {'flag': 'reason_port_jam', 'set': True}]
+    assert callback.call_args_list == [call('reason_port_jam', True)]
+
+
+def test_queries_use_request_socket_without_query_lane(client):
+    client.metrics()
+    assert client.run_operation.call_args == call('metrics')
+
+
+def test_refresh_uses_query_lane(mocker):
+    refresh = mocker.patch.object(RobotClient, 'refresh')
+    client = RobotClientMX(update_addr=UPDATE_ADDR, request_addr=REQUEST_ADDR,
+                           query_addr='tcp://127.0.0.1:13002')
+    client.query = MagicMock(return_value={'error': None, 'data': {'pins_mounted': 4}})
+    client.refresh()
+    assert client.query.call_args == call('refresh')
+    assert client.pins_mounted == 4
+    assert refresh.called is False
+
+
+def test_start_profiling(client):
+    client.start_profiling(10, 'profile.folded')
+    assert client.run_operation.call_args == call('start_profiling', duration=10,
+                                                  path='profile.folded',
+                                                  callback=None)
+
+
+def test_close_closes_the_request_sockets(client):
+    client.request_socket = MagicMock()
+    query_socket = client._sockets['query'] = MagicMock()
+    client.close()
+    assert client.request_socket.close.call_args == call(linger=0)
+    assert query_socket.close.call_args == call(linger=0)
+    assert client._watchdog_stop.is_set()
+
+
+@pytest.fixture
+def connected_client(mocker):
+    mocker.patch.object(RobotClient, 'run_operation',
+                        return_value={'handle': 7, 'error': None})
+    mocker.patch('aspyrobotmx.client.RESYNC_JITTER', 0)
+    client = RobotClientMX(update_addr=UPDATE_ADDR, request_addr=REQUEST_ADDR)
+    client.server_id = 'server-a'
+    client.state_version = 3
+    client.connected = True
+    client.heartbeat = {'server_id': 'server-a', 'state_version': 3, 'time': 0}
+    return client
+
+
+def test_pending_operations_are_told_when_connection_is_lost(connected_client):
+    client = connected_client
+    callback = MagicMock()
+    client.run_operation('mount', callback=callback, position='left')
+    client._check_connection()
+    assert client.connected is True
+    assert callback.called is False
+    client._last_heartbeat -= client.heartbeat_timeout + 1
+    client._check_connection()
+    assert client.connected is False
+    assert callback.call_args == call(handle=7, stage='end', message=None,
+                                      error='lost connection to server')
+
+
+def test_finished_operations_arent_reported_lost(connected_client):
+    client = connected_client
+    callback = MagicMock()
+    client.run_operation('set_lid', callback=callback, value=1)
+    tracked_callback = RobotClient.run_operation.call_args[1]['callback']
+    tracked_callback(handle=7, stage='end', message=None, error=None)
+    client._last_heartbeat -= client.heartbeat_timeout + 1
+    client._check_connection()
+    assert callback.call_count == 1
+
+
+def test_lost_operations_ignore_later_updates(connected_client):
+    client = connected_client
+    callback = MagicMock()
+    client.run_operation('mount', callback=callback, position='left')
+    tracked_callback = RobotClient.run_operation.call_args[1]['callback']
+    client._last_heartbeat -= client.heartbeat_timeout + 1
+    client._check_connection()
+    tracked_callback(handle=7, stage='end', message=None, error=None)
+    assert callback.call_count == 1
+    assert callback.call_args[1]['error'] == 'lost connection to server'
+
+
+def test_sockets_are_replaced_when_connection_is_lost(connected_client):
+    client = connected_client
+    socket = MagicMock()
+    client._sockets['resync'] = socket
+    client._last_heartbeat -= client.heartbeat_timeout + 1
+    client._check_connection()
+    assert socket.close.call_args == call(linger=0)
+    assert client._sockets == {}
+
+
+def test_client_resyncs_when_updates_are_missed(connected_client):
+    client = connected_client
+    client._request = MagicMock(return_value={'error': None, 'data': {
+        'server_id': 'server-a', 'full': False,
+        'values': {'pins_mounted': 5, 'state_version': 6},
+    }})
+    client.heartbeat = {'server_id': 'server-a', 'state_version': 6, 'time': 1}
+    client._check_connection()
+    assert client._request.call_args == call('resync', REQUEST_ADDR, 'changes_since',
+                                             version=3, server_id='server-a')
+    assert RobotClient.run_operation.called is False
+    assert client.pins_mounted == 5
+    assert client.state_version == 6
+
+
+def test_client_resyncs_from_before_dropped_updates(connected_client):
+    client = connected_client
+    client._request = MagicMock(return_value={'error': None, 'data': {
+        'server_id': 'server-a', 'full': False, 'values': {'state_version': 3},
+    }})
+    client.updates_dropped = {'since': 1}
+    client._check_connection()
+    assert client._request.call_args == call('resync', REQUEST_ADDR, 'changes_since',
+                                             version=1, server_id='server-a')
+    client._check_connection()
+    assert client._request.call_count == 1
+
+
+def test_client_resyncs_after_server_restart(connected_client):
+    client = connected_client
+    callback = MagicMock()
+    client.run_operation('mount', callback=callback, position='left')
+    client._request = MagicMock(return_value={'error': None, 'data': {
+        'server_id': 'server-b', 'full': True, 'values': {'state_version': 1},
+    }})
+    client.heartbeat = {'server_id': 'server-b', 'state_version': 1, 'time': 1}
+    client._check_connection()
+    assert callback.call_args[1]['error'] == 'server restarted'
+    assert client.server_id == 'server-b'
+    assert client.state_version == 1
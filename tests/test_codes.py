@@ -0,0 +1,29 @@
+from aspyrobotmx.codes import RobotStatus, decode_status, status_flags, status_changes
+
+
+def test_decode_status():
+    status = (RobotStatus.need_reset | RobotStatus.reason_port_jam
+              | RobotStatus.reason_abort | RobotStatus.in_manual)
+    assert decode_status(status) == {
+        'need': ('need_reset',),
+        'reason': ('reason_port_jam', 'reason_abort'),
+        'in': ('in_manual',),
+    }
+
+
+def test_decode_status_ignores_group_masks():
+    assert status_flags(RobotStatus.need_all) == (
+        'need_clear', 'need_reset', 'need_cal_magnet', 'need_cal_cassette',
+        'need_cal_gonio', 'need_cal_basic', 'need_user_action',
+    )
+    assert len(status_flags(0xffffffff)) == 32
+
+
+def test_status_changes():
+    old = RobotStatus.reason_estop | RobotStatus.in_tool
+    new = RobotStatus.reason_port_jam | RobotStatus.in_tool
+    assert status_changes(old, new) == [
+        {'flag': 'reason_port_jam', 'set': True},
+        {'flag': 'reason_estop', 'set': False},
+    ]
+    assert status_changes(new, new) == []
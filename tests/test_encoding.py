@@ -0,0 +1,59 @@
+import json
+import time
+from unittest.mock import MagicMock
+
+from aspyrobotmx.encoding import EncodedValueCache, EncodingSocket
+
+
+def test_encoding_matches_json():
+    cache = EncodedValueCache()
+    values = {'port_states': {'left': [-1, 0, 1]}, 'pins_mounted': 3, 'model': None}
+    cache.invalidate(values)
+    reply = {'error': None, 'data': values}
+    assert json.loads(cache.encode(reply)) == reply
+
+
+def test_encodings_are_reused_until_invalidated():
+    cache = EncodedValueCache()
+    port_states = {'left': [0] * 96}
+    cache.invalidate({'port_states': port_states})
+    cache.encode({'port_states': port_states})
+    cache.encode({'port_states': port_states})
+    assert (cache.hits, cache.misses) == (1, 1)
+    port_states['left'][0] = -1
+    cache.invalidate({'port_states': port_states})
+    encoded = cache.encode({'port_states': port_states})
+    assert json.loads(encoded)['port_states']['left'][0] == -1
+
+
+def test_cached_encoding_is_only_used_for_same_object():
+    cache = EncodedValueCache()
+    cache.invalidate({'port_states': {'left': [0]}})
+    cache.encode({'port_states': {'left': [0]}})
+    assert json.loads(cache.encode({'port_states': {'left': [1]}})) == {
+        'port_states': {'left': [1]},
+    }
+
+
+def test_worker_encodes_updates():
+    cache = EncodedValueCache()
+    cache.start()
+    try:
+        table = [1.5] * 96
+        cache.invalidate({'port_distances': table})
+        deadline = time.monotonic() + 1
+        while not cache.stats()['cached'] and time.monotonic() < deadline:
+            time.sleep(.001)
+        cache.encode({'port_distances': table})
+        assert cache.hits == 1
+    finally:
+        cache.stop()
+
+
+def test_encoding_socket_sends_encoded_bytes():
+    socket = MagicMock()
+    wrapped = EncodingSocket(socket, encode=lambda message: b'encoded')
+    wrapped.send_json({'error': None, 'data': {}})
+    assert socket.send.call_args[0] == (b'encoded', 0)
+    wrapped.recv_json()
+    assert socket.recv_json.called is True
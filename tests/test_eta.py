@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from aspyrobotmx.eta import DurationHistory
+
+
+def test_estimate_is_none_without_history():
+    history = DurationHistory()
+    assert history.estimate('mount', position='left') is None
+
+
+def test_estimate_is_median_of_matching_durations():
+    history = DurationHistory(min_samples=3)
+    for duration in [10, 30, 20]:
+        history.record('mount', duration, holder_type='normal', position='left')
+    assert history.estimate('mount', holder_type='normal', position='left') == 20
+
+
+def test_estimate_falls_back_to_less_specific_features():
+    history = DurationHistory(min_samples=3)
+    for duration in [10, 20, 30]:
+        history.record('mount', duration, holder_type='normal', position='left')
+    history.record('mount', 100, holder_type='normal', position='right')
+    estimate = history.estimate('mount', holder_type='normal', position='right')
+    assert estimate == 25
+    assert history.estimate('mount', holder_type='puck', position='right') == 25
+
+
+def test_estimate_uses_few_samples_when_nothing_else():
+    history = DurationHistory(min_samples=3)
+    history.record('dry_and_cool', 60)
+    assert history.estimate('dry_and_cool') == 60
+
+
+def test_max_samples_keeps_recent_durations():
+    history = DurationHistory(max_samples=2, min_samples=1)
+    for duration in [100, 10, 20]:
+        history.record('prefetch', duration)
+    assert history.estimate('prefetch') == 15
+
+
+def test_history_is_persisted(tmpdir):
+    path = str(tmpdir.join('durations.jsonl'))
+    history = DurationHistory(path, min_samples=1)
+    history.record('mount', 12.5, position='left')
+    with open(path) as file:
+        record = json.loads(file.readline())
+    assert record['features'] == {'position': 'left'}
+    assert DurationHistory(path, min_samples=1).estimate('mount', position='left') \
+        == pytest.approx(12.5)
+
+
+def test_corrupt_lines_are_skipped(tmpdir):
+    path = tmpdir.join('durations.jsonl')
+    path.write('not json\n{"operation": "mount", "duration": 5, "features": {}}\n')
+    assert DurationHistory(str(path), min_samples=1).estimate('mount') == 5
+
+
+def test_history_is_compacted_when_loaded(tmpdir):
+    path = tmpdir.join('durations.jsonl')
+    history = DurationHistory(str(path), max_samples=2)
+    for duration in [100, 10, 20]:
+        history.record('mount', duration, position='left')
+    history.record('mount', 30, position='right')
+    path.write('not json\n', mode='a')
+    history = DurationHistory(str(path), max_samples=2, min_samples=1)
+    durations = [json.loads(line)['duration'] for line in path.readlines()]
+    assert durations == [10, 20, 30]
+    assert history.estimate('mount', position='left') == 15
+    assert history.estimate('mount') == 25
@@ -0,0 +1,145 @@
+import json
+from threading import Condition
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from aspyrobotmx.gateway import StateGateway
+
+
+class StateSource:
+
+    server_id = 'abc'
+
+    def __init__(self):
+        self.state = {'state_version': 2, 'lid_open': 1,
+                      'port_states': {'left': [0] * 96}}
+        self.key_versions = {'lid_open': 1, 'port_states': 2}
+        self.changed = Condition()
+
+    @property
+    def state_version(self):
+        return self.state['state_version']
+
+    def update(self, values):
+        with self.changed:
+            self.state.update(values, state_version=self.state_version + 1)
+            for key in values:
+                self.key_versions[key] = self.state_version
+            self.last_update = values
+            self.changed.notify_all()
+
+    def state_snapshot(self):
+        return dict(self.state)
+
+    def state_changes(self, version, server_id=None):
+        if server_id == self.server_id and version == self.state_version - 1:
+            values = dict(self.last_update, state_version=self.state_version)
+            return {'server_id': self.server_id, 'full': False, 'values': values}
+        return {'server_id': self.server_id, 'full': True,
+                'values': self.state_snapshot()}
+
+    def key_version(self, keys):
+        return max((self.key_versions.get(key, 0) for key in keys), default=0)
+
+    def wait_for_change(self, version, timeout=None):
+        with self.changed:
+            return self.changed.wait_for(lambda: self.state_version > version, timeout)
+
+
+@pytest.fixture
+def source():
+    return StateSource()
+
+
+@pytest.fixture
+def url(source):
+    gateway = StateGateway(source, ('127.0.0.1', 0))
+    host, port = gateway.start()
+    yield f'http://{host}:{port}'
+    gateway.shutdown()
+
+
+def get(url, **headers):
+    return urlopen(Request(url, headers=headers), timeout=2)
+
+
+def test_resource_is_served_with_etag(url):
+    with get(url + '/ports') as response:
+        assert response.headers['ETag'] == '"abc-2"'
+        assert json.loads(response.read()) == {'port_states': {'left': [0] * 96}}
+
+
+def test_unchanged_resource_is_not_modified(url, source):
+    with pytest.raises(HTTPError) as error:
+        get(url + '/ports', **{'If-None-Match': '"abc-2"'})
+    assert error.value.code == 304
+    source.update({'lid_open': 0})
+    with pytest.raises(HTTPError) as error:
+        get(url + '/ports', **{'If-None-Match': '"abc-2"'})
+    assert error.value.code == 304
+
+
+def test_changed_resource_is_sent_again(url, source):
+    source.update({'port_states': {'left': [1] * 96}})
+    with get(url + '/ports', **{'If-None-Match': '"abc-2"'}) as response:
+        assert response.headers['ETag'] == '"abc-3"'
+        assert json.loads(response.read())['port_states']['left'][0] == 1
+
+
+def test_state_resource_serves_everything(url):
+    with get(url + '/state') as response:
+        assert response.headers['ETag'] == '"abc-2"'
+        assert json.loads(response.read())['lid_open'] == 1
+
+
+def test_unknown_resource_is_not_found(url):
+    with pytest.raises(HTTPError) as error:
+        get(url + '/nothing')
+    assert error.value.code == 404
+
+
+def read_event(response):
+    lines = []
+    while True:
+        line = response.readline().decode().rstrip('\n')
+        if not line:
+            return dict(line.split(': ', 1) for line in lines)
+        lines.append(line)
+
+
+def test_events_start_with_full_state_then_send_changes(url, source):
+    with get(url + '/events') as response:
+        assert response.headers['Content-Type'] == 'text/event-stream'
+        event = read_event(response)
+        assert event['event'] == 'state'
+        assert event['id'] == 'abc-2'
+        assert json.loads(event['data'])['lid_open'] == 1
+        source.update({'lid_open': 0})
+        event = read_event(response)
+        assert event['event'] == 'values'
+        assert event['id'] == 'abc-3'
+        assert json.loads(event['data']) == {'lid_open': 0, 'state_version': 3}
+
+
+def test_events_resume_from_last_event_id(url, source):
+    source.update({'lid_open': 0})
+    with get(url + '/events', **{'Last-Event-ID': 'abc-2'}) as response:
+        event = read_event(response)
+        assert event['event'] == 'values'
+        assert json.loads(event['data']) == {'lid_open': 0, 'state_version': 3}
+
+
+@pytest.mark.parametrize('if_none_match', [
+    '"abc-1",W/"abc-2"', '"abc-1" , "abc-2"', '*', 'W/"abc-2"',
+])
+def test_if_none_match_is_parsed_as_entity_tags(url, if_none_match):
+    with pytest.raises(HTTPError) as error:
+        get(url + '/ports', **{'If-None-Match': if_none_match})
+    assert error.value.code == 304
+
+
+def test_partial_entity_tags_do_not_match(url):
+    with get(url + '/ports', **{'If-None-Match': '"abc-1, "abc-2"'}) as response:
+        assert response.status == 200
@@ -9,7 +9,9 @@ import epics
 import aspyrobotmx
 from aspyrobotmx import RobotServerMX
 from aspyrobotmx.server import Port, Position
+from aspyrobotmx.maintenance import MaintenanceTask
 from aspyrobotmx.make_safe import MakeSafe, MakeSafeFailed
+from aspyrobotmx.testing import ImmediateExecutor, VirtualClock
 from aspyrobot.exceptions import RobotError
 
 
@@ -40,9 +42,25 @@ def server(robot, make_safe):
     yield make_server(robot, make_safe)
 
 
-def make_server(robot, make_safe):
-    return RobotServerMX(robot=robot, make_safe=make_safe,
-                         update_addr=UPDATE_ADDR, request_addr=REQUEST_ADDR)
+@pytest.fixture
+def clock():
+    yield VirtualClock()
+
+
+@pytest.fixture
+def virtual_server(robot, make_safe, clock):
+    yield make_server(robot, make_safe, clock=clock, sleep=clock.sleep,
+                      executor=ImmediateExecutor())
+
+
+def make_server(robot, make_safe, **kwargs):
+    server = RobotServerMX(robot=robot, make_safe=make_safe,
+                           update_addr=UPDATE_ADDR, request_addr=REQUEST_ADDR,
+                           **kwargs)
+    for position in ['left', 'middle', 'right']:
+        server.update_cassette_type(value='normal', position=position)
+        server.update_port_states(value=[-1] * 96, position=position, start=0)
+    return server
 
 
 def allow_threads_to_progress():
@@ -116,6 +134,57 @@ def test_mount(robot, make_safe, server, mocker):
     assert update['error'] is None
 
 
+def test_mount_rejects_empty_port_before_moving(server, robot, make_safe):
+    server.update_port_states(value=[1], position='left', start=0)
+    server.mount(HANDLE, 'left', 'A', 1)
+    assert make_safe.move_to_safe_position.called is False
+    assert robot.prepare_for_mount.called is False
+    update = _get_end_update(server)
+    assert update['error'] == 'preflight failed: L A 1 is empty'
+
+
+def test_mount_rejects_unknown_holder_type(server, robot):
+    server.update_cassette_type(value='unknown', position='right')
+    server.mount_and_prefetch(HANDLE, 'left', 'A', 1, 'right', 'B', 2)
+    assert robot.mount.called is False
+    update = _get_end_update(server)
+    assert update['error'] == 'preflight failed: R B 2 holder type is unknown'
+
+
+def test_mount_rejects_superpucks_until_their_map_is_confirmed(server, robot):
+    server.update_cassette_type(value='superpuck', position='right')
+    server.mount(HANDLE, 'right', 'B', 2)
+    assert robot.mount.called is False
+    update = _get_end_update(server)
+    assert update['error'] == ('preflight failed: R B 2 is in a holder whose port '
+                               'index map is not confirmed')
+
+
+def test_mount_rejects_sample_already_out_of_port(server, robot):
+    server.update_sample_locations(value={'goniometer': ['left', 0], 'cavity': None})
+    server.mount(HANDLE, 'left', 'A', 1)
+    assert robot.mount.called is False
+
+
+def test_mount_can_be_forced_past_preflight(server, robot):
+    server.update_port_states(value=[2], position='left', start=0)
+    server.mount(HANDLE, 'left', 'A', 1, force=True)
+    assert robot.mount.call_args == call(Port('left', 'A', 1))
+    updates = list(_get_all_updates(server))
+    assert any('L A 1 is in error' in (update.get('message') or '')
+               for update in updates)
+    assert updates[-1]['error'] is None
+
+
+def test_prefetch_warns_about_unusual_port_distance(server, robot):
+    server.port_anomalies['left'][0] = True
+    server.prefetch(HANDLE, 'left', 'A', 1)
+    assert robot.prefetch.called is True
+    assert any(update.get('message') ==
+               'preflight: L A 1 probed distance is unusual for its puck'
+               for update in _get_all_updates(server))
+
+
 def test_mount_enables_auto_heat_cool_allowed_if_makesafe_fails(server, make_safe, robot):
     make_safe.move_to_safe_position.side_effect = MakeSafeFailed('bad bad happened')
     server.mount(HANDLE, 'left', 'A', 1)
@@ -252,6 +321,40 @@ def test_dismount_does_nothing_if_no_sample_on_goni(server, robot, make_safe):
     assert update['message'] == 'no sample mounted'
 
 
+def test_dismount_and_prefetch_prefetches_when_returning_placer(server, robot):
+    server.robot.goniometer_sample.get.return_value = 'L A 1'
+    server.dismount_and_prefetch(HANDLE, 'right', 'B', 2)
+    assert robot.dismount.call_args == call(Port('left', 'A', 1))
+    assert robot.return_placer_and_prefetch.call_args_list == [
+        call(None), call(Port('right', 'B', 2)),
+    ]
+    assert robot.go_to_standby.call_count == 1
+    assert robot.prefetch.called is False
+    assert _get_end_update(server)['error'] is None
+
+
+def test_dismount_and_prefetch_prefetches_if_no_sample_on_goni(server, robot, make_safe):
+    server.robot.goniometer_sample.get.return_value = ''
+    server.dismount_and_prefetch(HANDLE, 'right', 'B', 2)
+    assert robot.dismount.called is False
+    assert make_safe.move_to_safe_position.called is False
+    assert robot.return_placer_and_prefetch.call_args == call(Port('right', 'B', 2))
+    assert robot.go_to_standby.call_count == 1
+    assert robot.set_auto_heat_cool_allowed.call_args_list == [call(False), call(True)]
+    update = _get_end_update(server)
+    assert update['error'] is None
+    assert update['message'] == 'no sample mounted'
+
+
+def test_dismount_and_prefetch_checks_prefetch_port(server, robot):
+    server.robot.goniometer_sample.get.return_value = 'L A 1'
+    server.update_port_states(value=[1], position='right', start=8)
+    server.dismount_and_prefetch(HANDLE, 'right', 'B', 1)
+    assert robot.dismount.called is False
+    update = _get_end_update(server)
+    assert update['error'] == 'preflight failed: R B 1 is empty'
+
+
 def test_mount_and_prefetch_calls_prepare(server, robot, make_safe):
     make_safe_complete = threading.Event()
     make_safe.move_to_safe_position.side_effect = lambda: make_safe_complete.wait()
@@ -419,3 +522,127 @@ def test_calibrate_goniometer_makes_safe_if_initial_cal(server, robot, make_safe
 def test_dry_and_cool(server, robot, make_safe):
     server.dry_and_cool(HANDLE)
     assert robot.dry_and_cool.called
+
+
+def test_prefetch_records_duration_and_publishes_eta(server, robot):
+    server.duration_history.record('prefetch', 30., prefetch=False,
+                                   holder_type='normal', position='left', column='A')
+    server.prefetch(HANDLE, 'left', 'A', 1)
+    updates = list(_get_all_updates(server))
+    assert any(update.get('message') == 'expected to take 30 s' for update in updates)
+    assert server.operation_eta is None
+    assert server.duration_history.estimate('prefetch', prefetch=False,
+                                            holder_type='normal', position='left',
+                                            column='A') < 30.
+
+
+def test_failed_operation_duration_isnt_recorded(server, robot):
+    robot.prefetch.side_effect = Exception()
+    server.prefetch(HANDLE, 'left', 'A', 1)
+    assert server.duration_history.estimate('prefetch') is None
+
+
+def _record_calls(robot, make_safe):
+    manager = Mock()
+    manager.attach_mock(robot, 'robot')
+    manager.attach_mock(make_safe, 'make_safe')
+    return manager
+
+
+def test_mount_steps_in_virtual_time(virtual_server, robot, make_safe, clock):
+    manager = _record_calls(robot, make_safe)
+    robot.mount.side_effect = lambda port: clock.sleep(30.)
+    virtual_server.mount(HANDLE, 'left', 'A', 1)
+    port = Port('left', 'A', 1)
+    steps = [name for name, args, kwargs in manager.mock_calls
+             if not name.startswith('robot.goniometer_locked')]
+    assert steps == [
+        'robot.set_auto_heat_cool_allowed', 'robot.prepare_for_mount',
+        'robot.return_placer_and_prefetch', 'make_safe.move_to_safe_position',
+        'robot.mount', 'make_safe.return_positions',
+        'robot.return_placer_and_prefetch', 'robot.go_to_standby',
+        'robot.set_auto_heat_cool_allowed',
+    ]
+    assert robot.mount.call_args == call(port)
+    assert virtual_server.duration_history.estimate('mount') == 30.
+    assert _get_end_update(virtual_server)['error'] is None
+
+
+def test_dismount_and_prefetch_in_virtual_time(virtual_server, robot, clock):
+    robot.goniometer_sample.get.return_value = 'L A 1'
+    robot.dismount.side_effect = lambda port: clock.sleep(20.)
+    robot.return_placer_and_prefetch.side_effect = lambda port: clock.sleep(5.)
+    virtual_server.dismount_and_prefetch(HANDLE, 'left', 'A', 2)
+    assert clock() == 30.
+    assert robot.return_placer_and_prefetch.call_args == call(Port('left', 'A', 2))
+    assert _get_end_update(virtual_server)['error'] is None
+
+
+def test_prefetch_in_virtual_time(virtual_server, robot, clock):
+    clock.advance(100.)
+    etas = []
+
+    def prefetch(port):
+        etas.append(virtual_server.operation_eta)
+        clock.sleep(15.)
+
+    robot.prefetch.side_effect = prefetch
+    virtual_server.prefetch(HANDLE, 'left', 'A', 2)
+    assert etas[0]['started'] == 100.
+    assert clock() == 115.
+    assert virtual_server.duration_history.estimate('prefetch') == 15.
+    assert _get_end_update(virtual_server)['error'] is None
+
+
+def test_dismount_in_virtual_time(virtual_server, robot, make_safe, clock):
+    robot.goniometer_sample.get.return_value = 'L A 1'
+    robot.dismount.side_effect = lambda port: clock.sleep(20.)
+    make_safe.return_positions.side_effect = lambda: clock.sleep(5.)
+    virtual_server.dismount(HANDLE)
+    assert robot.dismount.call_args == call(Port('left', 'A', 1))
+    assert robot.return_placer_and_prefetch.call_args_list[-1] == call(None)
+    assert clock() == 25.
+    assert virtual_server.duration_history.estimate('dismount') == 25.
+    assert _get_end_update(virtual_server)['error'] is None
+
+
+def test_make_safe_failure_in_virtual_time(virtual_server, robot, make_safe):
+    make_safe.move_to_safe_position.side_effect = MakeSafeFailed('blocked')
+    virtual_server.mount(HANDLE, 'left', 'A', 1)
+    assert robot.mount.called is False
+    assert robot.go_to_standby.call_count == 1
+    assert _get_end_update(virtual_server)['error'] == 'make safe failed: blocked'
+
+
+def test_maintenance_runs_when_idle_and_waits_for_mounts(robot, make_safe, clock):
+    server = make_server(robot, make_safe, clock=clock, sleep=clock.sleep,
+                         executor=ImmediateExecutor(), maintenance_idle=60.,
+                         maintenance_tasks=[MaintenanceTask('dry_and_cool', 3600.)])
+    server.ready = True
+    robot.mount.side_effect = lambda port: clock.sleep(30.)
+    clock.advance(60.)
+    server.mount(HANDLE, 'left', 'A', 1)
+    assert server.maintenance_scheduler.run_pending() is None
+    clock.advance(60.)
+    assert server.maintenance_scheduler.run_pending().operation == 'dry_and_cool'
+    assert robot.dry_and_cool.call_count == 1
+
+
+def test_maintenance_waits_after_any_user_operation(robot, make_safe, clock):
+    server = make_server(robot, make_safe, clock=clock, sleep=clock.sleep,
+                         executor=ImmediateExecutor(), maintenance_idle=60.,
+                         maintenance_tasks=[MaintenanceTask('dry_and_cool', 3600.)])
+    server.ready = True
+    clock.advance(60.)
+    server.operation_update(HANDLE, message='probing')
+    assert server.maintenance_scheduler.run_pending() is None
+    clock.advance(60.)
+    assert server.maintenance_scheduler.run_pending().operation == 'dry_and_cool'
+
+
+def test_user_operation_fails_if_maintenance_does_not_yield(server, robot, monkeypatch):
+    monkeypatch.setattr('aspyrobotmx.maintenance.PREEMPT_TIMEOUT', 0.01)
+    server.maintenance_scheduler.running = 'dry_and_cool'
+    server.mount(HANDLE, 'left', 'A', 1)
+    assert robot.mount.called is False
+    assert _get_end_update(server)['error'] == 'maintenance did not yield'
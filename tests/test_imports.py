@@ -0,0 +1,52 @@
+import subprocess
+import sys
+
+import pytest
+
+
+SERVER_MODULES = ['epics', 'requests', 'aspyrobotmx.server', 'aspyrobotmx.make_safe']
+# Most times importing the package may take compared to importing json in the
+# same process, a baseline that scales with the speed of the machine
+IMPORT_TIME_RATIO = 10
+
+
+def run_python(*args):
+    return subprocess.run([sys.executable, *args], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, check=True,
+                          universal_newlines=True)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='the package imports the server eagerly without PEP 562')
+def test_client_imports_do_not_load_server_dependencies():
+    result = run_python('-c', (
+        'import sys\n'
+        'import aspyrobotmx\n'
+        'from aspyrobotmx import RobotClientMX\n'
+        'from aspyrobotmx.codes import RobotStatus\n'
+        f'print([name for name in {SERVER_MODULES!r} if name in sys.modules])'
+    ))
+    assert result.stdout.strip() == '[]'
+
+
+def test_lazy_attributes_are_available():
+    result = run_python('-c', 'import aspyrobotmx; print(aspyrobotmx.codes.__name__)')
+    assert result.stdout.strip() == 'aspyrobotmx.codes'
+
+
+def import_times(module):
+    result = run_python('-X', 'importtime', '-c', f'import {module}')
+    # lines are formatted as: "import time: self [us] | cumulative | imported package"
+    return {line.split('|')[2].strip(): int(line.split('|')[1])
+            for line in result.stderr.splitlines()
+            if line.startswith('import time:') and 'cumulative' not in line}
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime needs 3.7')
+def test_package_import_time_is_relative_to_json():
+    ratios = []
+    for _ in range(3):
+        times = import_times('aspyrobotmx.codes, json')
+        package = times['aspyrobotmx'] + times['aspyrobotmx.codes']
+        ratios.append(package / times['json'])
+    assert min(ratios) < IMPORT_TIME_RATIO
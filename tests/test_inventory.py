@@ -0,0 +1,72 @@
+import pytest
+
+from aspyrobotmx.inventory import PortInventory
+from aspyrobotmx.codes import HolderType, PortState, PuckState
+
+
+@pytest.fixture
+def inventory():
+    yield PortInventory(['left', 'middle', 'right'], 96)
+
+
+def test_all_ports_start_unknown(inventory):
+    assert len(inventory.ports_in_state(PortState.unknown)) == 3 * 96
+    assert inventory.ports_in_state(PortState.full) == []
+
+
+def test_ports_in_state_are_sorted(inventory):
+    inventory.update_ports('middle', 10, [-1, 1, -1])
+    inventory.update_ports('left', 2, [-1])
+    assert inventory.ports_in_state(PortState.full) == [
+        ('left', 2), ('middle', 10), ('middle', 12),
+    ]
+    assert inventory.ports_in_state(PortState.full, 'middle') == [
+        ('middle', 10), ('middle', 12),
+    ]
+
+
+def test_ports_move_between_states(inventory):
+    inventory.update_ports('left', 0, [-1, -1])
+    inventory.update_ports('left', 0, [1])
+    assert inventory.ports_in_state(PortState.full) == [('left', 1)]
+    assert inventory.ports_in_state(PortState.empty) == [('left', 0)]
+
+
+def test_puck_summary_of_cassette_columns(inventory):
+    inventory.set_holder_type('left', HolderType.normal)
+    inventory.update_ports('left', 8, [-1, -1, 1])
+    summary = inventory.puck_summary('left', 'B')
+    assert summary['counts'] == {'full': 2, 'empty': 1, 'unknown': 5}
+
+
+def test_puck_summary_of_unknown_puck(inventory):
+    inventory.set_holder_type('right', HolderType.normal)
+    inventory.set_puck_states('right', {'B': PuckState.full})
+    assert inventory.puck_summary('right', 'B')['state'] == PuckState.full
+    with pytest.raises(KeyError):
+        inventory.puck_summary('right', 'M')
+
+
+def test_superpucks_are_refused_until_confirmed(inventory):
+    inventory.set_holder_type('right', HolderType.superpuck)
+    with pytest.raises(ValueError):
+        inventory.puck_summary('right', 'B')
+    with pytest.raises(ValueError):
+        inventory.port_index('right', 'B', 5)
+    assert inventory.port_code('right', 20) is None
+
+
+def test_next_port(inventory):
+    inventory.update_ports('left', 4, [-1, 1, -1])
+    inventory.update_ports('right', 0, [-1])
+    assert inventory.next_port(PortState.full, 'left', 4) == ('left', 6)
+    assert inventory.next_port(PortState.full, 'left', 6) == ('right', 0)
+    assert inventory.next_port(PortState.full, 'right', 0) is None
+
+
+def test_port_codes(inventory):
+    inventory.set_holder_type('left', HolderType.normal)
+    assert inventory.port_code('left', 20) == 'L C 5'
+    assert inventory.port_index('left', 'C', 5) == 20
+    assert inventory.port_code('middle', 20) == 'M C 5'
+    assert inventory.port_index('middle', 'C', 5) == 20
@@ -0,0 +1,79 @@
+import pytest
+
+from aspyrobotmx.codes import HolderType
+from aspyrobotmx.layout import Port, layout, port_masks
+
+
+def test_cassette_layout():
+    cassette = layout(HolderType.normal)
+    assert cassette.location(0) == ('A', 1)
+    assert cassette.location(95) == ('L', 8)
+    assert cassette.index('B', 5) == 12
+    assert cassette.port('left', 12) == Port('left', 'B', 5)
+    assert cassette.puck_indexes['C'] == range(16, 24)
+
+
+def test_superpuck_layout():
+    superpuck = layout(HolderType.superpuck)
+    assert superpuck.location(20) == ('B', 5)
+    assert superpuck.location(64) is None
+    assert superpuck.puck(64) is None
+    assert list(superpuck.puck_indexes) == ['A', 'B', 'C', 'D']
+
+
+def test_unconfirmed_layouts_refuse_codes():
+    superpuck = layout(HolderType.superpuck)
+    assert superpuck.confirmed is False
+    assert superpuck.port('right', 20) is None
+    with pytest.raises(ValueError):
+        superpuck.index('B', '5')
+    with pytest.raises(ValueError):
+        superpuck.mask(['B'])
+    with pytest.raises(ValueError):
+        port_masks(['R B 1'], {'right': HolderType.superpuck})
+
+
+@pytest.mark.parametrize('puck,port_num', [('M', 1), ('A', 9), ('A', 0)])
+def test_index_of_missing_port(puck, port_num):
+    with pytest.raises(ValueError):
+        layout(HolderType.normal).index(puck, port_num)
+
+
+def test_mask_passes_on_selections_by_index():
+    superpuck = layout(HolderType.superpuck)
+    assert superpuck.probe_request(superpuck.mask([1] * 96)) == '1' * 96
+    assert superpuck.probe_request(superpuck.mask('hex:' + 'f' * 25)) == '1' * 96
+    assert layout(HolderType.normal).probe_request(0b101).startswith('1010')
+
+
+@pytest.mark.parametrize('ports', [
+    [1, 0, 0, 0, 0, 0, 0, 0, 1, 1] + [0] * 86,
+    ['1', '0', '0', '0', '0', '0', '0', '0', '1', '1'],
+    ['A 1', 'B 1', 'B 2'],
+    'hex:301',
+    'base64:AwE=',
+])
+def test_mask_encodings(ports):
+    assert layout(HolderType.normal).mask(ports) == 0b1100000001
+
+
+def test_mask_of_pucks():
+    assert layout(HolderType.normal).mask(['B']) == 0xff << 8
+    assert layout(HolderType.normal).mask(['c', 'd 1']) == 0xff << 16 | 1 << 24
+    with pytest.raises(ValueError):
+        layout(HolderType.normal).mask(['M'])
+
+
+def test_port_masks_across_positions():
+    holder_types = {'left': HolderType.normal, 'middle': HolderType.unknown,
+                    'right': HolderType.superpuck}
+    masks = port_masks(['L A 2', 'L b', 'l c 1'], holder_types)
+    assert masks == {'left': 0xff << 8 | 1 << 16 | 0b10, 'middle': 0, 'right': 0}
+    assert port_masks({'middle': 'hex:ff'}, holder_types)['middle'] == 0xff
+    assert port_masks({'right': [1] * 96}, holder_types)['right'] == (1 << 96) - 1
+
+
+def test_port_codes():
+    port = Port.from_code('m C 7')
+    assert port == Port('middle', 'C', 7)
+    assert port.code == 'M C 7'
@@ -0,0 +1,71 @@
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from aspyrobotmx.loadtest import parse_mix, run_load_test
+
+
+UPDATE_ADDR = 'tcp://127.0.0.1:13000'
+REQUEST_ADDR = 'tcp://127.0.0.1:13001'
+
+
+def test_parse_mix():
+    assert parse_mix('refresh=10, mount=1.5') == {'refresh': 10., 'mount': 1.5}
+    with pytest.raises(ValueError):
+        parse_mix('probe=1')
+
+
+def make_client(**kwargs):
+    client = MagicMock()
+    client.query.return_value = {'error': None, 'data': {}}
+
+    def set_lid(value, callback):
+        callback({'stage': 'start'})
+        return {'error': None}
+
+    client.set_lid.side_effect = set_lid
+    client.mount.return_value = {'error': 'busy'}
+    return client
+
+
+def test_run_load_test_reports_latencies():
+    report = run_load_test(UPDATE_ADDR, REQUEST_ADDR, clients=3, requests=20,
+                           mix={'refresh': 1, 'set_lid': 1, 'mount': 1}, seed=1,
+                           client_factory=make_client)
+    assert report['requests'] == 60
+    assert report['request_latency']['all']['count'] == 60
+    request_latency = report['request_latency']
+    assert report['update_latency']['count'] == request_latency['set_lid']['count']
+    assert report['errors'] == {'mount': request_latency['mount']['count']}
+    assert report['throughput'] > 0
+
+
+def test_late_updates_are_timed_from_their_own_request():
+    callbacks = []
+
+    def set_lid(value, callback):
+        time.sleep(.05)
+        if callbacks:
+            callbacks.pop()(stage='start')
+        callbacks.append(callback)
+        return {'error': None}
+
+    client = make_client()
+    client.set_lid.side_effect = set_lid
+    report = run_load_test(UPDATE_ADDR, REQUEST_ADDR, clients=1, requests=3,
+                           mix={'set_lid': 1}, client_factory=lambda **_: client)
+    assert report['update_latency']['count'] == 2
+    assert report['update_latency']['p50'] >= .1
+
+
+def test_clients_are_closed_after_the_run():
+    clients = []
+
+    def client_factory(**kwargs):
+        clients.append(make_client())
+        return clients[-1]
+
+    run_load_test(UPDATE_ADDR, REQUEST_ADDR, clients=2, requests=1,
+                  mix={'refresh': 1}, client_factory=client_factory)
+    assert all(client.close.called for client in clients)
@@ -0,0 +1,107 @@
+import logging
+import logging.handlers
+
+import pytest
+
+from aspyrobotmx.logs import RateLimitFilter, limit_log_rate, start_queue_logging
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def make_record(lineno=1, level=logging.INFO, msg='noisy'):
+    return logging.LogRecord('test', level, 'server.py', lineno, msg, None, None)
+
+
+def test_rate_limit_allows_burst_then_rate():
+    clock = Clock()
+    limit = RateLimitFilter(rate=1., burst=2, clock=clock)
+    assert [limit.filter(make_record()) for _ in range(4)] == [True, True, False, False]
+    clock.now = 1.
+    record = make_record()
+    assert limit.filter(record) is True
+    assert record.msg == 'noisy [2 similar messages suppressed]'
+
+
+def test_rate_limit_is_per_call_site():
+    limit = RateLimitFilter(rate=1., burst=1, clock=Clock())
+    assert limit.filter(make_record(lineno=1)) is True
+    assert limit.filter(make_record(lineno=2)) is True
+    assert limit.filter(make_record(lineno=1)) is False
+
+
+def test_rate_limit_ignores_warnings():
+    limit = RateLimitFilter(rate=1., burst=1, clock=Clock())
+    records = [make_record(level=logging.WARNING) for _ in range(3)]
+    assert all(limit.filter(record) for record in records)
+
+
+def test_records_are_counted_once_by_a_shared_filter():
+    clock = Clock()
+    limit = RateLimitFilter(rate=1., burst=1, clock=clock)
+    for _ in range(3):
+        record = make_record()
+        assert limit.filter(record) is limit.filter(record)
+    clock.now = 2.
+    record = make_record()
+    assert limit.filter(record) is limit.filter(record) is True
+    assert record.msg == 'noisy [2 similar messages suppressed]'
+
+
+def test_flush_reports_suppressed_records_of_quiet_call_sites():
+    clock = Clock()
+    limit = RateLimitFilter(rate=1., burst=1, clock=clock)
+    for _ in range(3):
+        limit.filter(make_record())
+    assert limit.flush() == []
+    clock.now = 1.
+    summary, = limit.flush()
+    assert summary.getMessage() == 'noisy [2 similar messages suppressed]'
+    assert limit.filter(summary) is True
+    assert limit.flush() == []
+
+
+@pytest.fixture
+def logger():
+    logger = logging.getLogger('aspyrobotmx.test_logs')
+    handler = logging.handlers.BufferingHandler(100)
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    yield logger
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+
+
+def test_queue_logging_moves_handlers_to_listener(logger):
+    handler = logger.handlers[0]
+    listeners = start_queue_logging(rate=100., loggers=[logger])
+    try:
+        assert isinstance(logger.handlers[0], logging.handlers.QueueHandler)
+        logger.info('hello %s', 'world')
+    finally:
+        for listener in listeners:
+            listener.stop()
+    assert [record.getMessage() for record in handler.buffer] == ['hello world']
+
+
+def test_rate_limit_without_queue_logging(logger):
+    limit_log_rate(1., burst=1, loggers=[logger])
+    for _ in range(3):
+        logger.info('noisy')
+    assert len(logger.handlers[0].buffer) == 1
+
+
+def test_rate_limit_is_shared_by_handlers(logger):
+    first, second = logger.handlers[0], logging.handlers.BufferingHandler(100)
+    logger.addHandler(second)
+    limit_log_rate(1., burst=1, loggers=[logger])
+    for _ in range(3):
+        logger.info('noisy')
+    assert (len(first.buffer), len(second.buffer)) == (1, 1)
+    assert first.filters == second.filters
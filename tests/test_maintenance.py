@@ -0,0 +1,186 @@
+from threading import Event, Lock, Thread
+from types import SimpleNamespace
+
+import pytest
+
+from aspyrobotmx.codes import HolderType, PortState
+from aspyrobotmx.maintenance import MaintenanceScheduler, MaintenanceTask, unknown_pucks
+from aspyrobotmx.testing import VirtualClock
+
+
+class Server:
+
+    def __init__(self):
+        self.ready = True
+        self.robot = SimpleNamespace(foreground_done=SimpleNamespace(value=1))
+        self._foreground_lock = Lock()
+        self.holder_types = {'left': HolderType.superpuck,
+                             'middle': HolderType.unknown,
+                             'right': HolderType.normal}
+        self.port_states = {position: [PortState.full] * 96
+                            for position in ['left', 'middle', 'right']}
+        self.maintenance = None
+        self.calls = []
+
+    def dry_and_cool(self, handle):
+        self.calls.append(('dry_and_cool', {}))
+
+    def probe(self, handle, ports):
+        self.calls.append(('probe', {'ports': ports}))
+
+    def mount(self, handle):
+        pass
+    mount._preempts_maintenance = True
+
+
+@pytest.fixture
+def server():
+    return Server()
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock()
+
+
+def make_scheduler(server, clock, *tasks):
+    return MaintenanceScheduler(server, tasks, min_idle=60., clock=clock)
+
+
+def test_tasks_wait_for_idle_time(server, clock):
+    scheduler = make_scheduler(server, clock, MaintenanceTask('dry_and_cool', 3600.))
+    assert scheduler.run_pending() is None
+    clock.advance(60.)
+    assert scheduler.run_pending().operation == 'dry_and_cool'
+    assert server.calls == [('dry_and_cool', {})]
+
+
+def test_tasks_run_again_after_their_interval(server, clock):
+    scheduler = make_scheduler(server, clock, MaintenanceTask('dry_and_cool', 3600.))
+    clock.advance(60.)
+    scheduler.run_pending()
+    clock.advance(1800.)
+    assert scheduler.run_pending() is None
+    clock.advance(1800.)
+    assert scheduler.run_pending() is not None
+    assert scheduler.stats()['runs'] == 2
+
+
+def test_tasks_wait_while_robot_is_busy(server, clock):
+    scheduler = make_scheduler(server, clock, MaintenanceTask('dry_and_cool', 3600.))
+    clock.advance(60.)
+    server.robot.foreground_done.value = 0
+    assert scheduler.run_pending() is None
+    server.robot.foreground_done.value = 1
+    server._foreground_lock.acquire()
+    assert scheduler.run_pending() is None
+    server._foreground_lock.release()
+    server.ready = False
+    assert scheduler.run_pending() is None
+
+
+def test_user_operations_restart_the_idle_time(server, clock):
+    scheduler = make_scheduler(server, clock, MaintenanceTask('dry_and_cool', 3600.))
+    clock.advance(50.)
+    with scheduler.preempt():
+        clock.advance(20.)
+        assert scheduler.run_pending() is None
+    clock.advance(50.)
+    assert scheduler.run_pending() is None
+    clock.advance(10.)
+    assert scheduler.run_pending() is not None
+
+
+def test_unknown_pucks(server):
+    server.port_states['middle'] = [PortState.unknown] * 96
+    server.port_states['right'][88:96] = [PortState.unknown] * 8
+    assert unknown_pucks(server) == ['R L']
+
+
+def test_unknown_pucks_leave_out_unconfirmed_holders(server):
+    server.port_states['left'][16:32] = [PortState.unknown] * 16
+    assert unknown_pucks(server) == []
+
+
+def test_unknown_pucks_are_probed_together(server, clock):
+    server.port_states['right'][:16] = [PortState.unknown] * 16
+    scheduler = make_scheduler(server, clock,
+                               MaintenanceTask('probe_unknown_pucks', 600.))
+    clock.advance(60.)
+    scheduler.run_pending()
+    assert server.calls == [('probe', {'ports': ['R A', 'R B']})]
+
+
+class TwoStepTask(MaintenanceTask):
+
+    def steps(self, server):
+        return [(self.operation, {}), (self.operation, {})]
+
+
+def test_user_operations_preempt_remaining_steps(server, clock):
+    scheduler = make_scheduler(server, clock, TwoStepTask('dry_and_cool', 600.))
+    drying, release, mounted = Event(), Event(), Event()
+
+    def dry_and_cool(handle):
+        server.calls.append(('dry_and_cool', {}))
+        drying.set()
+        release.wait()
+
+    def mount():
+        with scheduler.preempt() as yielded:
+            assert yielded is True
+            assert scheduler.running is None
+            mounted.set()
+
+    server.dry_and_cool = dry_and_cool
+    clock.advance(60.)
+    maintenance = Thread(target=scheduler.run_pending)
+    maintenance.start()
+    drying.wait()
+    assert server.maintenance['operation'] == 'dry_and_cool'
+    user = Thread(target=mount)
+    user.start()
+    assert not mounted.wait(0.05)
+    release.set()
+    maintenance.join()
+    user.join()
+    assert mounted.is_set()
+    assert server.calls == [('dry_and_cool', {})]
+    assert scheduler.stats()['preempted'] == 1
+    assert server.maintenance is None
+
+
+def test_preempt_reports_maintenance_that_does_not_yield(server, clock, monkeypatch):
+    monkeypatch.setattr('aspyrobotmx.maintenance.PREEMPT_TIMEOUT', 0.01)
+    scheduler = make_scheduler(server, clock, MaintenanceTask('dry_and_cool', 600.))
+    scheduler.running = 'dry_and_cool'
+    with scheduler.preempt() as yielded:
+        assert yielded is False
+
+
+def test_user_activity_restarts_the_idle_time(server, clock):
+    scheduler = make_scheduler(server, clock, MaintenanceTask('dry_and_cool', 3600.))
+    clock.advance(60.)
+    scheduler.record_activity('maintenance-1')
+    assert scheduler.idle()
+    scheduler.record_activity(101)
+    assert not scheduler.idle()
+    clock.advance(60.)
+    assert scheduler.idle()
+
+
+def test_user_operations_cannot_be_maintenance(server, clock):
+    with pytest.raises(ValueError):
+        make_scheduler(server, clock, MaintenanceTask('mount', 600.))
+    with pytest.raises(ValueError):
+        make_scheduler(server, clock, MaintenanceTask('defrost', 600.))
+
+
+def test_task_from_config():
+    task = MaintenanceTask.from_config({
+        'operation': 'calibrate_toolset', 'interval': 86400,
+        'parameters': {'include_find_magnet': False, 'quick_mode': True},
+    })
+    assert task.interval == 86400.
+    assert task.steps(None) == [('calibrate_toolset', {'include_find_magnet': False,
+                                                       'quick_mode': True})]
@@ -0,0 +1,19 @@
+from aspyrobotmx.metrics import LatencyTracker, percentile
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, .5) == 50
+    assert percentile(values, .99) == 99
+    assert percentile([], .5) is None
+
+
+def test_latency_tracker_stats():
+    tracker = LatencyTracker(slo=.01, window=4)
+    for latency in [.001, .002, .02, .003, .004]:
+        tracker.record(latency)
+    stats = tracker.stats()
+    assert stats['count'] == 5
+    assert stats['within_slo'] == .75
+    assert stats['p50'] == .003
+    assert stats['max'] == .02
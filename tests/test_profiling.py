@@ -0,0 +1,63 @@
+import os
+import threading
+import tracemalloc
+
+from aspyrobotmx.profiling import SamplingProfiler, tracemalloc_summary
+
+
+def busy_worker(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_sampling_profiler_writes_folded_stacks(tmpdir):
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_worker, args=(stop,), name='busy')
+    worker.start()
+    profiler = SamplingProfiler()
+    path = str(tmpdir.join('profile.folded'))
+    try:
+        assert profiler.start(path=path, interval=.001) == path
+        threading.Event().wait(.05)
+        assert profiler.stop() == path
+    finally:
+        stop.set()
+        worker.join()
+    with open(path) as file:
+        lines = file.read().splitlines()
+    busy_lines = [line for line in lines if line.startswith('thread busy;')]
+    assert busy_lines
+    stack, count = busy_lines[0].rsplit(' ', 1)
+    assert 'busy_worker (test_profiling.py' in stack
+    assert int(count) > 0
+
+
+def test_sampling_profiler_stops_after_duration(tmpdir):
+    profiler = SamplingProfiler()
+    profiler.start(duration=.01, path=str(tmpdir.join('profile.folded')), interval=.001)
+    profiler._thread.join(1.)
+    assert profiler.running is False
+    assert tmpdir.join('profile.folded').check()
+
+
+def test_tracemalloc_summary():
+    was_tracing = tracemalloc.is_tracing()
+    try:
+        if not was_tracing:
+            assert 'started' in tracemalloc_summary()[0]
+        data = [bytearray(1000) for _ in range(100)]
+        lines = tracemalloc_summary(limit=3)
+        assert lines[0].startswith('traced memory:')
+        assert 'test_profiling.py' in lines[1]
+        assert len(lines) <= 4
+        del data
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+
+def test_sampling_profiler_default_file_is_in_directory(tmpdir):
+    profiler = SamplingProfiler()
+    path = profiler.start(directory=str(tmpdir), interval=.001)
+    assert profiler.stop() == path
+    assert tmpdir.join(os.path.basename(path)).check()
@@ -0,0 +1,105 @@
+from queue import Empty
+from threading import Thread
+import time
+
+import pytest
+
+from aspyrobotmx.publish import PublishQueue
+
+
+def values(**data):
+    return {'type': 'values', 'data': data}
+
+
+def operation(stage):
+    return {'type': 'operation', 'handle': 1, 'stage': stage}
+
+
+def drain(queue):
+    messages = []
+    while True:
+        try:
+            messages.append(queue.get_nowait())
+        except Empty:
+            return messages
+
+
+def test_unbounded_queue_keeps_everything():
+    queue = PublishQueue()
+    for i in range(100):
+        queue.put(values(lid_open=i))
+    assert len(drain(queue)) == 100
+
+
+def test_get_times_out():
+    with pytest.raises(Empty):
+        PublishQueue().get(timeout=.01)
+
+
+def test_coalesce_merges_into_last_values_update():
+    queue = PublishQueue(2)
+    queue.put(values(lid_open=0))
+    queue.put(values(lid_open=1, heater_hot=1))
+    queue.put(values(lid_open=2))
+    assert drain(queue) == [values(lid_open=0), values(lid_open=2, heater_hot=1)]
+    assert queue.stats()['coalesced'] == 1
+
+
+def test_coalesce_does_not_move_values_ahead_of_operations():
+    queue = PublishQueue(2)
+    queue.put(values(lid_open=0))
+    queue.put(operation('start'))
+    queue.put(values(lid_open=1))
+    queue.put(values(lid_open=2))
+    assert drain(queue) == [values(lid_open=0), operation('start'), values(lid_open=2)]
+
+
+def test_coalesce_joins_status_changes():
+    queue = PublishQueue(1)
+    queue.put(values(status_changes=[{'flag': 'reason_estop', 'set': True}]))
+    queue.put(values(status_changes=[{'flag': 'reason_estop', 'set': False}]))
+    assert drain(queue)[0]['data']['status_changes'] == [
+        {'flag': 'reason_estop', 'set': True},
+        {'flag': 'reason_estop', 'set': False},
+    ]
+
+
+def test_operation_updates_are_never_dropped():
+    queue = PublishQueue(1, 'drop_newest')
+    queue.put(values(lid_open=0))
+    queue.put_nowait(operation('start'))
+    queue.put_nowait(operation('end'))
+    queue.put(values(lid_open=1))
+    assert drain(queue) == [values(lid_open=0), operation('start'), operation('end')]
+    assert queue.stats()['dropped'] == 1
+
+
+def test_operation_updates_wait_for_room():
+    queue = PublishQueue(1)
+    queue.put(values(lid_open=0))
+    thread = Thread(target=queue.put, args=(operation('start'),))
+    thread.start()
+    time.sleep(.05)
+    assert queue.qsize() == 1
+    assert queue.get_nowait() == values(lid_open=0)
+    thread.join(1.)
+    assert queue.get_nowait() == operation('start')
+
+
+def test_dropped_values_are_reported_with_the_version_to_resync_from():
+    queue = PublishQueue(1, 'drop_newest')
+    queue.put(values(lid_open=0, state_version=1))
+    queue.put(values(lid_open=1, state_version=2))
+    queue.put(values(lid_open=2, state_version=3))
+    assert queue.get_nowait()['data']['updates_dropped'] == {'since': 1}
+    queue.put(values(lid_open=3, state_version=4))
+    assert 'updates_dropped' not in queue.get_nowait()['data']
+
+
+def test_drop_oldest():
+    queue = PublishQueue(2, 'drop_oldest')
+    for i in range(4):
+        queue.put(values(lid_open=i))
+    assert drain(queue) == [values(lid_open=2), values(lid_open=3)]
+    assert queue.stats()['dropped'] == 2
+    assert queue.stats()['high_water'] == 2
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+import zmq
+
+from aspyrobotmx.relay import UpdateRelay
+
+
+SERVER_UPDATE_ADDR = 'tcp://127.0.0.1:13010'
+RELAY_UPDATE_ADDR = 'tcp://127.0.0.1:13011'
+RELAY_REQUEST_ADDR = 'tcp://127.0.0.1:13013'
+
+
+@pytest.fixture
+def server_socket():
+    socket = zmq.Context.instance().socket(zmq.PUB)
+    socket.bind(SERVER_UPDATE_ADDR)
+    yield socket
+    socket.close(linger=0)
+
+
+@pytest.fixture
+def relay(mocker):
+    relay = UpdateRelay(SERVER_UPDATE_ADDR, 'tcp://127.0.0.1:13012',
+                        RELAY_UPDATE_ADDR, RELAY_REQUEST_ADDR)
+    mocker.patch.object(relay, 'fetch_state')
+    relay.state = {'lid_open': 0, 'port_states': {'left': [0] * 96}}
+    thread = threading.Thread(target=relay.run, daemon=True)
+    thread.start()
+    yield relay
+    relay.shutdown()
+    thread.join()
+
+
+def subscribe():
+    socket = zmq.Context.instance().socket(zmq.SUB)
+    socket.setsockopt(zmq.SUBSCRIBE, b'')
+    socket.setsockopt(zmq.RCVTIMEO, 1000)
+    socket.connect(RELAY_UPDATE_ADDR)
+    return socket
+
+
+def request(operation):
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.setsockopt(zmq.RCVTIMEO, 1000)
+    socket.connect(RELAY_REQUEST_ADDR)
+    socket.send_json({'operation': operation, 'parameters': {}})
+    reply = socket.recv_json()
+    socket.close(linger=0)
+    return reply
+
+
+def test_refresh_is_served_from_the_cache(relay):
+    assert request('refresh') == {
+        'error': None,
+        'data': {'lid_open': 0, 'port_states': {'left': [0] * 96}},
+    }
+
+
+def test_joining_does_not_publish_a_snapshot(relay):
+    first = subscribe()
+    time.sleep(.2)
+    second = subscribe()
+    time.sleep(.2)
+    with pytest.raises(zmq.Again):
+        first.recv_json()
+    first.close(linger=0)
+    second.close(linger=0)
+
+
+def test_relay_refuses_other_operations(relay):
+    assert 'read-only' in request('mount')['error']
+
+
+def test_updates_are_forwarded_and_cached(server_socket, relay):
+    socket = subscribe()
+    time.sleep(.2)
+    server_socket.send_json({'type': 'values', 'data': {'lid_open': 1}})
+    server_socket.send_json({'type': 'operation', 'handle': 1, 'stage': 'end'})
+    assert socket.recv_json() == {'type': 'values', 'data': {'lid_open': 1}}
+    assert socket.recv_json()['type'] == 'operation'
+    assert relay.state['lid_open'] == 1
+    socket.close(linger=0)
+
+
+def test_events_are_not_cached(server_socket, relay):
+    socket = subscribe()
+    time.sleep(.2)
+    server_socket.send_json({'type': 'values', 'data': {
+        'status': 4, 'status_changes': [{'flag': 'x', 'set': True}],
+    }})
+    server_socket.send_json({'type': 'values', 'data': {'heartbeat': {}}})
+    socket.recv_json()
+    socket.recv_json()
+    assert relay.state['status'] == 4
+    assert 'status_changes' not in relay.state
+    assert 'heartbeat' not in relay.state
+    socket.close(linger=0)
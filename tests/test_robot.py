@@ -21,6 +21,10 @@ def robot():
     yield robot
 
 
+def test_wait_for_connections(robot):
+    assert robot.wait_for_connections() == []
+
+
 def test_mount_sends_the_mount_command(robot):
     try:
         robot.mount(Port('left', 'A', '1'))
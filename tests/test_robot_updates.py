@@ -1,9 +1,11 @@
-from unittest.mock import create_autospec
+import json
+from unittest.mock import MagicMock, create_autospec
 
 import pytest
 
 from aspyrobotmx.server import RobotServerMX
-from aspyrobotmx.codes import HolderType, PuckState, PortState, DumbbellState
+from aspyrobotmx.codes import (HolderType, PuckState, PortState, DumbbellState,
+                               RobotStatus)
 
 
 UPDATE_ADDR = 'tcp://127.0.0.1:13000'
@@ -47,6 +49,18 @@ def test_update_port_states(server):
     assert 'port_states' in server.publish_queue.get_nowait()['data']
 
 
+def test_port_updates_replace_tables(server):
+    port_states = server.port_states
+    left = port_states['left']
+    server.update_port_states(value=[-1], position='left', start=0)
+    assert server.port_states is not port_states
+    assert left[0] == PortState.unknown
+    assert server.port_states['middle'] is port_states['middle']
+    published = server.publish_queue.get_nowait()['data']['port_states']
+    server.update_port_states(value=[1], position='left', start=0)
+    assert published['left'][0] == PortState.full
+
+
 def test_update_sample_distances(server):
     server.update_sample_distances(value=[-1.2, -3.4], position='left', start=0)
     assert server.port_distances['left'][0] == -1.2
@@ -70,3 +84,201 @@ def test_update_magnet_state(server):
     update = server.publish_queue.get_nowait()
     update_value = update['data']['dumbbell_state']
     assert update_value == DumbbellState.in_cradle
+
+
+def test_update_port_states_updates_inventory(server):
+    server.update_cassette_type(value='normal', position='left')
+    server.update_port_states(value=[-1, 1, -1], position='left', start=0)
+    assert server.ports_in_state('full')['data'] == ['L A 1', 'L A 3']
+    assert server.next_port('L A 1')['data'] == 'L A 3'
+    assert server.puck_summary('left', 'A')['data']['counts'] == {
+        'full': 2, 'empty': 1, 'unknown': 5,
+    }
+
+
+def test_server_is_ready_once_data_dump_is_received(server):
+    server.robot = MagicMock()
+    server.fetch_all_data()
+    for position in ['left', 'middle', 'right']:
+        assert server.ready is False
+        server.update_cassette_type(value='normal', position=position)
+        server.update_puck_states(value=[1, 1, 1, 1], position=position, start=0)
+        server.update_port_states(value=[1] * 96, position=position, start=0)
+        server.update_sample_distances(value=[0.] * 96, position=position, start=0)
+    assert server.ready is True
+
+
+def test_missing_data_is_requested_again_then_given_up_on(server, monkeypatch):
+    monkeypatch.setattr('aspyrobotmx.server.DATA_TIMEOUT', 0.01)
+    monkeypatch.setattr('aspyrobotmx.server.DATA_RETRIES', 1)
+    server.robot = MagicMock()
+    server.fetch_all_data()
+    server.update_cassette_type(value='normal', position='left')
+    server._await_data()
+    assert server.robot.generic_command.put.call_count == 2
+    assert server.ready is True
+
+
+def test_startup_is_timed_from_when_it_started():
+    server = RobotServerMX(robot=MagicMock(), update_addr=UPDATE_ADDR,
+                           request_addr=REQUEST_ADDR, make_safe=MagicMock(),
+                           started=-5., clock=lambda: 0.)
+    server._record_startup_phase('create', server._startup_times['create'])
+    assert server.startup_timings == {'create': 5.}
+
+
+def test_status_updates_publish_flag_changes(server):
+    server.values_update({'status': RobotStatus.reason_port_jam})
+    server.values_update({'status': RobotStatus.reason_port_jam})
+    server.values_update({'status': 0})
+    updates = [server.publish_queue.get_nowait()['data'] for _ in range(3)]
+    assert updates[0]['status_changes'] == [{'flag': 'reason_port_jam', 'set': True}]
+    assert 'status_changes' not in updates[1]
+    assert updates[2]['status_changes'] == [{'flag': 'reason_port_jam', 'set': False}]
+
+
+def test_query_lane_only_serves_query_operations(server):
+    response = server._handle_query({'operation': 'metrics'})
+    assert response['error'] is None
+    assert 'query' in response['data']['lanes']
+    response = server._handle_query({'operation': 'reset_mount_counters',
+                                     'parameters': {'handle': 1}})
+    assert 'is not a query operation' in response['error']
+
+
+def test_query_lane_replies_to_bad_requests_with_errors(server):
+    assert 'not an object' in server._handle_query(['refresh'])['error']
+    response = server._handle_query({'operation': 'puck_summary', 'parameters': [1]})
+    assert 'not an object' in response['error']
+    response = server._handle_query({'operation': 'next_port', 'parameters': {
+        'after': 'nowhere'}})
+    assert response['error'] and response['data'] is None
+
+
+def test_completed_sample_distances_are_screened(server):
+    server.update_cassette_type(value='normal', position='left')
+    server.update_port_states(value=[-1] * 96, position='left', start=0)
+    server.update_sample_distances(value=[1.] * 48, position='left', start=0)
+    assert not any(server.port_anomalies['left'])
+    server.update_sample_distances(value=[1.] * 47 + [4.], position='left', start=48)
+    assert server.port_anomalies['left'][95] is True
+    assert sum(server.port_anomalies['left']) == 1
+
+
+def test_anomalies_are_screened_again_when_states_or_holder_change(server):
+    server.update_cassette_type(value='normal', position='left')
+    server.update_port_states(value=[-1] * 96, position='left', start=0)
+    server.update_sample_distances(value=[1.] * 87 + [4.] * 9, position='left',
+                                   start=0)
+    assert [i for i, flag in enumerate(server.port_anomalies['left']) if flag] == [87]
+    server.update_port_states(value=[1], position='left', start=87)
+    assert not any(server.port_anomalies['left'])
+    server.update_port_states(value=[-1], position='left', start=87)
+    server.update_cassette_type(value='superpuck', position='left')
+    anomalies = [i for i, flag in enumerate(server.port_anomalies['left']) if flag]
+    assert anomalies == list(range(80, 87))
+
+
+def test_values_updates_are_versioned(server):
+    server.values_update({'pins_mounted': 1})
+    server.values_update({'pins_lost': 2})
+    updates = [server.publish_queue.get_nowait()['data'] for _ in range(2)]
+    assert [update['state_version'] for update in updates] == [1, 2]
+
+
+def test_changes_since_returns_later_values(server):
+    server.values_update({'pins_mounted': 1, 'pins_lost': 0})
+    server.values_update({'status': RobotStatus.reason_port_jam})
+    server.values_update({'pins_mounted': 2})
+    response = server.changes_since(1, server_id=server.server_id)
+    assert response['data']['full'] is False
+    values = response['data']['values']
+    assert values['pins_mounted'] == 2
+    assert values['status'] == RobotStatus.reason_port_jam
+    assert 'pins_lost' not in values
+    assert 'status_changes' not in values
+    assert values['state_version'] == 3
+
+
+def test_changes_since_falls_back_to_full_state(server):
+    server.robot = MagicMock()
+    server.robot.snapshot.return_value = {'time': '12:00'}
+    server.values_update({'pins_mounted': 1})
+    response = server.changes_since(0, server_id='another server')
+    assert response['data']['full'] is True
+    assert response['data']['values']['time'] == '12:00'
+    assert response['data']['values']['state_version'] == 1
+    assert response['data']['server_id'] == server.server_id
+
+
+def test_key_versions_track_the_last_change(server):
+    server.values_update({'pins_mounted': 1})
+    server.values_update({'pins_lost': 2})
+    assert server.key_version(['pins_mounted']) == 1
+    assert server.key_version(['pins_mounted', 'pins_lost']) == 2
+    assert server.key_version(['lid_open']) == 0
+
+
+def test_wait_for_change(server):
+    server.values_update({'pins_mounted': 1})
+    assert server.wait_for_change(0, timeout=0) is True
+    assert server.wait_for_change(1, timeout=0.01) is False
+
+
+def test_query_lane_replies_use_encoded_values(server):
+    server.robot = MagicMock()
+    server.robot.snapshot.return_value = {}
+    server.encoded_values.start()
+    try:
+        server.update_port_states(value=[-1], position='left', start=0)
+        reply = server.encoded_values.encode(
+            server._handle_query({'operation': 'refresh'})
+        )
+        assert json.loads(reply)['data']['port_states']['left'][0] == PortState.full
+        server.encoded_values.encode(server._handle_query({'operation': 'refresh'}))
+        assert server.encoded_values.hits > 0
+    finally:
+        server.encoded_values.stop()
+
+
+def test_refresh_is_reused_until_the_state_changes(server):
+    server.robot = MagicMock()
+    server.robot.snapshot.return_value = {}
+    first = server.refresh()['data']
+    assert server.refresh()['data'] is first
+    assert server.robot.snapshot.call_count == 1
+    server.values_update({'pins_mounted': 1})
+    assert server.refresh()['data']['pins_mounted'] == 1
+    assert server.metrics()['data']['refresh']['cached'] == 1
+
+
+def test_query_lane_reuses_encoded_refresh_replies(server):
+    server.robot = MagicMock()
+    server.robot.snapshot.return_value = {}
+    reply = server._encode_reply(server._handle_query({'operation': 'refresh'}))
+    assert server._encode_reply(server._handle_query({'operation': 'refresh'})) is reply
+
+
+def test_published_updates_use_encoded_values(server):
+    server.update_socket = socket = MagicMock()
+    server._encode_sends()
+    server.update_port_states(value=[1] * 96, position='left', start=0)
+    message = server.publish_queue.get_nowait()
+    server.update_socket.send_json(message)
+    assert json.loads(socket.send.call_args[0][0]) == message
+    misses = server.encoded_values.misses
+    server.update_socket.send_json(message)
+    assert server.encoded_values.misses == misses
+    assert server.encoded_values.hits == misses
+
+
+def test_request_socket_reuses_encoded_refresh_replies(server):
+    server.robot = MagicMock()
+    server.robot.snapshot.return_value = {}
+    server.request_socket = socket = MagicMock()
+    server._encode_sends()
+    server.request_socket.send_json(server.refresh())
+    server.request_socket.send_json(server.refresh())
+    first, second = (args[0] for args, _ in socket.send.call_args_list)
+    assert second is first
+    assert json.loads(first)['data']['server_id'] == server.server_id
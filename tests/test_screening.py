@@ -0,0 +1,33 @@
+from aspyrobotmx.codes import HolderType, PortState
+from aspyrobotmx.screening import distance_anomalies
+
+
+FULL = int(PortState.full)
+EMPTY = int(PortState.empty)
+
+
+def test_outlying_port_is_flagged_within_its_column():
+    distances = [1.0, 1.1, 0.9, 1.0, 1.05, 0.95, 1.0, 3.0] + [5.0] * 88
+    anomalies = distance_anomalies(distances, [FULL] * 96, HolderType.normal)
+    assert anomalies[:8] == [False] * 7 + [True]
+    assert not any(anomalies[8:])
+
+
+def test_empty_and_unmeasured_ports_are_ignored():
+    distances = [1.0] * 6 + [None, 9.0] + [None] * 88
+    states = [FULL] * 7 + [EMPTY] + [FULL] * 88
+    anomalies = distance_anomalies(distances, states, HolderType.normal)
+    assert not any(anomalies)
+
+
+def test_pucks_with_few_measured_ports_arent_screened():
+    distances = [1.0, 1.0, 9.0] + [None] * 93
+    anomalies = distance_anomalies(distances, [FULL] * 96, HolderType.normal)
+    assert not any(anomalies)
+
+
+def test_superpucks_are_screened_by_16_port_puck():
+    distances = [1.0] * 8 + [2.0] * 7 + [9.0] + [None] * 80
+    anomalies = distance_anomalies(distances, [FULL] * 96, HolderType.superpuck)
+    assert anomalies.index(True) == 15
+    assert sum(anomalies) == 1
@@ -5,6 +5,7 @@ import epics
 
 import aspyrobotmx
 from aspyrobotmx import RobotServerMX, RobotMX
+from aspyrobotmx.profiling import profiler
 
 
 aspyrobotmx.DELAY_TO_PROCESS = .01
@@ -61,6 +62,13 @@ def test_probe(server):
     assert server.robot.generic_command.char_value == 'ProbeCassettes'
 
 
+def test_probe_compact_ports(server):
+    server.probe(HANDLE, ['L B', 'R A 2'])
+    assert server.robot.left_probe_request.char_value == '0' * 8 + '1' * 8 + '0' * 80
+    assert server.robot.middle_probe_request.char_value == '0' * 96
+    assert server.robot.right_probe_request.char_value == '01' + '0' * 94
+
+
 def test_probe_when_busy(server):
     server._foreground_lock.acquire()
     ports = {'left': [0] * 96, 'middle': [0] * 96, 'right': [1] * 96}
@@ -117,3 +125,23 @@ def test_set_sample_location(server):
     process()
     assert server.robot.task_args.char_value == 'goniometer L A 1'
     assert server.robot.generic_command.char_value == 'SetSampleStatus'
+
+
+def test_start_profiling_only_writes_to_the_profile_dir(server, tmpdir):
+    server.profile_dir = str(tmpdir)
+    server.start_profiling(HANDLE, duration=None, path='../profile.folded')
+    assert 'file name' in list(operation_updates(server))[-1]['error']
+    server.start_profiling(HANDLE, duration=None, path='profile.folded')
+    list(operation_updates(server))
+    assert profiler.stop() == str(tmpdir.join('profile.folded'))
+
+
+def test_profiling_errors_end_the_operation(server, tmpdir):
+    server.profile_dir = str(tmpdir)
+    server.stop_profiling(HANDLE)
+    assert list(operation_updates(server))[-1]['error'] == 'profiler is not running'
+    server.start_profiling(HANDLE, duration=None)
+    list(operation_updates(server))
+    server.start_profiling(HANDLE, duration=None)
+    assert list(operation_updates(server))[-1]['error'] == 'profiler is already running'
+    profiler.stop()
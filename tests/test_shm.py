@@ -0,0 +1,92 @@
+from threading import Thread
+
+import pytest
+
+from aspyrobotmx.shm import SharedStateReader, SharedStateWriter
+
+
+@pytest.fixture
+def path(tmpdir):
+    yield str(tmpdir.join('robot.state'))
+
+
+def test_reader_sees_written_state(path):
+    writer = SharedStateWriter(path)
+    writer.update({
+        'holder_types': {'left': 2, 'middle': 3},
+        'puck_states': {'middle': {'B': -1}},
+        'port_states': {'right': [-1, 1] + [0] * 94},
+        'port_distances': {'left': [1.5, None] + [0.] * 94},
+        'pins_mounted': 7,
+        'motors_locked': True,
+        'model': None,
+        'task_message': 'mounting L A 1',
+    })
+    state = SharedStateReader(path).read()
+    assert state['holder_types'] == {'left': 2, 'middle': 3, 'right': 0}
+    assert state['puck_states']['middle'] == {'A': 0, 'B': -1, 'C': 0, 'D': 0}
+    assert state['port_states']['right'][:3] == [-1, 1, 0]
+    assert state['port_distances']['left'][:2] == [1.5, None]
+    assert state['pins_mounted'] == 7
+    assert state['motors_locked'] == 1
+    assert state['model'] == ''
+    assert state['task_message'] == 'mounting L A 1'
+
+
+def test_long_text_is_truncated(path):
+    writer = SharedStateWriter(path)
+    writer.update({'goniometer_sample': 'x' * 100})
+    assert SharedStateReader(path).read()['goniometer_sample'] == 'x' * 32
+
+
+def test_sequence_changes_with_writes_and_survives_restart(path):
+    writer = SharedStateWriter(path)
+    reader = SharedStateReader(path)
+    before = reader.sequence
+    writer.update({'pins_lost': 1})
+    writer.update({'unrelated': 1})
+    assert reader.sequence == before + 2
+    writer.close()
+    SharedStateWriter(path).update({'pins_lost': 2})
+    assert reader.read()['pins_lost'] == 2
+
+
+def test_reads_are_consistent_during_writes(path):
+    writer = SharedStateWriter(path)
+    reader = SharedStateReader(path)
+
+    def write():
+        for count in range(500):
+            writer.update({'port_states': {'left': [count % 3 - 1] * 96}})
+
+    thread = Thread(target=write)
+    thread.start()
+    while thread.is_alive():
+        ports = reader.read()['port_states']['left']
+        assert len(set(ports)) == 1
+    thread.join()
+
+
+def test_reader_rejects_other_files(path):
+    with open(path, 'wb') as file:
+        file.write(b'\0' * 8192)
+    with pytest.raises(ValueError):
+        SharedStateReader(path)
+
+
+def test_older_versions_do_not_overwrite_newer_values(path):
+    writer = SharedStateWriter(path)
+    writer.update({'pins_lost': 2, 'state_version': 5})
+    writer.update({'pins_lost': 1, 'pins_mounted': 3, 'state_version': 4})
+    state = SharedStateReader(path).read()
+    assert state['pins_lost'] == 2
+    assert state['pins_mounted'] == 3
+    assert state['state_version'] == 5
+
+
+def test_unknown_pucks_are_skipped(path):
+    writer = SharedStateWriter(path)
+    writer.update({'puck_states': {'left': {'A': 1, 'E': 1}}, 'pins_lost': 1})
+    state = SharedStateReader(path).read()
+    assert state['puck_states']['left'] == {'A': 1, 'B': 0, 'C': 0, 'D': 0}
+    assert state['pins_lost'] == 1
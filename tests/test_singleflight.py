@@ -0,0 +1,85 @@
+from threading import Event, Thread
+
+import pytest
+
+from aspyrobotmx.singleflight import SingleFlight
+from aspyrobotmx.testing import VirtualClock
+
+
+def test_concurrent_callers_share_one_call():
+    started, release = Event(), Event()
+    calls = []
+
+    def snapshot():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return {'calls': len(calls)}
+
+    flight = SingleFlight(snapshot, ttl=0)
+    results = []
+    threads = [Thread(target=lambda: results.append(flight())) for _ in range(5)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    while flight.shared < 4:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert flight.stats()['hit_rate'] == 0.8
+
+
+def test_callers_with_a_new_key_dont_share_a_running_call():
+    started, release = Event(), Event()
+    calls = []
+
+    def snapshot():
+        calls.append(1)
+        call_number = len(calls)
+        if call_number == 1:
+            started.set()
+            release.wait()
+        return {'call': call_number}
+
+    flight = SingleFlight(snapshot, ttl=10.)
+    results = {}
+    old = Thread(target=lambda: results.update(old=flight(key=1)))
+    old.start()
+    started.wait()
+    results['new'] = flight(key=2)
+    release.set()
+    old.join()
+    assert results == {'old': {'call': 1}, 'new': {'call': 2}}
+    assert flight.shared == 0
+
+
+def test_results_are_reused_for_ttl_with_the_same_key():
+    clock = VirtualClock()
+    flight = SingleFlight(object, ttl=1., clock=clock)
+    first = flight(key=1)
+    assert flight(key=1) is first
+    assert flight(key=2) is not first
+    second = flight(key=2)
+    clock.advance(1.5)
+    assert flight(key=2) is not second
+    assert flight.stats() == {'calls': 5, 'computed': 3, 'shared': 0, 'cached': 2,
+                              'hit_rate': 0.4}
+
+
+def test_errors_are_raised_and_not_reused():
+    results = iter([ValueError('no robot'), 'state'])
+
+    def snapshot():
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    flight = SingleFlight(snapshot, ttl=10.)
+    with pytest.raises(ValueError):
+        flight()
+    assert flight() == 'state'
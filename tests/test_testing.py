@@ -0,0 +1,27 @@
+import pytest
+
+from aspyrobotmx.testing import ImmediateExecutor, VirtualClock
+
+
+def test_virtual_clock_only_moves_when_sleeping():
+    clock = VirtualClock(start=10.)
+    assert clock() == 10.
+    clock.sleep(.5)
+    clock.advance(2.)
+    assert clock() == 12.5
+    assert clock.sleeps == [.5]
+
+
+def test_immediate_executor_runs_functions_in_order():
+    calls = []
+    executor = ImmediateExecutor()
+    first = executor.submit(calls.append, 1)
+    calls.append(2)
+    assert calls == [1, 2]
+    assert first.done() is True
+
+
+def test_immediate_executor_keeps_exceptions_in_future():
+    future = ImmediateExecutor().submit(int, 'not a number')
+    with pytest.raises(ValueError):
+        future.result()